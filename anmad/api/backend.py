@@ -1,12 +1,15 @@
 #!/usr/bin/env python3
 """API functions."""
 
-from flask import abort, redirect
+from flask import (
+    Response, abort, redirect, request, has_request_context, jsonify)
 import git
 
 import anmad.interface.backend as intbackend
+from anmad.common import timings
+from anmad.common.jobs import DEFAULT_PRIORITY, PRIORITIES
 from anmad.common.yaml import list_missing_files
-from anmad.daemon.process import get_ansible_playbook_procs, kill, killall
+from anmad.daemon.process import kill_registered
 
 def git_pull(**config):
     """Execute git pull on playbook_root_dir.
@@ -22,23 +25,63 @@ def git_pull(**config):
     except git.GitCommandError as error:
         return error
 
-def runall(**config):
-    """Run all playbooks after verifying that files exist."""
+def requester():
+    """Return the address of the client making the current request,
+    or None outside of a request."""
+    if has_request_context():
+        return request.remote_addr
+    return None
+
+def request_priority():
+    """Return the priority asked for by the priority argument of the
+    current request, aborting with 400 if it isnt a known one.
+    Returns the default priority outside a request."""
+    if not has_request_context():
+        return DEFAULT_PRIORITY
+    priority = request.args.get('priority', DEFAULT_PRIORITY)
+    if priority not in PRIORITIES:
+        abort(400)
+    return priority
+
+def queued(job, **config):
+    """Log a job that was queued, or found already waiting, and return
+    it."""
+    if job.get("coalesced"):
+        config["logger"].info("%s already queued as job %s",
+                              str(job["playbooks"]), job["id"])
+    else:
+        config["logger"].info("Queueing %s at %s priority",
+                              str(job["playbooks"]),
+                              job.get("priority", DEFAULT_PRIORITY))
+    return job
+
+def queue_prerun(**config):
+    """Queue the prerun playbooks that arent already queued."""
+    if config["args"].pre_run_playbooks is not None:
+        for play in config["args"].prerun_list:
+            job = config["queues"].prequeue_job(play, requester=requester())
+            if not job.get("coalesced"):
+                config["logger"].info("Pre-Queueing %s", str(play))
+
+def queue_runall(priority=DEFAULT_PRIORITY, **config):
+    """Queue the prerun playbooks that arent already queued, and a job
+    for the run list at priority, after verifying that files exist.
+    Returns the run job, or None if files are missing."""
     problemfile = list_missing_files(
         config["logger"],
         config["args"].prerun_list)
     if problemfile:
         config["logger"].info("Invalid files: %s", str(problemfile))
-        return redirect(config["baseurl"])
+        return None
 
-    if config["args"].pre_run_playbooks is not None:
-        for play in config["args"].prerun_list:
-            if [play] not in config["queues"].prequeue_list:
-                config["logger"].info("Pre-Queueing %s", str(play))
-                config["queues"].prequeue_job(play)
+    queue_prerun(**config)
+    return queued(config["queues"].queue_job(
+        config["args"].run_list, requester=requester(),
+        priority=priority), **config)
 
-    config["logger"].info("Queueing %s", str(config["args"].run_list))
-    config["queues"].queue_job(config["args"].run_list)
+def runall(**config):
+    """Run all playbooks after verifying that files exist."""
+    queue_runall(priority=request_priority(), **config)
     config["queues"].update_job_lists()
 
     config["logger"].debug("Redirecting to control page")
@@ -50,8 +93,9 @@ def oneplaybook(playbook, playbooklist, **config):
         config["logger"].warning("API request for %s DENIED", str(playbook))
         abort(404)
     my_runlist = [config["args"].playbook_root_dir + '/' + playbook]
-    config["logger"].info("Queueing %s", str(my_runlist))
-    config["queues"].queue_job(my_runlist)
+    return queued(config["queues"].queue_job(
+        my_runlist, requester=requester(), priority=request_priority()),
+                  **config)
 
 def configuredplaybook(playbook, **config):
     """Runs one playbook, if its one of the configured ones."""
@@ -77,26 +121,26 @@ def otherplaybook(playbook, **config):
 
 def kill_proc_by_pid(requestedpid, **config):
     """Kill a proc by PID.
-    Hopefully a PID thats verified by psutil to be an ansible-playbook!"""
-    proclist = get_ansible_playbook_procs()
-    pids = [li['pid'] for li in proclist]
-    if requestedpid in pids:
-        kill(requestedpid)
+    Only PIDs in the registry of processes started by anmad are killed."""
+    proc = config["registry"].lookup(requestedpid)
+    if proc is not None:
+        kill_registered(proc)
+        config["metrics"].inc('killed_processes_total')
         config["logger"].warning("KILLED pid %s on request", requestedpid)
-        for proc in proclist:
-            if proc['pid'] == requestedpid:
-                cmdline = ' '.join(proc['cmdline'])
-                config["logger"].warning(
-                    "pid %s had cmdline '%s'", requestedpid, cmdline)
+        config["logger"].warning(
+            "pid %s had cmdline '%s'", requestedpid, ' '.join(proc['cmdline']))
     else:
         config["logger"].critical(
-            "got request to kill PID %s which doesnt look like ansible-playbook!!!",
+            "got request to kill PID %s which anmad did not start!!!",
             requestedpid)
     return redirect(config["baseurl"] + "jobs")
 
 def killall_ansible(**config):
-    """equivalent to sh: killall ansible-playbook."""
-    killedprocs = killall()
+    """Kill every ansible-playbook process started by anmad on this host."""
+    killedprocs = config["registry"].procs()
+    for proc in killedprocs:
+        kill_registered(proc)
+    config["metrics"].inc('killed_processes_total', len(killedprocs))
     for proc in killedprocs:
         config["logger"].warning(
             "KILLED process '%s' via killall", ' '.join(proc['cmdline']))
@@ -108,3 +152,215 @@ def clearqueues(**config):
     config["queues"].clear()
     config["queues"].update_job_lists()
     return redirect(config["baseurl"])
+
+def syncache_stats(**config):
+    """Return syntax check cache hit rates as json."""
+    return jsonify(config["syncache"].stats())
+
+def playbook_catalog(**config):
+    """Return playbooks found in playbook_root_dir as json."""
+    return jsonify({
+        "playbook_root_dir": config["args"].playbook_root_dir,
+        "playbooks": intbackend.catalog(**config).playbooks(),
+        "configured": intbackend.buttonlist(
+            config["args"].playbooks, config["args"].pre_run_playbooks),
+        "other": intbackend.extraplays(**config),
+        })
+
+def log_history(**config):
+    """Return logs for the playbook in the play arg as json, newest
+    first. Without a play arg, list playbooks that have logs."""
+    play = request.args.get('play')
+    if not play:
+        return jsonify({"playbooks": config["logindex"].playbooks()})
+    start = request.args.get('start', default=0, type=int)
+    count = request.args.get('count', default=50, type=int)
+    return jsonify({
+        "playbook": play,
+        "logs": [{"log": logfile, "time": when} for logfile, when in
+                 config["logindex"].history(play, start, count)],
+        })
+
+def run_events(**config):
+    """Return the task / host event summary of a run as json, for the
+    log in the log arg, or the latest log of the playbook in the play
+    arg."""
+    logfile = request.args.get('log')
+    if not logfile and request.args.get('play'):
+        logfile = config["logindex"].latest(request.args.get('play'))
+    if not logfile or '..' in logfile:
+        return abort(404)
+    summary = config["logindex"].run(logfile.lstrip('/'))
+    if summary is None:
+        return abort(404, 'No events recorded for ' + logfile)
+    summary["log"] = logfile
+    return jsonify(summary)
+
+def timing_report(**config):
+    """Return the slowest tasks and roles across runs as json, for the
+    playbook in the play arg or all playbooks."""
+    return jsonify(timings.report(
+        config["queues"].redis,
+        request.args.get('play') or None,
+        request.args.get('count', default=20, type=int)))
+
+def metrics(**config):
+    """Return metrics in the prometheus text format."""
+    return Response(config["metrics"].render(config["queues"]),
+                    mimetype='text/plain; version=0.0.4')
+
+def api_error(message, status=400):
+    """Return a json error response."""
+    return jsonify({"error": message}), status
+
+def job_specs(body):
+    """Return the list of job specs in a json request body, which may be
+    one job spec, a list of them, or {"jobs": [job spec, ...]}.
+    Specs without a priority get the one given beside "jobs", or the
+    priority argument of the request."""
+    priority = request.args.get('priority', DEFAULT_PRIORITY)
+    if isinstance(body, dict) and "jobs" in body:
+        priority = body.get("priority", priority)
+        body = body["jobs"]
+    if isinstance(body, dict):
+        body = [body]
+    if not isinstance(body, list) or not all(
+            isinstance(spec, dict) for spec in body):
+        return None
+    return [dict(spec, priority=spec.get("priority", priority))
+            for spec in body]
+
+def submit_jobs(**config):
+    """Queue one or many jobs from a json request body, where each job
+    spec is {"playbooks": [playbook, ...]} with playbooks named relative
+    to playbook_root_dir, or {"runall": true}, either with an optional
+    "priority" of urgent, normal or bulk.
+    Either every job is queued, or none are."""
+    specs = job_specs(request.get_json(silent=True))
+    if not specs:
+        return api_error('Expected a job, a list of jobs or '
+                         '{"jobs": [...]}, where a job is '
+                         '{"playbooks": [...]} or {"runall": true}')
+    allowed = set(intbackend.buttonlist(
+        config["args"].playbooks, config["args"].pre_run_playbooks)
+                  + intbackend.extraplays(**config))
+    errors = []
+    for num, spec in enumerate(specs):
+        if spec["priority"] not in PRIORITIES:
+            errors.append({"job": num, "error": 'Unknown priority',
+                           "priority": spec["priority"]})
+            continue
+        if spec.get("runall"):
+            missing = list_missing_files(
+                config["logger"], config["args"].prerun_list)
+            if missing:
+                errors.append({"job": num, "error": 'Missing playbooks',
+                               "playbooks": missing})
+            continue
+        playbooks = spec.get("playbooks")
+        if (not isinstance(playbooks, list) or not playbooks
+                or not all(isinstance(play, str) for play in playbooks)):
+            errors.append({"job": num, "error": 'No playbooks list'})
+            continue
+        denied = [play for play in playbooks if play not in allowed]
+        if denied:
+            config["logger"].warning("API request for %s DENIED", denied)
+            errors.append({"job": num, "error": 'Unknown playbooks',
+                           "playbooks": denied})
+    if errors:
+        return jsonify({"error": 'No jobs queued', "jobs": errors}), 400
+
+    if any(spec.get("runall") for spec in specs):
+        queue_prerun(**config)
+    # one batch per lane, in the order the specs came in
+    lanes = {}
+    for num, spec in enumerate(specs):
+        lanes.setdefault(spec["priority"], []).append(
+            (num, config["args"].run_list if spec.get("runall") else
+             [config["args"].playbook_root_dir + '/' + play
+              for play in spec["playbooks"]]))
+    jobs = [None] * len(specs)
+    for priority, batch in lanes.items():
+        for (num, _), job in zip(batch, config["queues"].queue_jobs(
+                [playbooks for _, playbooks in batch],
+                requester=requester(), priority=priority)):
+            jobs[num] = job
+    config["logger"].info(
+        "Queued %s jobs via the api, %s were already queued", len(jobs),
+        len([job for job in jobs if job.get("coalesced")]))
+    return jsonify({"jobs": [
+        {"id": job["id"],
+         "playbooks": job["playbooks"],
+         "priority": job["priority"],
+         "status": 'queued',
+         "coalesced": bool(job.get("coalesced")),
+         "url": config["baseurl"] + 'api/v1/jobs/' + job["id"]}
+        for job in jobs]}), 202
+
+def find_job(job_id, **config):
+    """Return the status of a queued or running job, or None if it isnt
+    in any queue."""
+    queues = config["queues"]
+    queues.update_job_lists()
+    joblists = [('prerun', queues.prequeue_list)] + [
+        (queues.lanes[priority].name, queues.lane_lists[priority])
+        for priority in PRIORITIES]
+    for name, joblist in joblists:
+        for position, job in enumerate(joblist):
+            if isinstance(job, dict) and job.get("id") == job_id:
+                return {"status": 'queued', "queue": name,
+                        "position": position, "job": job}
+    for worker_id, job in intbackend.claimed_jobs(**config):
+        if isinstance(job, dict) and job.get("id") == job_id:
+            return {"status": 'running', "worker": worker_id, "job": job}
+    return None
+
+def job_status(job_id, **config):
+    """Return the status of one job, with its lifecycle record if it has
+    been claimed by a daemon, as json."""
+    status = find_job(job_id, **config)
+    record = config["jobrecords"].get(job_id)
+    if status is None and record is None:
+        return api_error('Job ' + job_id + ' is not known', 404)
+    if status is None:
+        status = {"status": record["state"]}
+    status["lifecycle"] = record
+    return jsonify(status)
+
+def job_history(**config):
+    """Return lifecycle records of recently claimed jobs as json, newest
+    first."""
+    return jsonify({"jobs": config["jobrecords"].recent(
+        request.args.get('start', default=0, type=int),
+        request.args.get('count', default=50, type=int))})
+
+def queue_state(**config):
+    """Return queued and running jobs, and daemon status, as json."""
+    config["queues"].update_job_lists()
+    return jsonify({
+        "prerun": config["queues"].prequeue_list,
+        "playbooks": config["queues"].queue_list,
+        "lanes": config["queues"].lane_lists,
+        "running": [{"worker": worker_id, "job": job} for worker_id, job in
+                    intbackend.claimed_jobs(**config)],
+        "daemon": intbackend.daemon_status(**config),
+        })
+
+def run_history(playbook, **config):
+    """Return recent runs of a playbook, newest first, with the results
+    of each run that recorded events, as json."""
+    start = request.args.get('start', default=0, type=int)
+    count = request.args.get('count', default=50, type=int)
+    history = config["logindex"].history(playbook, start, count)
+    runs = []
+    for (logfile, when), summary in zip(
+            history,
+            config["logindex"].runs([logfile for logfile, _ in history])):
+        run = {"log": logfile, "time": when}
+        if summary is not None:
+            run.update({"start": summary["start"],
+                        "end": summary["end"],
+                        "hosts": summary["hosts"],
+                        "failed": summary["failed"]})
+        runs.append(run)
+    return jsonify({"playbook": playbook, "runs": runs})
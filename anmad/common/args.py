@@ -11,6 +11,51 @@ def prepend_rootdir(myrootdir, mylist):
     ret = [myrootdir + '/' + str(x) for x in mylist]
     return ret
 
+def add_redis_args(parser):
+    """Add the redis connection arguments to a parser."""
+    parser.add_argument(
+        "--redis_host",
+        help="redis server hostname",
+        default="localhost"
+        )
+    parser.add_argument(
+        "--redis_port",
+        type=int,
+        help="redis server port",
+        default=6379
+        )
+    parser.add_argument(
+        "--redis_db",
+        type=int,
+        help="redis database number",
+        default=0
+        )
+    parser.add_argument(
+        "--redis_socket",
+        help="redis unix socket path, overrides --redis_host and "
+             "--redis_port if set"
+        )
+
+def parse_redis_args():
+    """Read only the redis connection arguments from command line or
+    config file, for tools that dont need the rest of the config."""
+    parser = configargparse.ArgParser(
+        default_config_files=[
+            '/etc/anmad.conf',
+            expanduser("~") + '/.anmad.conf'
+            ],
+        formatter_class=configargparse.ArgumentDefaultsHelpFormatter
+        )
+    parser.add_argument(
+        "-c",
+        "--configfile",
+        is_config_file=True,
+        help="override default config files"
+        )
+    add_redis_args(parser)
+    myargs, _ = parser.parse_known_args()
+    return myargs
+
 def parse_anmad_args():
     """Read arguments from command line or config file."""
 
@@ -75,6 +120,24 @@ def parse_anmad_args():
         help="Optional directory to search for *.yml and *.yaml files to "
              "syntax check when changes are detected"
         )
+    parser.add_argument(
+        "--watch",
+        dest="watch",
+        action="store_true",
+        help="watch playbook_root_dir and syntax_check_dir for changes "
+             "(with inotify, or by polling) and run yaml and ansible syntax "
+             "checks in the background, so that queued jobs find passing "
+             "checks already in the syntax check cache. Needs the cache, "
+             "so ignored if --syncheck_cache_ttl is 0. Checks wait for any "
+             "running job to finish"
+        )
+    parser.add_argument(
+        "--watch_debounce",
+        type=float,
+        help="seconds without further changes before checking, so that "
+             "bursts of changes such as a git pull are checked once",
+        default=2.0
+        )
     parser.add_argument(
         "--playbooks",
         "-p",
@@ -87,6 +150,18 @@ def parse_anmad_args():
         help="base directory to run playbooks from",
         required=True,
         )
+    parser.add_argument(
+        "--systemctl_status",
+        action="store_true",
+        help="in the interface, ask systemctl for the anmad service status "
+             "when no daemon heartbeat is found in redis"
+        )
+    parser.add_argument(
+        "--recursive_catalog",
+        action="store_true",
+        help="also list playbooks in subdirectories of playbook_root_dir "
+             "(except roles, group_vars, host_vars and hidden dirs)"
+        )
     parser.add_argument(
         "--pre_run_playbooks",
         nargs='*',
@@ -140,11 +215,70 @@ def parse_anmad_args():
              "defaults to number of cpu reported by OS",
         default=cpu_count()
         )
+    parser.add_argument(
+        "--engine",
+        choices=['pool', 'asyncio'],
+        help="how to run concurrent ansible-playbook processes. 'pool' "
+             "uses a pool of python worker processes, 'asyncio' supervises "
+             "them all from one event loop so --concurrency can exceed "
+             "the number of cpus",
+        default='pool'
+        )
     parser.add_argument(
         "--timeout",
         help="timeout in seconds before aborting playbooks",
         default=1800
         )
+    parser.add_argument(
+        "--kill_grace",
+        type=float,
+        help="seconds a timed out playbook's process group gets to exit "
+             "after SIGTERM before it is sent SIGKILL",
+        default=10
+        )
+    parser.add_argument(
+        "--syncheck_cache_ttl",
+        type=int,
+        help="seconds to remember a passing syntax check of an unchanged "
+             "playbook, its includes, roles, inventory and ansible config. "
+             "0 disables the cache",
+        default=604800
+        )
+    parser.add_argument(
+        "--log_retention_days",
+        type=int,
+        help="delete ansible logs older than this many days. "
+             "0 keeps them forever",
+        default=0
+        )
+    parser.add_argument(
+        "--log_retention_count",
+        type=int,
+        help="keep at most this many ansible logs per playbook. "
+             "0 for no limit",
+        default=0
+        )
+    parser.add_argument(
+        "--log_retention_mb",
+        type=int,
+        help="delete the oldest ansible logs when all logs together "
+             "use more than this many MB. 0 for no limit",
+        default=0
+        )
+    parser.add_argument(
+        "--log_compress_after",
+        type=int,
+        help="gzip ansible logs that have not been written to for this "
+             "many hours. 0 disables compression",
+        default=24
+        )
+    parser.add_argument(
+        "--job_history_days",
+        type=float,
+        help="days to keep the record of when each job was queued, "
+             "checked and run, and its return codes",
+        default=7
+        )
     parser.add_argument(
         "--messagelist_size",
         help="number of messages to display on homepage",
@@ -161,8 +295,24 @@ def parse_anmad_args():
         "--repo_deploykey",
         help="ssh private key file for git pull operations"
         )
+    parser.add_argument(
+        "--lease_time",
+        type=int,
+        help="seconds a daemon worker may go without a heartbeat before "
+             "its claimed job is requeued for another worker. Several "
+             "daemons may consume the same redis queues",
+        default=30
+        )
+    parser.add_argument(
+        "--starve_after",
+        type=int,
+        help="seconds a job may wait in a lower priority queue before it "
+             "runs ahead of urgent or normal jobs",
+        default=900
+        )
+    add_redis_args(parser)
 
-    parser.set_defaults(debug=False, syslog=True, dryrun=False)
+    parser.set_defaults(debug=False, syslog=True, dryrun=False, watch=False)
     myargs, unknown = parser.parse_known_args()
     if len(unknown) > 0:
         print('ANMAD: Ignoring unknown args: ' + str(unknown))
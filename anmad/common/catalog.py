@@ -0,0 +1,71 @@
+"""Cached index of playbooks in playbook_root_dir."""
+import os
+import threading
+
+# directories that hold things other than playbooks, skipped when recursive
+SKIP_DIRS = ['roles', 'group_vars', 'host_vars']
+
+class PlaybookCatalog:
+    """Index of yaml files under a directory, relative to it.
+    The listing is only rebuilt when the mtime of an indexed directory
+    changes (a file was added, removed or renamed), or when invalidate()
+    is called, so most lookups cost one stat per directory."""
+
+    def __init__(self, logger, root_dir, recursive=False):
+        """Init PlaybookCatalog."""
+        self.logger = logger
+        self.root_dir = os.path.abspath(root_dir)
+        self.recursive = recursive
+        self.index = []
+        self.mtimes = None
+        self.lock = threading.Lock()
+
+    def invalidate(self):
+        """Force the next lookup to rebuild the index."""
+        self.mtimes = None
+
+    def stale(self):
+        """Return True if any indexed directory has changed."""
+        if self.mtimes is None:
+            return True
+        for directory, mtime in self.mtimes.items():
+            try:
+                if os.stat(directory).st_mtime_ns != mtime:
+                    return True
+            except OSError:
+                return True
+        return False
+
+    def refresh(self):
+        """Rebuild the index."""
+        self.logger.debug("Indexing playbooks in %s", self.root_dir)
+        index = []
+        mtimes = {}
+        for root, dirs, files in os.walk(self.root_dir):
+            # stat before listing, so changes made while listing are
+            # picked up next time
+            mtimes[root] = os.stat(root).st_mtime_ns
+            if self.recursive:
+                dirs[:] = [d for d in dirs
+                           if not d.startswith('.') and d not in SKIP_DIRS]
+            else:
+                dirs[:] = []
+            for filename in files:
+                if filename.endswith(('.yml', '.yaml')):
+                    index.append(os.path.relpath(
+                        os.path.join(root, filename), self.root_dir))
+        # a missing root_dir is never fresh
+        mtimes.setdefault(self.root_dir, None)
+        index.sort()
+        self.index = index
+        self.mtimes = mtimes
+
+    def playbooks(self):
+        """Return sorted list of playbooks, relative to root_dir."""
+        with self.lock:
+            if self.stale():
+                self.refresh()
+            return list(self.index)
+
+    def __contains__(self, playbook):
+        return playbook in self.playbooks()
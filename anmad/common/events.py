@@ -0,0 +1,91 @@
+"""Read the per task / per host events written by the anmad_events
+ansible callback plugin."""
+import json
+import os
+
+CALLBACK_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'daemon', 'callback_plugins')
+CALLBACK_NAME = 'anmad_events'
+
+def events_file(logfile):
+    """Return the events file written alongside an ansible log."""
+    if logfile.endswith('.gz'):
+        logfile = logfile[:-3]
+    return logfile + '.events.jsonl'
+
+def callback_env(env, logfile):
+    """Enable the anmad_events callback in an ansible-playbook environment,
+    writing events alongside logfile."""
+    env['ANMAD_EVENTS_PATH'] = events_file(logfile)
+    env['ANSIBLE_CALLBACK_PLUGINS'] = os.pathsep.join(
+        [CALLBACK_DIR] + [path for path in
+                          env.get('ANSIBLE_CALLBACK_PLUGINS', '').split(
+                              os.pathsep) if path])
+    # callbacks_enabled was called callback_whitelist before ansible 2.11
+    for setting in ['ANSIBLE_CALLBACKS_ENABLED', 'ANSIBLE_CALLBACK_WHITELIST']:
+        env[setting] = ','.join(
+            [name for name in env.get(setting, '').split(',') if name]
+            + [CALLBACK_NAME])
+    return env
+
+def read_events(filename):
+    """Generator yielding events from an events file, skipping any line
+    that is not valid json (like one cut short by a kill)."""
+    with open(filename, 'r') as my_file:
+        for line in my_file:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+def new_task(event, start):
+    """Return an empty task summary for the task in event."""
+    return {"task": event["task"],
+            "role": event["role"],
+            "play": event.get("play"),
+            "start": start,
+            "duration": 0.0,
+            "host_duration_max": 0.0,
+            "hosts": 0,
+            "changed": 0,
+            "status": {}}
+
+def summarize(filename):
+    """Return a summary of one run from its events file: per host stats,
+    the failed host / task pairs, and each tasks duration and results.
+    Returns None if there is no events file."""
+    if not os.path.isfile(filename):
+        return None
+    tasks = {}
+    failed = []
+    hosts = {}
+    start = end = None
+    for event in read_events(filename):
+        if start is None:
+            start = event["time"]
+        end = event["time"]
+        if event["event"] == 'task_start':
+            tasks.setdefault(event["uuid"], new_task(event, event["time"]))
+        elif event["event"] == 'host':
+            task = tasks.setdefault(
+                event["uuid"], new_task(event, event["start"]))
+            task["hosts"] += 1
+            task["changed"] += int(event["changed"])
+            task["status"][event["status"]] = (
+                task["status"].get(event["status"], 0) + 1)
+            task["duration"] = round(max(
+                task["duration"],
+                event["start"] + event["duration"] - task["start"]), 3)
+            task["host_duration_max"] = max(
+                task["host_duration_max"], event["duration"])
+            if event["status"] in ['failed', 'unreachable']:
+                failed.append({key: event.get(key) for key in
+                               ['host', 'task', 'role', 'status', 'msg']})
+        elif event["event"] == 'stats':
+            hosts = event["hosts"]
+    return {"start": start,
+            "end": end,
+            "hosts": hosts,
+            "failed": failed,
+            "tasks": sorted(tasks.values(), key=lambda task: task["start"])}
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""Anmad job envelope and queue wire format.
+
+Jobs are stored in redis as compact JSON objects:
+
+    {"version":1,"id":"<hex>","type":"run","playbooks":["/x/deploy.yaml"],
+     "submitted":1600000000.0,"requester":"10.0.0.1","priority":"normal"}
+
+so that tools other than anmad can push jobs with RPUSH onto
+hotqueue:<name> (followed by INCR hotqueue:<name>:version).
+Run jobs of each priority have their own queue, or lane, named
+<name>-<priority>, except normal priority jobs which use <name>.
+Messages pickled by older anmad versions can still be read, but only
+if they are made of plain builtin types. Messages that cant be decoded
+are read as {"type":"invalid"} markers, and moved by anmad to the
+hotqueue:<name>:dead list."""
+import io
+import json
+import pickle
+from time import time
+from uuid import uuid4
+
+JOB_VERSION = 1
+JOB_TYPES = ['run', 'prerun', 'restart']
+# highest first
+PRIORITIES = ['urgent', 'normal', 'bulk']
+DEFAULT_PRIORITY = 'normal'
+# type of the marker returned for messages that cant be decoded
+INVALID = 'invalid'
+
+def make_job(playbooks, jobtype='run', requester=None,
+             priority=DEFAULT_PRIORITY):
+    """Return a new job envelope for a list of playbooks."""
+    if isinstance(playbooks, str):
+        playbooks = [playbooks]
+    return {"version": JOB_VERSION,
+            "id": uuid4().hex,
+            "type": jobtype,
+            "playbooks": list(playbooks),
+            "submitted": time(),
+            "requester": requester,
+            "priority": priority}
+
+def is_job(msg, jobtype=None):
+    """Return True if msg is a job envelope, optionally of jobtype."""
+    if not isinstance(msg, dict) or msg.get("type") not in JOB_TYPES:
+        return False
+    return jobtype is None or msg["type"] == jobtype
+
+def is_invalid(msg):
+    """Return True if msg is the marker for a message that couldnt be
+    decoded."""
+    return isinstance(msg, dict) and msg.get("type") == INVALID
+
+def invalid_message(data, error):
+    """Return the marker for a message that couldnt be decoded."""
+    if isinstance(data, bytes):
+        data = data.decode('utf-8', 'replace')
+    return {"type": INVALID, "error": str(error), "data": str(data)[:200]}
+
+def job_signature(job):
+    """Return a string that is the same for jobs that would run the same
+    playbooks, in any order."""
+    return json.dumps([job["type"], sorted(job["playbooks"])],
+                      separators=(',', ':'))
+
+def upgrade_legacy(msg, jobtype):
+    """Convert a message from an older anmad version into a job envelope.
+    Legacy jobs were bare lists of playbooks."""
+    if not isinstance(msg, list):
+        return msg
+    if msg == ['restart_anmad_run']:
+        return make_job([], jobtype='restart')
+    return make_job(msg, jobtype=jobtype)
+
+
+class SafeUnpickler(pickle.Unpickler):
+    """Unpickler that refuses to load anything but builtin data types."""
+
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError(
+            "refusing to unpickle " + module + "." + name)
+
+
+class JobSerializer:
+    """HotQueue serializer that writes compact JSON and reads both JSON
+    and legacy pickle messages.
+    If jobtype is set, legacy messages are upgraded to job envelopes
+    of that type, and incoming job envelopes are filled in with
+    defaults for any missing fields."""
+
+    def __init__(self, jobtype=None):
+        self.jobtype = jobtype
+
+    @staticmethod
+    def dumps(msg):
+        """Serialize a message to compact JSON."""
+        return json.dumps(msg, separators=(',', ':'))
+
+    def loads(self, data):
+        """Deserialize a JSON or legacy pickle message.
+        Returns an invalid_message marker instead of raising if data
+        cant be decoded, or if jobtype is set and data decodes to
+        something that isnt a job envelope."""
+        try:
+            if isinstance(data, bytes) and data[:1] == pickle.PROTO:
+                msg = SafeUnpickler(io.BytesIO(data)).load()
+                if self.jobtype is None:
+                    return msg
+                msg = upgrade_legacy(msg, self.jobtype)
+            else:
+                msg = json.loads(data)
+        except (pickle.UnpicklingError, EOFError, ValueError, TypeError,
+                KeyError, IndexError, AttributeError) as error:
+            return invalid_message(data, error)
+        if self.jobtype is None:
+            return msg
+        if isinstance(msg, dict):
+            msg.setdefault("version", JOB_VERSION)
+            msg.setdefault("id", None)
+            msg.setdefault("type", self.jobtype)
+            msg.setdefault("playbooks", [])
+            msg.setdefault("submitted", None)
+            msg.setdefault("requester", None)
+            msg.setdefault("priority", DEFAULT_PRIORITY)
+        if not is_job(msg) or not isinstance(msg["playbooks"], list):
+            return invalid_message(data, "not a job: " + repr(msg)[:100])
+        return msg
@@ -0,0 +1,123 @@
+"""Lifecycle records of jobs from the playbooks queue, kept in redis for
+a while after they finish, so the time a job spent waiting in the queue,
+syntax checking and running can be seen."""
+import json
+import time
+
+import redis
+
+from anmad.common.queues import RedisClient
+
+PREFIX = 'anmad:jobs'
+# seconds records are kept after a jobs last change
+TTL = 7 * 86400
+TIMES = ['submitted', 'dequeued', 'prerun_done', 'syncheck_start',
+         'syncheck_end', 'run_start', 'run_end', 'finished']
+JSON_FIELDS = ['playbooks', 'returncodes', 'syncheck_problems']
+# phase name: (start, end)
+PHASES = {"wait": ('submitted', 'dequeued'),
+          "prerun": ('dequeued', 'prerun_done'),
+          "syncheck": ('syncheck_start', 'syncheck_end'),
+          "run": ('run_start', 'run_end'),
+          "total": ('submitted', 'finished')}
+
+
+def phases(record):
+    """Return seconds spent in each phase of a job record, or None for
+    phases it has not finished."""
+    return {phase: (round(record[end] - record[start], 3)
+                    if record.get(start) and record.get(end) else None)
+            for phase, (start, end) in PHASES.items()}
+
+
+class JobRecords(RedisClient):
+    """Hash per job of the times it reached each point of its lifecycle,
+    the worker that ran it, its state and per playbook return codes,
+    plus a sorted set of recent job ids.
+    Recording is best effort, redis errors are ignored so that records
+    never stop a playbook from running."""
+
+    def __init__(self, ttl=TTL, prefix=PREFIX, **redis_kwargs):
+        """Init JobRecords."""
+        super().__init__(**redis_kwargs)
+        self.ttl = ttl
+        self.prefix = prefix
+        self.recent_key = prefix + ':recent'
+
+    def key(self, job_id):
+        """Return the key of a jobs record."""
+        return self.prefix + ':' + str(job_id)
+
+    def write(self, job_id, fields):
+        """Update a jobs record and its expiry time."""
+        if job_id is None:
+            return
+        fields = {field: (json.dumps(value) if field in JSON_FIELDS
+                          else value)
+                  for field, value in fields.items() if value is not None}
+        try:
+            pipe = self.redis.pipeline()
+            pipe.hset(self.key(job_id), mapping=fields)
+            pipe.expire(self.key(job_id), int(self.ttl))
+            pipe.execute()
+        except redis.RedisError:
+            pass
+
+    def start(self, job, worker_id, dequeued=None):
+        """Create the record of a job claimed by a worker at time
+        dequeued (default now)."""
+        now = time.time() if dequeued is None else dequeued
+        self.write(job["id"], {
+            "id": job["id"],
+            "type": job["type"],
+            "playbooks": job["playbooks"],
+            "requester": job.get("requester"),
+            "priority": job.get("priority"),
+            "submitted": job.get("submitted"),
+            "dequeued": now,
+            "worker": worker_id,
+            "state": 'dequeued'})
+        if job["id"] is None:
+            return
+        try:
+            pipe = self.redis.pipeline()
+            pipe.zadd(self.recent_key, {job["id"]: now})
+            pipe.zremrangebyscore(self.recent_key, 0, now - self.ttl)
+            pipe.execute()
+        except redis.RedisError:
+            pass
+
+    def mark(self, job_id, point, state=None, **fields):
+        """Record the time a job reached a point of its lifecycle,
+        optionally with its new state and other fields."""
+        fields[point] = time.time()
+        fields["state"] = state
+        self.write(job_id, fields)
+
+    @staticmethod
+    def decode(record):
+        """Return a record read from redis as a dict, with its phases."""
+        record = {field.decode(): value.decode()
+                  for field, value in record.items()}
+        for field in TIMES:
+            if field in record:
+                record[field] = float(record[field])
+        for field in JSON_FIELDS:
+            if field in record:
+                record[field] = json.loads(record[field])
+        record["phases"] = phases(record)
+        return record
+
+    def get(self, job_id):
+        """Return the record of a job, or None if there isnt one."""
+        record = self.redis.hgetall(self.key(job_id))
+        return self.decode(record) if record else None
+
+    def recent(self, start=0, count=50):
+        """Return records of recently claimed jobs, newest first."""
+        job_ids = self.redis.zrevrange(
+            self.recent_key, start, start + count - 1)
+        pipe = self.redis.pipeline()
+        for job_id in job_ids:
+            pipe.hgetall(self.key(job_id.decode()))
+        return [self.decode(record) for record in pipe.execute() if record]
@@ -0,0 +1,217 @@
+"""Functions to read ansible-playbook log files a page at a time.
+Logs compressed with gzip (.log.gz) are decompressed as they are read,
+offsets into them are offsets into the decompressed log."""
+import functools
+import gzip
+import os
+import shutil
+import struct
+import time
+from collections import deque
+
+from anmad.common.events import events_file
+
+LOG_BASE = '/var/log/ansible/playbook'
+# most bytes of a log shown on one page
+PAGE_BYTES = 256 * 1024
+BLOCK_BYTES = 64 * 1024
+# seconds between checks for appended output when following a log
+FOLLOW_INTERVAL = 1.0
+# stop following a log after this many seconds without new output
+FOLLOW_IDLE = 300
+# deflate never compresses better than this, so gzip files smaller than
+# 4GiB / MAX_DEFLATE_RATIO are under 4GiB decompressed
+MAX_DEFLATE_RATIO = 1032
+
+def compressed(filename):
+    """Return True if filename is a gzip compressed log."""
+    return filename.endswith('.gz')
+
+def open_log(filename):
+    """Open a log for reading bytes, decompressing it if needed."""
+    if compressed(filename):
+        return gzip.open(filename, 'rb')
+    return open(filename, 'rb')
+
+@functools.lru_cache(maxsize=256)
+def gz_size(filename, mtime_ns, size):
+    """Return the decompressed size of a gzip log by reading it through.
+    mtime_ns and size are only there so that a changed file isnt
+    answered from the cache."""
+    # pylint: disable=unused-argument
+    total = 0
+    with gzip.open(filename, 'rb') as logfile:
+        block = logfile.read(BLOCK_BYTES)
+        while block:
+            total += len(block)
+            block = logfile.read(BLOCK_BYTES)
+    return total
+
+def log_size(filename):
+    """Return the size of a log, decompressed."""
+    if compressed(filename):
+        stat = os.stat(filename)
+        if stat.st_size < 4:
+            return 0
+        if stat.st_size * MAX_DEFLATE_RATIO >= 2 ** 32:
+            # could be 4GiB or more, too big for the gzip trailer
+            return gz_size(filename, stat.st_mtime_ns, stat.st_size)
+        # gzip stores the decompressed size (mod 4GiB) in its last 4 bytes
+        with open(filename, 'rb') as logfile:
+            logfile.seek(-4, os.SEEK_END)
+            return struct.unpack('<I', logfile.read(4))[0]
+    return os.path.getsize(filename)
+
+def compress_log(filename):
+    """Gzip a log, keeping its mtime, and remove the original.
+    Returns the name of the compressed log."""
+    gzname = filename + '.gz'
+    tmpname = gzname + '.tmp'
+    stat = os.stat(filename)
+    with open(filename, 'rb') as logfile:
+        with gzip.open(tmpname, 'wb') as gzfile:
+            shutil.copyfileobj(logfile, gzfile, BLOCK_BYTES)
+    os.utime(tmpname, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    os.replace(tmpname, gzname)
+    os.remove(filename)
+    return gzname
+
+def remove_log(filename):
+    """Remove a log and its events, and its dated directory if that is
+    now empty."""
+    os.remove(filename)
+    try:
+        os.remove(events_file(filename))
+    except OSError:
+        pass
+    try:
+        os.rmdir(os.path.dirname(filename))
+    except OSError:
+        pass
+
+def gz_tail_offset(filename, lines, limit=PAGE_BYTES, before=None):
+    """tail_offset for compressed logs, which can only be read forwards.
+    Decompresses up to before (or the end) once, remembering where the
+    last N lines started."""
+    size = log_size(filename)
+    end = size if before is None else min(max(0, before), size)
+    floor = max(0, end - limit)
+    starts = deque(maxlen=lines)
+    first_after_floor = None
+    position = 0
+    with open_log(filename) as logfile:
+        for line in logfile:
+            if position >= end:
+                break
+            starts.append(position)
+            if first_after_floor is None and position >= floor:
+                first_after_floor = position
+            position += len(line)
+    if starts and starts[0] >= floor:
+        return starts[0]
+    return end if first_after_floor is None else first_after_floor
+
+def tail_offset(filename, lines, limit=PAGE_BYTES, before=None):
+    """Return byte offset of the start of the last N lines of a file,
+    or of the N lines before offset before, reading backwards a block
+    at a time. Never goes back more than limit bytes."""
+    if compressed(filename):
+        return gz_tail_offset(filename, lines, limit, before)
+    with open(filename, 'rb') as logfile:
+        size = logfile.seek(0, os.SEEK_END)
+        if before is not None:
+            size = line_start(logfile, min(max(0, before), size))
+        if size == 0:
+            return 0
+        floor = max(0, size - limit)
+        position = size
+        # a trailing newline ends the last line rather than starting a new one
+        logfile.seek(size - 1)
+        newlines = -1 if logfile.read(1) == b'\n' else 0
+        while position > floor:
+            readsize = min(BLOCK_BYTES, position - floor)
+            position -= readsize
+            logfile.seek(position)
+            block = logfile.read(readsize)
+            index = block.rfind(b'\n')
+            while index >= 0:
+                newlines += 1
+                if newlines == lines:
+                    return position + index + 1
+                index = block.rfind(b'\n', 0, index)
+        return line_start(logfile, floor) if floor else 0
+
+def line_start(logfile, offset):
+    """Return offset of the first line starting at or after offset."""
+    if offset <= 0:
+        return 0
+    logfile.seek(offset - 1)
+    if logfile.read(1) == b'\n':
+        return offset
+    logfile.readline()
+    return logfile.tell()
+
+def read_page(filename, offset=None, before=None, lines=500,
+              limit=PAGE_BYTES):
+    """Read one page of a log file, whole lines only.
+    If offset is given the page starts at the first line at or after it.
+    Otherwise the page is the last N lines before offset before, or of
+    the file if before is None too.
+    Returns a dict with the decoded lines, the start and end offsets of the
+    page, the file size, the before offset of the older page and the
+    offset of the newer page (or None if there arent any)."""
+    size = log_size(filename)
+    with open_log(filename) as logfile:
+        if offset is None:
+            start = tail_offset(filename, lines, limit, before)
+            end = size if before is None else line_start(
+                logfile, min(max(0, before), size))
+        else:
+            start = line_start(logfile, min(max(0, offset), size))
+            end = min(size, start + limit)
+        logfile.seek(start)
+        data = logfile.read(end - start)
+        end = start + len(data)
+        if end < size and b'\n' in data:
+            data = data[:data.rindex(b'\n') + 1]
+            end = start + len(data)
+    return {"text": data.decode(errors='replace').splitlines(keepends=True),
+            "start": start,
+            "end": end,
+            "size": size,
+            "older": start if start > 0 else None,
+            "newer": end if end < size else None}
+
+def follow(filename, offset=0, interval=FOLLOW_INTERVAL, idle=FOLLOW_IDLE):
+    """Generator yielding (offset, data) for each batch of whole lines
+    appended to a file after offset, where offset is the end of data.
+    Only the file size is checked between batches. Yields (offset, b'')
+    after every quiet check so callers can send keepalives, and stops
+    after idle seconds without new output."""
+    size = log_size(filename)
+    with open_log(filename) as logfile:
+        offset = line_start(logfile, min(max(0, offset), size))
+        quiet = 0
+        while True:
+            data = b''
+            # compressed logs are finished, so never grow
+            if not compressed(filename):
+                size = os.fstat(logfile.fileno()).st_size
+            if size > offset:
+                logfile.seek(offset)
+                data = logfile.read(min(size - offset, PAGE_BYTES))
+                if b'\n' in data:
+                    data = data[:data.rindex(b'\n') + 1]
+                elif len(data) < PAGE_BYTES:
+                    # wait for the rest of a partly written line
+                    data = b''
+            if data:
+                offset += len(data)
+                quiet = 0
+                yield offset, data
+                continue
+            if quiet >= idle:
+                return
+            yield offset, b''
+            time.sleep(interval)
+            quiet += interval
@@ -13,7 +13,8 @@ class AnmadInfoHandler(logging.handlers.QueueHandler):
 def logsetup(args, name):
     """Set up anmad logging."""
     logger = logging.getLogger(name)
-    queues = anmadqueues.AnmadQueues('prerun', 'playbooks', 'info')
+    queues = anmadqueues.AnmadQueues(
+        'prerun', 'playbooks', 'info', **anmadqueues.redis_config(args))
 
     syslog_formatter = logging.Formatter(
         '%(name)s - [%(levelname)s] - %(message)s')
@@ -0,0 +1,172 @@
+"""Index of ansible-playbook log files in redis, keyed by playbook."""
+import calendar
+import json
+import os
+import re
+import time
+from socket import getfqdn
+
+from anmad.common.logfiles import LOG_BASE
+from anmad.common.queues import RedisClient
+
+# <playbook>.<date>.<time>.log as written by AnmadRun, times are UTC
+LOG_NAME = re.compile(
+    r'\.(\d{4}-\d{2}-\d{2})\.(\d{2}-\d{2}-\d{2})\.log(\.gz)?$')
+
+def started(logfile, default=None):
+    """Return the start time in the name of a log file, or default if
+    it doesnt have one."""
+    match = LOG_NAME.search(logfile)
+    if match is None:
+        return default
+    try:
+        return calendar.timegm(time.strptime(
+            match.group(1) + ' ' + match.group(2), '%Y-%m-%d %H-%M-%S'))
+    except ValueError:
+        return default
+
+class LogIndex(RedisClient):
+    """Sorted set per playbook of its log files (relative to log_base),
+    scored by start time, so the latest log and a playbooks history are
+    found without listing the log directories.
+    Logs are on the local disk of the host that ran the playbook, so
+    like ProcessRegistry there is one index per host, under
+    <prefix>:<host>, and each host only rebuilds and prunes its own.
+    Connects to redis on first use, so it can be passed to pool workers."""
+
+    def __init__(self, log_base=LOG_BASE, prefix='anmad:logs', host=None,
+                 **redis_kwargs):
+        """Init LogIndex."""
+        super().__init__(**redis_kwargs)
+        self.log_base = log_base
+        self.host = host or getfqdn()
+        self.prefix = prefix + ':' + self.host
+        self.playbooks_key = self.prefix + ':playbooks'
+
+    def run_key(self, logfile):
+        """Return the key of the event summary for the run that wrote
+        logfile."""
+        logfile = os.path.relpath(
+            os.path.join(self.log_base, logfile), self.log_base)
+        if logfile.endswith('.gz'):
+            logfile = logfile[:-3]
+        return self.prefix + ':run:' + logfile
+
+    def record_run(self, logfile, summary):
+        """Store the event summary of a run."""
+        self.redis.set(self.run_key(logfile),
+                       json.dumps(summary, separators=(',', ':')))
+
+    def run(self, logfile):
+        """Return the event summary of the run that wrote logfile, or
+        None if there isnt one."""
+        summary = self.redis.get(self.run_key(logfile))
+        return json.loads(summary) if summary is not None else None
+
+    def runs(self, logfiles):
+        """Return the event summaries of several runs in one round trip,
+        with None for runs without one."""
+        pipe = self.redis.pipeline()
+        for logfile in logfiles:
+            pipe.get(self.run_key(logfile))
+        return [json.loads(summary) if summary is not None else None
+                for summary in pipe.execute()]
+
+    def key(self, playbook):
+        """Return the key of a playbooks sorted set."""
+        return self.prefix + ':' + os.path.basename(playbook.strip('/'))
+
+    def record(self, playbook, logfile, when=None):
+        """Add a log file for playbook to the index."""
+        playbook = os.path.basename(playbook)
+        pipe = self.redis.pipeline()
+        pipe.zadd(self.key(playbook),
+                  {os.path.relpath(logfile, self.log_base):
+                   time.time() if when is None else when})
+        pipe.sadd(self.playbooks_key, playbook)
+        pipe.execute()
+
+    def latest(self, playbook):
+        """Return path of the newest log for playbook, relative to
+        log_base, or None if there isnt one."""
+        newest = self.redis.zrevrange(self.key(playbook), 0, 0)
+        return newest[0].decode() if newest else None
+
+    def history(self, playbook, start=0, count=50):
+        """Return list of (log path, start time) for playbook, newest
+        first."""
+        return [(logfile.decode(), when) for logfile, when in
+                self.redis.zrevrange(self.key(playbook), start,
+                                     start + count - 1, withscores=True)]
+
+    def entries(self, playbook):
+        """Return list of (log path, start time) for playbook, oldest
+        first."""
+        return [(logfile.decode(), when) for logfile, when in
+                self.redis.zrange(self.key(playbook), 0, -1,
+                                  withscores=True)]
+
+    def remove(self, playbook, logfile):
+        """Remove a log and its run summary from the index, logfile is
+        relative to log_base."""
+        pipe = self.redis.pipeline()
+        pipe.zrem(self.key(playbook), logfile)
+        pipe.delete(self.run_key(logfile))
+        pipe.execute()
+
+    def replace(self, playbook, logfile, newfile):
+        """Replace a log in the index with another, keeping its start
+        time, for example after compressing it."""
+        when = self.redis.zscore(self.key(playbook), logfile)
+        if when is None:
+            return
+        pipe = self.redis.pipeline()
+        pipe.zrem(self.key(playbook), logfile)
+        pipe.zadd(self.key(playbook), {newfile: when})
+        pipe.execute()
+
+    def playbooks(self):
+        """Return sorted list of playbooks with logs."""
+        return sorted(playbook.decode() for playbook in
+                      self.redis.smembers(self.playbooks_key))
+
+    def scan(self):
+        """Return {playbook: {log path: start time}} for every log on
+        disk, laid out as <log_base>/<playbook>/<date>/<log>.
+        The start time comes from the log name, or its mtime if the name
+        has none. ctime is no use, compressing a log resets it."""
+        output = {}
+        try:
+            playdirs = [entry for entry in os.scandir(self.log_base)
+                        if entry.is_dir()]
+        except OSError:
+            return output
+        for playdir in playdirs:
+            logs = {}
+            for datedir in os.scandir(playdir.path):
+                if not datedir.is_dir():
+                    continue
+                for entry in os.scandir(datedir.path):
+                    if (entry.name.endswith(('.log', '.log.gz'))
+                            and entry.is_file()):
+                        logs[os.path.relpath(entry.path, self.log_base)] = (
+                            started(entry.name, entry.stat().st_mtime))
+            if logs:
+                output[playdir.name] = logs
+        return output
+
+    def rebuild(self):
+        """Replace this hosts index with what is on its disk.
+        Returns number of logs indexed."""
+        found = self.scan()
+        pipe = self.redis.pipeline()
+        for playbook in self.playbooks():
+            if playbook not in found:
+                pipe.delete(self.key(playbook))
+        pipe.delete(self.playbooks_key)
+        for playbook, logs in found.items():
+            pipe.delete(self.key(playbook))
+            pipe.zadd(self.key(playbook), logs)
+            pipe.sadd(self.playbooks_key, playbook)
+        pipe.execute()
+        return sum(len(logs) for logs in found.values())
@@ -0,0 +1,179 @@
+"""Metrics recorded in redis by the daemon, and rendered in the
+prometheus text format by the interface."""
+import time
+from contextlib import contextmanager
+from socket import getfqdn
+
+import redis
+
+from anmad.common.queues import (
+    RedisClient, processing_key_for, status_key_for, worker_ids)
+
+PREFIX = 'anmad:metrics'
+# histogram bucket upper bounds, in seconds
+BUCKETS = [0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600]
+HISTOGRAMS = {
+    "job_wait_seconds":
+        "Time jobs waited in the playbooks queue before being claimed",
+    "job_run_seconds":
+        "Time from claiming a job to finishing its checks and playbooks",
+    "syncheck_seconds": "Duration of ansible-playbook syntax checks",
+    "playbook_run_seconds": "Duration of ansible-playbook runs",
+    "kill_seconds":
+        "Time taken to kill the process group of a timed out playbook",
+    }
+COUNTERS = {
+    "jobs_total": "Jobs processed from the playbooks queue",
+    "playbook_timeouts_total": "ansible-playbook runs that timed out",
+    "killed_processes_total":
+        "ansible-playbook processes killed by timeouts or on request",
+    "kill_escalations_total":
+        "Timed out ansible-playbook processes that needed SIGKILL",
+    }
+GAUGES = {
+    "pool_workers": "ansible-playbook processes a daemon may run at once",
+    }
+
+
+class AnmadMetrics(RedisClient):
+    """Histograms, counters and per host gauges kept in redis hashes.
+    Busy ansible-playbook processes are counted in the status hash of
+    the daemon worker they were attached to, so the count goes when the
+    workers lease expires.
+    Recording is best effort, redis errors are ignored so that metrics
+    never stop a playbook from running."""
+
+    def __init__(self, host=None, **redis_kwargs):
+        """Init AnmadMetrics."""
+        super().__init__(**redis_kwargs)
+        self.host = host or getfqdn()
+        self.status_key = None
+        self.lease_time = None
+
+    def attach(self, status_key, lease_time):
+        """Count busy processes in a workers status hash from now on."""
+        self.status_key = status_key
+        self.lease_time = lease_time
+
+    def observe(self, name, value):
+        """Add a value to a histogram."""
+        key = PREFIX + ':histogram:' + name
+        try:
+            pipe = self.redis.pipeline()
+            for bucket in BUCKETS:
+                if value <= bucket:
+                    pipe.hincrby(key, str(bucket), 1)
+            pipe.hincrby(key, '+Inf', 1)
+            pipe.hincrbyfloat(key, 'sum', value)
+            pipe.hincrby(key, 'count', 1)
+            pipe.execute()
+        except redis.RedisError:
+            pass
+
+    def inc(self, name, amount=1):
+        """Increment a counter."""
+        try:
+            self.redis.hincrby(PREFIX + ':counters', name, amount)
+        except redis.RedisError:
+            pass
+
+    def set_gauge(self, name, value):
+        """Set this hosts value of a gauge."""
+        try:
+            self.redis.hset(PREFIX + ':gauges', name + '|' + self.host, value)
+        except redis.RedisError:
+            pass
+
+    def count_busy(self, amount):
+        """Change the busy count in the attached workers status."""
+        if self.status_key is None:
+            return
+        try:
+            pipe = self.redis.pipeline()
+            pipe.hincrby(self.status_key, 'busy', amount)
+            pipe.expire(self.status_key, int(self.lease_time))
+            pipe.execute()
+        except redis.RedisError:
+            pass
+
+    @contextmanager
+    def busy(self, histogram):
+        """Count a running ansible-playbook process as busy, and record
+        how long it took in histogram."""
+        start = time.time()
+        self.count_busy(1)
+        try:
+            yield
+        finally:
+            self.count_busy(-1)
+            self.observe(histogram, time.time() - start)
+
+    def render(self, queues):
+        """Return all metrics, plus queue depths and redis round trip
+        time, in the prometheus text format."""
+        start = time.time()
+        self.redis.ping()
+        rtt = time.time() - start
+        workers = worker_ids(queues.queue)
+        pipe = self.redis.pipeline()
+        for name in HISTOGRAMS:
+            pipe.hgetall(PREFIX + ':histogram:' + name)
+        pipe.hgetall(PREFIX + ':counters')
+        pipe.hgetall(PREFIX + ':gauges')
+        for queue in [queues.prequeue] + list(queues.lanes.values()):
+            pipe.llen(queue.key)
+        for worker_id in workers:
+            pipe.llen(processing_key_for(queues.queue, worker_id))
+            pipe.hmget(status_key_for(queues.queue, worker_id),
+                       'host', 'busy')
+        results = pipe.execute()
+        lines = []
+
+        def metric(name, kind, helptext):
+            lines.append('# HELP anmad_' + name + ' ' + helptext)
+            lines.append('# TYPE anmad_' + name + ' ' + kind)
+
+        for name, helptext in HISTOGRAMS.items():
+            values = {key.decode(): value.decode()
+                      for key, value in results.pop(0).items()}
+            metric(name, 'histogram', helptext)
+            for bucket in [str(bucket) for bucket in BUCKETS] + ['+Inf']:
+                lines.append('anmad_%s_bucket{le="%s"} %s' % (
+                    name, bucket, values.get(bucket, '0')))
+            lines.append('anmad_%s_sum %s' % (name, values.get('sum', '0')))
+            lines.append('anmad_%s_count %s' % (
+                name, values.get('count', '0')))
+        counters = {key.decode(): value.decode()
+                    for key, value in results.pop(0).items()}
+        for name, helptext in COUNTERS.items():
+            metric(name, 'counter', helptext)
+            lines.append('anmad_%s %s' % (name, counters.get(name, '0')))
+        gauges = {}
+        for key, value in results.pop(0).items():
+            name, host = key.decode().split('|', 1)
+            gauges.setdefault(name, []).append((host, value.decode()))
+        for name, helptext in GAUGES.items():
+            metric(name, 'gauge', helptext)
+            for host, value in sorted(gauges.get(name, [])):
+                lines.append('anmad_%s{host="%s"} %s' % (name, host, value))
+        metric('queue_depth', 'gauge', 'Jobs waiting in each queue')
+        for queue in [queues.prequeue] + list(queues.lanes.values()):
+            lines.append('anmad_queue_depth{queue="%s"} %s' % (
+                queue.name, results.pop(0)))
+        processing = 0
+        metric('pool_busy', 'gauge',
+               'ansible-playbook processes a daemon worker is running')
+        for worker_id in workers:
+            processing += results.pop(0)
+            host, busy = results.pop(0)
+            if host is not None:
+                lines.append('anmad_pool_busy{host="%s",worker="%s"} %s' % (
+                    host.decode(), worker_id,
+                    busy.decode() if busy is not None else '0'))
+        metric('queue_processing', 'gauge',
+               'Jobs claimed from the playbooks queue and not yet finished')
+        lines.append('anmad_queue_processing %s' % processing)
+        metric('redis_rtt_seconds', 'gauge',
+               'Round trip time of a redis PING from the interface')
+        lines.append('anmad_redis_rtt_seconds %.6f' % rtt)
+        return '\n'.join(lines) + '\n'
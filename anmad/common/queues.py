@@ -1,53 +1,372 @@
 #!/usr/bin/env python3
 """Anmad queue module."""
-import pickle
 import redis
 from hotqueue import HotQueue
 
-def read_queue(queue):
+from anmad.common.jobs import (
+    DEFAULT_PRIORITY, PRIORITIES, JobSerializer, is_invalid, is_job,
+    job_signature, make_job)
+
+# One connection pool per redis server, shared by every queue in the process.
+POOLS = {}
+# messages kept on each queues dead letter list
+DEAD_LETTERS = 100
+
+# Scripts that keep a queues pending jobs in step with its list.
+# A pending job only counts if its message is still in the list, so an
+# entry left behind by a job taken off some other way is replaced.
+# KEYS: queue list, pending hash, change counter
+# ARGV: signature, message pairs
+# Returns the waiting message for each coalesced job, or '' if it was put
+PUT_UNIQUE_SCRIPT = """
+local output = {}
+local added = 0
+for num = 1, #ARGV, 2 do
+    local waiting = redis.call('HGET', KEYS[2], ARGV[num])
+    if waiting and redis.call('LPOS', KEYS[1], waiting) then
+        table.insert(output, waiting)
+    else
+        redis.call('HSET', KEYS[2], ARGV[num], ARGV[num + 1])
+        redis.call('RPUSH', KEYS[1], ARGV[num + 1])
+        table.insert(output, '')
+        added = added + 1
+    end
+end
+if added > 0 then
+    redis.call('INCR', KEYS[3])
+end
+return output
+"""
+# KEYS: queue list, pending hash
+# ARGV: signature, message already in the list
+REMEMBER_SCRIPT = """
+local waiting = redis.call('HGET', KEYS[2], ARGV[1])
+if waiting and redis.call('LPOS', KEYS[1], waiting) then
+    return 0
+end
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+return 1
+"""
+# KEYS: pending hash
+# ARGV: signature, message taken off the list
+FORGET_SCRIPT = """
+if redis.call('HGET', KEYS[1], ARGV[1]) == ARGV[2] then
+    return redis.call('HDEL', KEYS[1], ARGV[1])
+end
+return 0
+"""
+
+def redis_pool(host='localhost', port=6379, db=0, unix_socket_path=None):
+    """Return the process-wide connection pool for a redis server,
+    creating it on first use."""
+    poolkey = (host, port, db, unix_socket_path)
+    if poolkey not in POOLS:
+        if unix_socket_path:
+            POOLS[poolkey] = redis.ConnectionPool(
+                connection_class=redis.UnixDomainSocketConnection,
+                path=unix_socket_path,
+                db=db)
+        else:
+            POOLS[poolkey] = redis.ConnectionPool(
+                host=host, port=port, db=db)
+    return POOLS[poolkey]
+
+def redis_config(args):
+    """Return redis connection kwargs from parsed anmad args."""
+    return {"host": args.redis_host,
+            "port": args.redis_port,
+            "db": args.redis_db,
+            "unix_socket_path": args.redis_socket}
+
+def workers_key_for(queue):
+    """Return the key name of the set of workers consuming a queue."""
+    return queue.key + ':workers'
+
+def worker_ids(queue):
+    """Return the sorted ids of workers consuming a queue."""
+    return sorted(worker_id.decode() for worker_id in
+                  queue.redis.smembers(workers_key_for(queue)))
+
+def lease_key_for(queue, worker_id):
+    """Return the lease key name for a worker on a queue."""
+    return queue.key + ':lease:' + worker_id
+
+def processing_key_for(queue, worker_id):
+    """Return the key name of a workers list of claimed jobs."""
+    return queue.key + ':processing:' + worker_id
+
+def requeue_key_for(queue, worker_id):
+    """Return the key name of the list a worker moves jobs through
+    while requeueing them."""
+    return queue.key + ':requeue:' + worker_id
+
+def status_key_for(queue, worker_id):
+    """Return the status key name for a worker on a queue. Its busy
+    field counts the ansible-playbook processes the worker is running."""
+    return queue.key + ':status:' + worker_id
+
+class RedisClient:
+    """Base for objects that connect to redis on first use, and drop
+    the connection when pickled, so they can be sent to pool workers."""
+
+    def __init__(self, **redis_kwargs):
+        self.redis_kwargs = redis_kwargs
+        self.conn = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['conn'] = None
+        return state
+
+    @property
+    def redis(self):
+        """Return a redis connection."""
+        if self.conn is None:
+            self.conn = redis.Redis(
+                connection_pool=redis_pool(**self.redis_kwargs))
+        return self.conn
+
+def decode_jobs(queue, msgs):
+    """Decode messages read from queue, skipping any that cant be
+    decoded."""
+    return [job for job in map(queue.serializer.loads, msgs)
+            if not is_invalid(job)]
+
+def read_queue(queue, redis_conn=None):
     """Reads jobs from queue, returns list of jobs."""
-    redis_conn = redis.Redis()
-    output = []
-    for msg in redis_conn.lrange(queue.key, 0, -1):
-        output.append(pickle.loads(msg))
-    return output
+    if redis_conn is None:
+        redis_conn = redis.Redis(connection_pool=redis_pool())
+    return decode_jobs(queue, redis_conn.lrange(queue.key, 0, -1))
 
-def trim_queue(queue, length):
+def trim_queue(queue, length, redis_conn=None):
     """Trims a redis queue to last N items."""
-    redis_conn = redis.Redis()
+    if redis_conn is None:
+        redis_conn = redis.Redis(connection_pool=redis_pool())
     redis_conn.ltrim(queue.key, -length, -1)
 
 
+class VersionedQueue(HotQueue):
+    """HotQueue that bumps a change counter in redis whenever a put,
+    get or clear changes its contents. Anything else writing to the
+    queue list directly should INCR version_key too.
+    Jobs put with put_unique are also kept in a hash of pending jobs by
+    job_signature until they are taken off the queue, so an identical
+    job that is already waiting is found with one lookup instead of
+    reading the whole queue. Checking for, and putting or removing,
+    pending jobs are done in lua scripts, so each is atomic.
+    Messages that cant be decoded are moved to a dead letter list by
+    get, or by whatever else takes them off the queue, so that one bad
+    message cant stop the queue being read."""
+    def __init__(self, name, serializer=None, **kwargs):
+        if serializer is None:
+            serializer = JobSerializer()
+        super().__init__(name, serializer=serializer, **kwargs)
+        self.redis = redis.Redis(**kwargs)
+        self.put_unique_script = self.redis.register_script(
+            PUT_UNIQUE_SCRIPT)
+        self.remember_script = self.redis.register_script(REMEMBER_SCRIPT)
+        self.forget_script = self.redis.register_script(FORGET_SCRIPT)
+
+    @property
+    def version_key(self):
+        """Return the key name used to store this queues change counter."""
+        return self.key + ':version'
+
+    @property
+    def dead_key(self):
+        """Return the key name of this queues dead letter list."""
+        return self.key + ':dead'
+
+    @property
+    def pending_key(self):
+        """Return the key name of this queues hash of pending jobs."""
+        return self.key + ':pending'
+
+    def bump(self):
+        """Increment the change counter."""
+        self.redis.incr(self.version_key)
+
+    def remember(self, job, msg):
+        """Add a job already on the queue as the message msg to the
+        pending jobs, unless an identical job is waiting. Returns True
+        if it was added."""
+        if not is_job(job):
+            return False
+        return bool(self.remember_script(
+            keys=[self.key, self.pending_key],
+            args=[job_signature(job), msg]))
+
+    def bury(self, msg, source=None):
+        """Move a message that couldnt be decoded to the dead letter
+        list, from the list source if it is given."""
+        pipe = self.redis.pipeline()
+        if source is not None:
+            pipe.lrem(source, 1, msg)
+        pipe.rpush(self.dead_key, msg)
+        pipe.ltrim(self.dead_key, -DEAD_LETTERS, -1)
+        pipe.execute()
+
+    def forget(self, job, msg):
+        """Remove a job taken off the queue as the message msg from the
+        pending jobs, unless an identical job has been put since."""
+        if is_job(job):
+            self.forget_script(keys=[self.pending_key],
+                               args=[job_signature(job), msg])
+
+    def put_unique(self, *jobs):
+        """Put jobs onto the queue, unless an identical job is already
+        waiting on it. Returns the list of jobs, with the waiting job in
+        place of each duplicate, marked "coalesced"."""
+        args = []
+        for job in jobs:
+            args.extend([job_signature(job), self.serializer.dumps(job)])
+        waiting = self.put_unique_script(
+            keys=[self.key, self.pending_key, self.version_key], args=args)
+        output = []
+        for job, msg in zip(jobs, waiting):
+            if msg:
+                job = self.serializer.loads(msg)
+                job["coalesced"] = True
+            output.append(job)
+        return output
+
+    def put(self, *msgs):
+        """Put messages onto the queue and bump the change counter."""
+        super().put(*msgs)
+        self.bump()
+
+    def get(self, block=False, timeout=None):
+        """Get a message from the queue, bumping the change counter if
+        one was removed. Messages that cant be decoded are moved to the
+        dead letter list, and returned as invalid markers."""
+        if block:
+            msg = self.redis.blpop(self.key, timeout=timeout or 0)
+            if msg is not None:
+                msg = msg[1]
+        else:
+            msg = self.redis.lpop(self.key)
+        if msg is None:
+            return None
+        job = self.serializer.loads(msg)
+        if is_invalid(job):
+            self.bury(msg)
+        else:
+            self.forget(job, msg)
+        self.bump()
+        return job
+
+    def clear(self):
+        """Clear the queue and pending jobs, and bump the change counter."""
+        super().clear()
+        self.redis.delete(self.pending_key)
+        self.bump()
+
+
 class AnmadQueues:
-    """Queues used by anmad."""
-    def __init__(self, prequeue, queue, info):
-        self.prequeue = HotQueue(prequeue)
-        self.queue = HotQueue(queue)
-        self.info = HotQueue(info)
+    """Queues used by anmad.
+    Run jobs go into one lane per priority, highest first in lanes.
+    The queue named queue is the normal priority lane."""
+    def __init__(self, prequeue, queue, info, **redis_kwargs):
+        self.pool = redis_pool(**redis_kwargs)
+        self.redis = redis.Redis(connection_pool=self.pool)
+        self.prequeue = VersionedQueue(
+            prequeue, serializer=JobSerializer('prerun'),
+            connection_pool=self.pool)
+        self.queue = VersionedQueue(
+            queue, serializer=JobSerializer('run'),
+            connection_pool=self.pool)
+        self.lanes = {}
+        for priority in PRIORITIES:
+            self.lanes[priority] = (
+                self.queue if priority == DEFAULT_PRIORITY else
+                VersionedQueue(queue + '-' + priority,
+                               serializer=JobSerializer('run'),
+                               connection_pool=self.pool))
+        self.info = VersionedQueue(
+            info, serializer=JobSerializer(),
+            connection_pool=self.pool)
+        # decoded snapshot of each queue, and the change counter it was
+        # read at, keyed by queue name
+        self.snapshots = {}
+        self.versions = {}
         self.update_job_lists()
 
+    def all_queues(self):
+        """Return the prerun queue, every lane and the info queue."""
+        return [self.prequeue] + list(self.lanes.values()) + [self.info]
+
+    def stale_queues(self):
+        """Return the queues whose change counter has moved since they
+        were last read."""
+        myqueues = self.all_queues()
+        versions = self.redis.mget([q.version_key for q in myqueues])
+        return [myqueue for myqueue, version in zip(myqueues, versions)
+                if myqueue.name not in self.versions
+                or self.versions[myqueue.name] != version]
+
     def update_job_lists(self):
-        """Reset queue_message vars."""
-        self.prequeue_list = []
-        self.prequeue_list = read_queue(self.prequeue)
-        self.queue_list = []
-        self.queue_list = read_queue(self.queue)
-        self.info_list = []
-        trim_queue(self.info, 100)
-        self.info_list = read_queue(self.info)
-        self.info_list.reverse()
-
-    def prequeue_job(self, job):
-        """Adds an item to the pre-run queue."""
-        self.prequeue.put([job])
-
-    def queue_job(self, job):
-        """Adds an item to the run queue."""
-        self.queue.put(job)
+        """Reset queue_message vars.
+        Queues are only re-read and decoded if their change counter has
+        moved. Stale queues are read (and info trimmed) in one
+        pipelined round trip.
+        queue_list has the jobs of every lane, in the order they would
+        be run if none were starved."""
+        stale = self.stale_queues()
+        if stale:
+            pipe = self.redis.pipeline()
+            for myqueue in stale:
+                if myqueue is self.info:
+                    pipe.ltrim(myqueue.key, -100, -1)
+                pipe.get(myqueue.version_key)
+                pipe.lrange(myqueue.key, 0, -1)
+            results = iter(pipe.execute())
+            for myqueue in stale:
+                if myqueue is self.info:
+                    next(results)
+                self.versions[myqueue.name] = next(results)
+                self.snapshots[myqueue.name] = decode_jobs(
+                    myqueue, next(results))
+
+        self.prequeue_list = self.snapshots[self.prequeue.name]
+        if any(lane in stale for lane in self.lanes.values()):
+            self.lane_lists = {priority: self.snapshots[lane.name]
+                               for priority, lane in self.lanes.items()}
+            self.queue_list = [job for priority in PRIORITIES
+                               for job in self.lane_lists[priority]]
+        self.info_list = list(reversed(self.snapshots[self.info.name]))
+
+    def prequeue_job(self, job, requester=None):
+        """Adds a playbook to the pre-run queue, unless it is already
+        waiting there. Returns the job, or the waiting one."""
+        myjob = make_job([job], jobtype='prerun', requester=requester)
+        return self.prequeue.put_unique(myjob)[0]
+
+    def queue_job(self, job, jobtype='run', requester=None,
+                  priority=DEFAULT_PRIORITY):
+        """Adds a list of playbooks to the run queue lane for priority,
+        unless the same playbooks are already waiting there. Returns the
+        job, or the waiting one."""
+        myjob = make_job(job, jobtype=jobtype, requester=requester,
+                         priority=priority)
+        return self.lanes[priority].put_unique(myjob)[0]
+
+    def queue_jobs(self, jobs, jobtype='run', requester=None,
+                   priority=DEFAULT_PRIORITY):
+        """Adds several lists of playbooks to the run queue lane for
+        priority, each as its own job, in a few round trips. Lists
+        already waiting there are not added again. Returns the jobs, or
+        the waiting ones."""
+        myjobs = [make_job(job, jobtype=jobtype, requester=requester,
+                           priority=priority)
+                  for job in jobs]
+        if myjobs:
+            return self.lanes[priority].put_unique(*myjobs)
+        return myjobs
 
     def clear(self):
         """Clears all job queues."""
-        self.queue.clear()
+        for lane in self.lanes.values():
+            lane.clear()
         self.prequeue.clear()
 
     def clearinfo(self):
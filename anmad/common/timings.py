@@ -0,0 +1,104 @@
+"""Task, role and run durations collected across runs, kept in redis."""
+import json
+
+PREFIX = 'anmad:timings'
+# most recent samples kept per task / role / playbook
+SAMPLES = 200
+
+def sample_key(playbook, item):
+    """Return the key of the sample list for one item of a playbook,
+    where item is the json of ["run"], ["role", role] or
+    ["task", role, task]."""
+    return PREFIX + ':' + playbook + ':' + item
+
+def items_key(playbook):
+    """Return the key of the set of items recorded for a playbook."""
+    return PREFIX + ':items:' + playbook
+
+def record(redis_conn, playbook, summary):
+    """Add the durations from a run summary (see anmad.common.events)
+    to the samples for playbook."""
+    samples = {}
+    for task in summary["tasks"]:
+        when = task["start"]
+        samples.setdefault(
+            json.dumps(["task", task["role"], task["task"]]), []).append(
+                (when, task["duration"]))
+        if task["role"]:
+            role = samples.setdefault(json.dumps(["role", task["role"]]), [])
+            if role:
+                role[0] = (role[0][0], role[0][1] + task["duration"])
+            else:
+                role.append((when, task["duration"]))
+    if summary["start"] is not None:
+        samples[json.dumps(["run"])] = [
+            (summary["start"], summary["end"] - summary["start"])]
+    pipe = redis_conn.pipeline()
+    pipe.sadd(PREFIX + ':playbooks', playbook)
+    for item, durations in samples.items():
+        key = sample_key(playbook, item)
+        pipe.sadd(items_key(playbook), item)
+        pipe.lpush(key, *['%.3f:%.3f' % sample for sample in durations])
+        pipe.ltrim(key, 0, SAMPLES - 1)
+    pipe.execute()
+
+def percentile(durations, percent):
+    """Return the nearest rank percentile of a sorted list."""
+    if not durations:
+        return None
+    rank = max(0, int(round(percent / 100.0 * len(durations))) - 1)
+    return durations[min(rank, len(durations) - 1)]
+
+def stats(samples):
+    """Return count, p50, p95, max and mean of a list of
+    (start, duration) samples, newest first, with the trend: p50 of the
+    newer half of the samples divided by p50 of the older half."""
+    durations = sorted(duration for _, duration in samples)
+    output = {"count": len(samples),
+              "p50": percentile(durations, 50),
+              "p95": percentile(durations, 95),
+              "max": durations[-1] if durations else None,
+              "mean": (round(sum(durations) / len(durations), 3)
+                       if durations else None),
+              "last": samples[0][0] if samples else None,
+              "trend": None}
+    if len(samples) >= 4:
+        half = len(samples) // 2
+        newer = percentile(sorted(d for _, d in samples[:half]), 50)
+        older = percentile(sorted(d for _, d in samples[half:]), 50)
+        if older:
+            output["trend"] = round(newer / older, 2)
+    return output
+
+def report(redis_conn, playbook=None, count=20):
+    """Return the count slowest tasks and roles by p95, and run
+    durations, for one playbook or all of them."""
+    if playbook is None:
+        playbooks = sorted(p.decode() for p in
+                           redis_conn.smembers(PREFIX + ':playbooks'))
+    else:
+        playbooks = [playbook]
+    items = []
+    for play in playbooks:
+        items.extend((play, item.decode()) for item in
+                     redis_conn.smembers(items_key(play)))
+    pipe = redis_conn.pipeline()
+    for play, item in items:
+        pipe.lrange(sample_key(play, item), 0, -1)
+    output = {"tasks": [], "roles": [], "runs": []}
+    for (play, item), raw in zip(items, pipe.execute()):
+        samples = [tuple(float(part) for part in sample.decode().split(':'))
+                   for sample in raw]
+        item = json.loads(item)
+        entry = {"playbook": play}
+        if item[0] == 'task':
+            entry.update({"role": item[1], "task": item[2]})
+        elif item[0] == 'role':
+            entry["role"] = item[1]
+        entry.update(stats(samples))
+        output[item[0] + 's'].append(entry)
+    for kind in ['tasks', 'roles', 'runs']:
+        output[kind].sort(key=lambda entry: entry["p95"] or 0, reverse=True)
+    output["tasks"] = output["tasks"][:count]
+    output["roles"] = output["roles"][:count]
+    return output
@@ -1,15 +1,24 @@
 """Functions to verify yaml files."""
-from os.path import abspath, exists
+from os import cpu_count
+from os.path import abspath, exists, isdir
 from glob import glob
+from multiprocessing import Pool
 import configparser
 import yaml
 
-def find_yaml_files(logger, directory):
+# use libyaml when pyyaml was built with it
+SafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# below this many files, checking in one process is faster than forking
+PARALLEL_THRESHOLD = 64
+
+def find_yaml_files(logger, directory, recursive=False):
     """Returns a list of files with yaml or yml extensions in a directory.
-    Does not recurse into subdirectories."""
+    Does not recurse into subdirectories unless recursive is set."""
     logger.debug("Searching in %s for yaml files", str(directory))
-    yamlfiles = glob(directory + '/*.yaml')
-    ymlfiles = glob(directory + '/*.yml')
+    pattern = '/**/*' if recursive else '/*'
+    yamlfiles = glob(directory + pattern + '.yaml', recursive=recursive)
+    ymlfiles = glob(directory + pattern + '.yml', recursive=recursive)
     output = yamlfiles + ymlfiles
     output.sort()
     return output
@@ -20,7 +29,7 @@ def verify_yaml_file(logger, filename):
     filename = abspath(filename)
     try:
         with open(filename, 'r') as my_filename:
-            yaml.safe_load(my_filename)
+            yaml.load(my_filename, Loader=SafeLoader)
     except FileNotFoundError:
         logger.error("%s not found", filename)
         return False
@@ -44,15 +53,72 @@ def verify_config_file(filename):
         return False
     return True
 
+def yaml_error(filename):
+    """Load every document in a yaml file with the safe loader, so that
+    bad tags and values are caught as well as bad syntax.
+    Return None if it loads, or a dict describing the first error."""
+    try:
+        with open(filename, 'rb') as my_filename:
+            for _ in yaml.load_all(my_filename, Loader=SafeLoader):
+                pass
+    except OSError as error:
+        return {"file": filename, "line": None, "column": None,
+                "error": error.strerror}
+    except yaml.MarkedYAMLError as error:
+        mark = error.problem_mark or error.context_mark
+        return {"file": filename,
+                "line": mark.line + 1 if mark else None,
+                "column": mark.column + 1 if mark else None,
+                "error": str(error.problem or error.context)}
+    except (yaml.YAMLError, ValueError) as error:
+        return {"file": filename, "line": None, "column": None,
+                "error": str(error)}
+    return None
+
+def yaml_errors(logger, filelist, processes=None, recursive=False):
+    """Check yaml files, and yaml files in any directories in filelist,
+    for bad syntax. Large lists are spread across worker processes,
+    unless processes is 1, which always checks in this process.
+    Return a list of dicts with file, line, column and error for each bad
+    file, or empty list if OK."""
+    checkfiles = []
+    for filename in filelist:
+        if isdir(filename):
+            checkfiles.extend(find_yaml_files(logger, filename, recursive))
+        else:
+            checkfiles.append(filename)
+
+    if processes == 1 or len(checkfiles) < PARALLEL_THRESHOLD:
+        results = map(yaml_error, checkfiles)
+    else:
+        processes = processes or cpu_count()
+        with Pool(processes) as pool:
+            results = pool.map(
+                yaml_error, checkfiles,
+                chunksize=max(1, len(checkfiles) // (processes * 4)))
+
+    errors = [result for result in results if result is not None]
+    for error in errors:
+        logger.error("%s line %s column %s: %s", error["file"],
+                     error["line"], error["column"], error["error"])
+    return errors
+
 def list_bad_yamlfiles(logger, filelist):
-    """ Check a list of yaml files for bad syntax.
+    """ Check a list of yaml files (or directories of them) for bad syntax.
     Return list of files that look wrong, or empty list if OK."""
-    badfiles = []
+    expanded = {}
     for filename in filelist:
-        yamldata = verify_yaml_file(logger, filename)
-        if not yamldata:
-            badfiles.append(filename)
-    return badfiles
+        if isdir(filename):
+            expanded[filename] = find_yaml_files(logger, filename)
+            if not expanded[filename]:
+                logger.error("No yaml files found in %s", str(filename))
+        else:
+            expanded[filename] = [filename]
+    allfiles = sorted({yml for ymls in expanded.values() for yml in ymls})
+    errorfiles = {error["file"] for error in yaml_errors(logger, allfiles)}
+    return [filename for filename in filelist
+            if not expanded[filename]
+            or errorfiles.intersection(expanded[filename])]
 
 def list_missing_files(logger, filelist):
     """Check a list of files to see if they exist. log if not.
@@ -2,23 +2,48 @@
 """Daemon to watch redis queues for ansible jobs."""
 import os
 import sys
+import threading
+import time
 
 from anmad.daemon.multi import AnmadMulti
+from anmad.daemon.process import ProcessRegistry
+from anmad.daemon.worker import AnmadWorker
+from anmad.daemon.syncache import SyntaxCheckCache
+from anmad.daemon.watcher import AnmadWatcher
+from anmad.daemon.retention import LogRetention
+from anmad.common.yaml import yaml_errors
+from anmad.common.lifecycle import JobRecords
+from anmad.common.logindex import LogIndex
+from anmad.common.metrics import AnmadMetrics
 from anmad.common.logging import logsetup
 from anmad.common.args import parse_anmad_args
 from anmad.daemon.ssh import add_ssh_key_to_agent
-from anmad.common.queues import AnmadQueues
+from anmad.common.queues import AnmadQueues, redis_config
+from anmad.common.jobs import is_job
 import anmad.common.version as anmadver
 
-QUEUES = AnmadQueues('prerun', 'playbooks', 'info')
 ARGS = parse_anmad_args()
+QUEUES = AnmadQueues('prerun', 'playbooks', 'info', **redis_config(ARGS))
 LOGGER = logsetup(ARGS, 'ANMAD Daemon')
+LOGINDEX = LogIndex(**redis_config(ARGS))
+METRICS = AnmadMetrics(**redis_config(ARGS))
+JOBRECORDS = JobRecords(ARGS.job_history_days * 86400, **redis_config(ARGS))
 MULTIOBJ = AnmadMulti(
     LOGGER,
     ARGS.inventories,
     ARGS.ansible_playbook_cmd,
     ARGS.vault_password_file,
-    ARGS.timeout)
+    ARGS.timeout,
+    ARGS.concurrency,
+    ARGS.engine,
+    SyntaxCheckCache(LOGGER, QUEUES.redis, ARGS.syncheck_cache_ttl)
+    if ARGS.syncheck_cache_ttl > 0 else None,
+    LOGINDEX,
+    METRICS,
+    ProcessRegistry(**redis_config(ARGS)),
+    ARGS.kill_grace)
+# start the pool before the worker heartbeat thread, so it forks cleanly
+MULTIOBJ.start()
 
 LOGGER.info("anmad_run version: %s starting", str(anmadver.VERSION))
 LOGGER.debug("config file: %s",
@@ -42,34 +67,127 @@ LOGGER.debug("playbook_root_dir: %s", str(ARGS.playbook_root_dir))
 
 add_ssh_key_to_agent(LOGGER, ARGS.ssh_id, ARGS.ssh_askpass)
 
-for playbookjob in QUEUES.queue.consume():
+LOGGER.info("Indexed %s ansible logs", LOGINDEX.rebuild())
+RETENTION = LogRetention(
+    LOGGER,
+    LOGINDEX,
+    ARGS.log_retention_days,
+    ARGS.log_retention_count,
+    ARGS.log_retention_mb,
+    ARGS.log_compress_after,
+    # never touch logs a playbook could still be writing to
+    max(3600, float(ARGS.timeout)))
+RETENTION.start()
+
+def process_prerun_queue():
+    """Run every job in the pre-run queue, one at a time.
+    Each job is claimed under PREWORKERs lease, so if this daemon dies
+    while running it, another daemon puts it back in the queue."""
+    PREWORKER.requeue_expired()
+    while True:
+        # claim first item in preQ and check if its a prerun job,
+        # if so run it. Messages that couldnt be decoded are moved to
+        # the dead letters by claim.
+        preQ_job = PREWORKER.claim(timeout=0)
+        if preQ_job is None:
+            LOGGER.info(
+                "processed all items in pre-run queue")
+            break #stop processing pre-Q if its empty
+        if is_job(preQ_job, 'prerun'):
+            LOGGER.info(
+                " Found a pre-run queue item: %s",
+                str(preQ_job["playbooks"]))
+            # statements to process pre-Q job
+            MULTIOBJ.runplaybooks(preQ_job["playbooks"])
+
+        # if it wasnt a prerun job, something is wrong
+        else:
+            LOGGER.warning(
+                "Ignoring item in pre-run queue thats not a prerun job: %s",
+                str(preQ_job))
+        PREWORKER.release()
+
+def progress(state, job=None):
+    """Record what the worker is doing, and whether it is idle."""
+    WORKER.progress(state, job)
+    if state == 'idle':
+        IDLE.set()
+    else:
+        IDLE.clear()
+
+def precheck_changes(changed):
+    """Syntax check playbooks in the background after files change, so
+    passing checks are already cached when a job arrives.
+    Checks wait until no job is running, so they dont compete with
+    playbook runs for the pool."""
+    if not IDLE.is_set():
+        LOGGER.info("Detected %s changed files, waiting for the running "
+                    "job before pre-running syntax checks", len(changed))
+        IDLE.wait()
+    LOGGER.info("Detected %s changed files, pre-running syntax checks",
+                len(changed))
+    # check in this thread, forking a pool here could copy redis and
+    # logging locks held by the heartbeat and retention threads
+    yaml_errors(LOGGER, [changed_file for changed_file in changed
+                         if changed_file.endswith(('.yml', '.yaml'))
+                         and os.path.isfile(changed_file)], processes=1)
+    precheck_problems = MULTIOBJ.checkmatrix(
+        (ARGS.prerun_list or []) + ARGS.run_list)
+    if ARGS.syntax_check_dir is not None:
+        precheck_problems += MULTIOBJ.syncheck_dir(ARGS.syntax_check_dir)
+    LOGGER.info("Background syntax checks found %s problems",
+                precheck_problems)
+
+IDLE = threading.Event()
+IDLE.set()
+if ARGS.watch and MULTIOBJ.cache is None:
+    LOGGER.warning("Not watching for changes, --watch needs the syntax "
+                   "check cache and --syncheck_cache_ttl is 0")
+elif ARGS.watch:
+    WATCHER = AnmadWatcher(
+        LOGGER,
+        [ARGS.playbook_root_dir, ARGS.syntax_check_dir],
+        precheck_changes,
+        ARGS.watch_debounce)
+    WATCHER.start()
+
+WORKER = AnmadWorker(LOGGER, QUEUES.queue, ARGS.lease_time, anmadver.VERSION,
+                     QUEUES.lanes, ARGS.starve_after)
+WORKER.start()
+PREWORKER = AnmadWorker(LOGGER, QUEUES.prequeue, ARGS.lease_time,
+                        anmadver.VERSION)
+PREWORKER.start()
+METRICS.attach(WORKER.status_key, ARGS.lease_time)
+
+for playbookjob in WORKER.consume():
     LOGGER.info("Starting to consume playbooks queue...")
     if playbookjob is not None:
         LOGGER.info("Found playbook queue job: %s", str(playbookjob))
+        claimed = time.time()
 
         # when an item is found in the PLAYQ, first process all jobs in preQ!
+        # Only one worker may do this at a time, so that other workers
+        # wait for the prerun batch to finish before checking their jobs.
         LOGGER.info("Starting to consume prerun queue...")
-        while True:
-            # get first item in preQ and check if its a list of 1 item,
-            # if so run it
-            preQ_job = QUEUES.prequeue.get()
-            if isinstance(preQ_job, list) and len(preQ_job) == 1:
-                LOGGER.info(
-                    " Found a pre-run queue item: %s", str(preQ_job))
-                # statements to process pre-Q job
-                MULTIOBJ.runplaybooks(preQ_job)
-
-            # if it wasnt a list, but something is there, something is wrong
-            elif preQ_job is not None:
-                LOGGER.warning(
-                    "item found in pre-run queue but its not a single item list")
-                break
-            else:
-                LOGGER.info(
-                    "processed all items in pre-run queue")
-                break #stop processing pre-Q if its empty
-
-        if playbookjob[0] == 'restart_anmad_run':
+        progress(
+            'prerun', playbookjob if is_job(playbookjob) else None)
+        with WORKER.lock('prerun'):
+            process_prerun_queue()
+
+        if not is_job(playbookjob):
+            LOGGER.warning(
+                "Ignoring malformed playbooks queue item: %s",
+                str(playbookjob))
+            progress('idle')
+            continue
+        METRICS.inc('jobs_total')
+        JOBRECORDS.start(playbookjob, WORKER.worker_id, claimed)
+        JOBRECORDS.mark(playbookjob["id"], 'prerun_done')
+        if playbookjob.get("submitted"):
+            METRICS.observe('job_wait_seconds',
+                            claimed - playbookjob["submitted"])
+
+        if playbookjob["type"] == 'restart':
             LOGGER.info(
                 'Restarting %s %s %s %s',
                 str(sys.executable),
@@ -77,27 +195,56 @@ for playbookjob in QUEUES.queue.consume():
                 str(__file__),
                 " ".join(sys.argv[1:])
                 )
+            JOBRECORDS.mark(playbookjob["id"], 'finished', 'restarted')
+            WORKER.release()
+            WORKER.stop()
+            PREWORKER.stop()
+            RETENTION.stop()
+            MULTIOBJ.close()
             os.execl(sys.executable, sys.executable, __file__, *sys.argv[1:])
 
-        LOGGER.info('Running job from playqueue: %s', str(playbookjob))
+        LOGGER.info('Running job %s from playqueue: %s',
+                    str(playbookjob["id"]), str(playbookjob["playbooks"]))
         #Syntax check playbooks, or all playbooks in syntax_check_dir
-        if ARGS.syntax_check_dir is None or len(playbookjob) == 1:
-            problemcount = MULTIOBJ.checkplaybooks(playbookjob)
+        progress('syntax checking', playbookjob)
+        JOBRECORDS.mark(playbookjob["id"], 'syncheck_start', 'syntax checking')
+        if (ARGS.syntax_check_dir is None
+                or len(playbookjob["playbooks"]) == 1):
+            problemcount = MULTIOBJ.checkmatrix(playbookjob["playbooks"])
         else:
             problemcount = MULTIOBJ.syncheck_dir(
                 ARGS.syntax_check_dir)
 
+        JOBRECORDS.mark(playbookjob["id"], 'syncheck_end',
+                        syncheck_problems=problemcount)
+
         if problemcount != 0:
             LOGGER.warning(
                 "Refusing to queue requested playbooks until "
                 "syntax checks pass")
+            JOBRECORDS.mark(playbookjob["id"], 'finished',
+                            'failed syntax check')
+            METRICS.observe('job_run_seconds', time.time() - claimed)
+            progress('idle')
             continue
 
         # if we get to here syntax checks passed. Run the job
         LOGGER.info(
-            "Running playbooks %s", str(playbookjob))
-        MULTIOBJ.runplaybooks(playbookjob)
+            "Running playbooks %s", str(playbookjob["playbooks"]))
+        progress('running', playbookjob)
+        JOBRECORDS.mark(playbookjob["id"], 'run_start', 'running')
+        returncodes = MULTIOBJ.returncodes(playbookjob["playbooks"])
+        JOBRECORDS.mark(playbookjob["id"], 'run_end',
+                        returncodes=dict(zip(playbookjob["playbooks"],
+                                             returncodes)))
+        JOBRECORDS.mark(playbookjob["id"], 'finished',
+                        'succeeded' if not any(returncodes) else 'failed')
+        METRICS.observe('job_run_seconds', time.time() - claimed)
+        progress('idle')
         LOGGER.info(
             "Continuing to process items in playbooks queue...")
 
+WORKER.stop()
+PREWORKER.stop()
+MULTIOBJ.close()
 LOGGER.warning("Stopped processing playbooks queue!")
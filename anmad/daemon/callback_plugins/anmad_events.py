@@ -0,0 +1,110 @@
+# GNU General Public License v3.0+ (see https://www.gnu.org/licenses/gpl-3.0.txt)
+"""Ansible callback plugin, enabled by anmad for its playbook runs, that
+writes one compact json line per task start and per host result to the
+file named in ANMAD_EVENTS_PATH."""
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type # pylint: disable=invalid-name
+
+import json
+import os
+import time
+
+from ansible.plugins.callback import CallbackBase
+
+DOCUMENTATION = '''
+    name: anmad_events
+    type: aggregate
+    short_description: write per task / per host events for anmad
+    description:
+      - Appends json lines describing task starts, host results and
+        final stats to the file in ANMAD_EVENTS_PATH.
+      - Does nothing if ANMAD_EVENTS_PATH is not set.
+    requirements:
+      - enabled in callbacks_enabled (callback_whitelist before 2.11)
+'''
+
+
+def _attr(obj, name):
+    """Return obj.name, falling back to obj._name for older ansible."""
+    value = getattr(obj, name, None)
+    if value is None:
+        value = getattr(obj, '_' + name, None)
+    return value
+
+
+class CallbackModule(CallbackBase):
+    """Write anmad events."""
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = 'aggregate'
+    CALLBACK_NAME = 'anmad_events'
+    CALLBACK_NEEDS_ENABLED = True
+    CALLBACK_NEEDS_WHITELIST = True
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        path = os.environ.get('ANMAD_EVENTS_PATH')
+        self.events = open(path, 'a', buffering=1) if path else None
+        self.started = {}
+        self.play = None
+
+    def emit(self, **event):
+        """Write one event."""
+        if self.events is not None:
+            event["time"] = round(time.time(), 3)
+            self.events.write(json.dumps(event, separators=(',', ':')) + '\n')
+
+    @staticmethod
+    def describe(task):
+        """Return name and role of a task."""
+        role = task._role.get_name() if task._role else None # pylint: disable=protected-access
+        return {"task": task.get_name().strip(), "role": role,
+                "uuid": task._uuid} # pylint: disable=protected-access
+
+    def v2_playbook_on_play_start(self, play):
+        self.play = play.get_name().strip()
+        self.emit(event='play_start', play=self.play)
+
+    def v2_playbook_on_task_start(self, task, is_conditional):
+        self.emit(event='task_start', play=self.play, **self.describe(task))
+
+    def v2_playbook_on_handler_task_start(self, task):
+        self.emit(event='task_start', play=self.play, handler=True,
+                  **self.describe(task))
+
+    def v2_runner_on_start(self, host, task):
+        self.started[(host.name, task._uuid)] = time.time() # pylint: disable=protected-access
+
+    def host_result(self, result, status):
+        """Emit the result of a task on one host."""
+        host = _attr(result, 'host')
+        task = _attr(result, 'task')
+        details = _attr(result, 'result') or {}
+        end = time.time()
+        start = self.started.pop((host.name, task._uuid), end) # pylint: disable=protected-access
+        event = {"event": 'host', "host": host.name, "status": status,
+                 "changed": bool(details.get('changed', False)),
+                 "start": round(start, 3),
+                 "duration": round(end - start, 3)}
+        event.update(self.describe(task))
+        if status in ['failed', 'unreachable'] and details.get('msg'):
+            event["msg"] = str(details["msg"])[:500]
+        self.emit(**event)
+
+    def v2_runner_on_ok(self, result):
+        self.host_result(result, 'ok')
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        self.host_result(result, 'ignored' if ignore_errors else 'failed')
+
+    def v2_runner_on_skipped(self, result):
+        self.host_result(result, 'skipped')
+
+    def v2_runner_on_unreachable(self, result):
+        self.host_result(result, 'unreachable')
+
+    def v2_playbook_on_stats(self, stats):
+        self.emit(event='stats', hosts={
+            host: stats.summarize(host) for host in sorted(stats.processed)})
+        if self.events is not None:
+            self.events.close()
+            self.events = None
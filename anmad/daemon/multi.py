@@ -1,13 +1,38 @@
 """Functions to check / run ansible playbooks."""
+import asyncio
 import os
+import subprocess
 from multiprocessing import Pool
 
 import anmad.common.yaml as anmadyaml
+from anmad.daemon.process import KILL_GRACE
 from anmad.daemon.run import AnmadRun
 
+def run_pair(playbookobj, playbook, syncheck=False):
+    """Run (or syntax check) one playbook with an AnmadRun object.
+    Module level, so that pool workers can unpickle it."""
+    if syncheck:
+        return playbookobj.syncheck_playbook(playbook)
+    return playbookobj.run_playbook(playbook)
+
+async def async_run_pair(playbookobj, playbook, syncheck=False):
+    """asyncio version of run_pair."""
+    if syncheck:
+        return await playbookobj.asyncheck_playbook(playbook)
+    return await playbookobj.arun_playbook(playbook)
+
 class AnmadMulti:
     """Anmad Multi inventory / playbook class. Accepts a list of inventories.
-    Multi playbooks will run against the first inventory in the list."""
+    Multi playbooks will run against the first inventory in the list.
+    With the default 'pool' engine, owns a pool of worker processes that is
+    reused for every run, call close() to shut it down. The 'asyncio'
+    engine instead supervises every ansible-playbook process from one
+    event loop, so concurrency is not tied to the number of cpus.
+    If a SyntaxCheckCache is given, syntax checks of unchanged playbooks
+    are skipped. If a LogIndex is given, log files are recorded in it,
+    and if AnmadMetrics are given, pool usage and run times are recorded.
+    If a ProcessRegistry is given, running ansible-playbook processes are
+    recorded in it."""
     # pylint: disable=too-many-arguments
 
 
@@ -16,81 +41,207 @@ class AnmadMulti:
                  inventories,
                  ansible_playbook_cmd,
                  vault_password_file=None,
-                 timeout=1800):
+                 timeout=1800,
+                 concurrency=None,
+                 engine='pool',
+                 cache=None,
+                 logindex=None,
+                 metrics=None,
+                 registry=None,
+                 kill_grace=KILL_GRACE):
         """Init ansibleSyntaxCheck."""
         self.logger = logger
         if not isinstance(inventories, list):
             self.inventories = [inventories]
         else:
-            self.inventories = inventories
+            # results are keyed by inventory, so check each one once
+            self.inventories = list(dict.fromkeys(inventories))
         self.maininventory = self.inventories[0]
         self.ansible_playbook_cmd = ansible_playbook_cmd
         self.vault_password_file = vault_password_file
-        self.concurrency = os.cpu_count()
+        self.concurrency = concurrency or os.cpu_count()
         self.timeout = timeout
+        self.engine = engine
+        self.cache = cache
+        self.logindex = logindex
+        self.metrics = metrics
+        self.registry = registry
+        self.kill_grace = kill_grace
+        self.pool = None
+
+    def start(self):
+        """Start the worker pool, if its not already running."""
+        if self.pool is None and self.metrics is not None:
+            self.metrics.set_gauge('pool_workers', self.concurrency)
+        if self.pool is None and self.engine == 'pool':
+            self.logger.debug(
+                "Starting pool of %s worker processes", self.concurrency)
+            self.pool = Pool(self.concurrency)
+        return self.pool
+
+    def close(self):
+        """Wait for running jobs and shut down the worker pool."""
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def runobj(self, inventory):
+        """Return an AnmadRun object for one inventory."""
+        return AnmadRun(
+            self.logger,
+            inventory,
+            self.ansible_playbook_cmd,
+            self.vault_password_file,
+            self.timeout,
+            self.logindex,
+            self.metrics,
+            self.registry,
+            self.kill_grace)
+
+    def verify_inventory(self, inventory):
+        """Return True if an inventory parses as yaml or ini."""
+        if not anmadyaml.verify_yaml_file(self.logger, inventory):
+            # check the 'bad yaml' isnt actually a valid ini style
+            # inventory, before reporting it bad.
+            if not anmadyaml.verify_config_file(inventory):
+                self.logger.error(
+                    "Unable to verify file %s", str(inventory))
+                return False
+        return True
+
+    def syntax_check_matrix(self, listofplaybooks):
+        """Syntax check every playbook against every inventory.
+        Each playbook and inventory is parsed once, then all
+        playbook x inventory pairs are checked concurrently.
+        Playbooks listed more than once are checked once.
+        Returns a dict of (playbook, inventory): result, where result is
+        0 if OK, 1 or 2 if there was a parsing issue with the playbook
+        or the inventory respectively, or 3 if ansible-playbook syntax
+        check failed."""
+        if isinstance(listofplaybooks, str):
+            listofplaybooks = [listofplaybooks]
+        listofplaybooks = list(dict.fromkeys(listofplaybooks))
+        good_inventories = [inv for inv in self.inventories
+                            if self.verify_inventory(inv)]
+        good_playbooks = []
+        for playbook in listofplaybooks:
+            if anmadyaml.verify_yaml_file(self.logger, playbook):
+                good_playbooks.append(playbook)
+            else:
+                self.logger.error(
+                    "Unable to verify yaml file %s", str(playbook))
+
+        pairs = [(self.runobj(inv), playbook)
+                 for playbook in good_playbooks
+                 for inv in good_inventories]
+        completed_processes = iter(self.runpairs(pairs, syncheck=True))
+
+        results = {}
+        for playbook in listofplaybooks:
+            for inv in self.inventories:
+                if playbook not in good_playbooks:
+                    results[(playbook, inv)] = 1
+                elif inv not in good_inventories:
+                    results[(playbook, inv)] = 2
+                elif next(completed_processes).returncode != 0:
+                    results[(playbook, inv)] = 3
+                else:
+                    results[(playbook, inv)] = 0
+        return results
+
+    def checkmatrix(self, listofplaybooks):
+        """Syntax check a list of playbooks against all inventories.
+        Return number of failed playbook x inventory pairs
+        (so 0 = success)."""
+        results = self.syntax_check_matrix(listofplaybooks)
+        for (playbook, inv), result in results.items():
+            if result != 0:
+                self.logger.warning(
+                    "Syntax check of %s against %s failed with result %s",
+                    str(playbook), str(inv), str(result))
+        return len(results) - list(results.values()).count(0)
 
     def syntax_check_one_play_many_inv(self, playbook):
         """Check a single playbook against all inventories.
         Returns 0 if all OK, 1 or 2 if there was a parsing issue
         with the playbook or the inventories respectively.
         Returns 3 if ansible-playbook syntax check failed.
-        If any errors are found, the function will stop and return one
-        of the above without continuing."""
-        # check if we've been passed a single string, make it a one item list
-        # if so.
-        if not anmadyaml.verify_yaml_file(self.logger, playbook):
-            self.logger.error(
-                "Unable to verify yaml file %s", str(playbook))
-            return 1
-        for my_inventory in self.inventories:
-            if not anmadyaml.verify_yaml_file(self.logger, my_inventory):
-                # check the 'bad yaml' isnt actually a valid ini style
-                # inventory, before reporting it bad.
-                if not anmadyaml.verify_config_file(my_inventory):
-                    self.logger.error(
-                        "Unable to verify file %s", str(my_inventory))
-                    return 2
-
-            playbookobject = AnmadRun(
-                self.logger,
-                my_inventory,
-                self.ansible_playbook_cmd,
-                self.vault_password_file,
-                self.timeout)
-            if playbookobject.syncheck_playbook(playbook).returncode != 0:
-                return 3
-        # if none of the above return statements happen, then syntax checks
-        # passed and we can return 0 to the caller.
+        If any errors are found, the result for the first failing
+        inventory is returned."""
+        results = self.syntax_check_matrix([playbook])
+        for inv in self.inventories:
+            if results[(playbook, inv)] != 0:
+                return results[(playbook, inv)]
         return 0
 
-    def concurrentrun(self, listofplaybooks, syncheck=False):
+    def runpairs(self, pairs, syncheck=False, usecache=True):
+        """Concurrently run a list of (AnmadRun object, playbook) pairs.
+        Return list of completedProcess objs, in the same order."""
+        if syncheck and usecache and self.cache is not None:
+            return self.cached_checkpairs(pairs)
+        if self.engine == 'asyncio':
+            return asyncio.run(self.async_runpairs(pairs, syncheck))
+        return self.start().starmap(
+            run_pair,
+            [(playbookobj, playbook, syncheck)
+             for playbookobj, playbook in pairs])
+
+    def cached_checkpairs(self, pairs):
+        """Syntax check a list of (AnmadRun object, playbook) pairs,
+        only running ansible-playbook for pairs without a cached pass.
+        Return list of completedProcess objs, in the same order."""
+        fingerprints = [self.cache.fingerprint(playbookobj, playbook)
+                        for playbookobj, playbook in pairs]
+        output = [None] * len(pairs)
+        torun = []
+        for num, (playbookobj, playbook) in enumerate(pairs):
+            if self.cache.lookup(fingerprints[num]):
+                self.logger.info(
+                    "OK. Cached syntax check of %s against inventory %s",
+                    str(playbook), str(playbookobj.inventory))
+                output[num] = subprocess.CompletedProcess([playbook], 0)
+            else:
+                torun.append(num)
+        completed_processes = self.runpairs(
+            [pairs[num] for num in torun], syncheck=True, usecache=False)
+        for num, completedprocess in zip(torun, completed_processes):
+            self.cache.store(fingerprints[num], completedprocess.returncode)
+            output[num] = completedprocess
+        return output
+
+    async def async_runpairs(self, pairs, syncheck=False):
+        """Run a list of (AnmadRun object, playbook) pairs as asyncio
+        subprocesses, at most self.concurrency at a time.
+        Return list of completedProcess objs, in the same order."""
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def run_one(playbookobj, playbook):
+            async with semaphore:
+                return await async_run_pair(playbookobj, playbook, syncheck)
+
+        return await asyncio.gather(
+            *[run_one(playbookobj, playbook)
+              for playbookobj, playbook in pairs])
+
+    def returncodes(self, listofplaybooks, syncheck=False):
         """Concurrently run a list of ansible playbooks
         against a single inventory.
-        Return number of nonzero exit codes (so 0 = success)."""
+        Return list of return codes, in the same order."""
         if isinstance(listofplaybooks, str):
             listofplaybooks = [listofplaybooks]
-        playbookobj = AnmadRun(
-            self.logger,
-            self.maininventory,
-            self.ansible_playbook_cmd,
-            self.vault_password_file,
-            self.timeout)
-
-        output = []
-        pool = Pool(self.concurrency)
-        if syncheck:
-            completed_processes = pool.map(
-                playbookobj.syncheck_playbook, listofplaybooks)
-        else:
-            completed_processes = pool.map(
-                playbookobj.run_playbook, listofplaybooks)
-        pool.close()
-        pool.join()
-
-        output = []
+        playbookobj = self.runobj(self.maininventory)
+        completed_processes = self.runpairs(
+            [(playbookobj, playbook) for playbook in listofplaybooks],
+            syncheck=syncheck)
+        return [completedprocess.returncode
+                for completedprocess in completed_processes]
 
-        for completedprocess in completed_processes:
-            output.append(completedprocess.returncode)
+    def concurrentrun(self, listofplaybooks, syncheck=False):
+        """Concurrently run a list of ansible playbooks
+        against a single inventory.
+        Return number of nonzero exit codes (so 0 = success)."""
+        output = self.returncodes(listofplaybooks, syncheck)
 
         # if the returned list of outputs only contains 0, success.
         if output.count(0) == len(output):
@@ -106,14 +257,16 @@ class AnmadMulti:
         return problemcount
 
     def syncheck_dir(self, check_dir):
-        """Check all YAML in a directory for ansible syntax.
-        Return number of files failing syntax check (0 = success)
+        """Check all YAML in a directory for ansible syntax against all
+        inventories.
+        Return number of file x inventory pairs failing syntax check
+        (0 = success)
         and/or 255 if dir not found"""
         if not os.path.exists(check_dir):
             self.logger.error("%s cannot be found", str(check_dir))
             return 255
 
-        problemcount = self.checkplaybooks(
+        problemcount = self.checkmatrix(
             anmadyaml.find_yaml_files(self.logger, check_dir))
         return problemcount
 
@@ -1,25 +1,149 @@
 """anmad process functions."""
-import fnmatch
+import asyncio
+import json
+import os
+import signal
+import subprocess
+import time
+from socket import getfqdn
+
 import psutil
+import redis
+
+from anmad.common.queues import RedisClient
 
-def get_ansible_playbook_procs(cmdline_search='ansible-playbook'):
-    """Get list of processes that match *ansible-playbook."""
-    proclist = [p.info for p in
-                psutil.process_iter(attrs=['pid', 'name', 'cmdline'])
-                if fnmatch.filter(
-                    p.info['cmdline'], '*' + cmdline_search + '*')]
-    return proclist
+# seconds a process group gets to exit after SIGTERM before SIGKILL
+KILL_GRACE = 10
 
 def kill(pid):
     """Kill ONE ansible-playbook process by pid."""
     process = psutil.Process(pid)
     process.kill()
 
-def killall(**kwargs):
-    """Killall ansible-playbook."""
-    playtokill = kwargs.get('playtokill', 'ansible-playbook')
-    proclist = get_ansible_playbook_procs(cmdline_search=playtokill)
-    pids = [li['pid'] for li in proclist]
-    for pid in pids:
-        kill(pid)
-    return proclist
+def kill_registered(entry):
+    """SIGKILL a process from a ProcessRegistry, along with the rest of
+    its process group if it leads one."""
+    if entry.get("pgid") == entry["pid"]:
+        signal_group(entry["pid"], signal.SIGKILL)
+    else:
+        kill(entry["pid"])
+
+def signal_group(pgid, signum):
+    """Send a signal to every process in a process group.
+    Returns False if the group has no processes left."""
+    try:
+        os.killpg(pgid, signum)
+    except ProcessLookupError:
+        return False
+    return True
+
+def terminate_group(proc, grace=KILL_GRACE):
+    """SIGTERM the process group led by a Popen object, then SIGKILL
+    whatever is left of it once the leader has exited or after grace
+    seconds, so no forks are left holding ssh connections.
+    Returns (seconds taken, True if the leader needed SIGKILL)."""
+    start = time.time()
+    signal_group(proc.pid, signal.SIGTERM)
+    try:
+        proc.wait(timeout=grace)
+        escalated = False
+    except subprocess.TimeoutExpired:
+        escalated = True
+    signal_group(proc.pid, signal.SIGKILL)
+    proc.wait()
+    return time.time() - start, escalated
+
+async def aterminate_group(proc, grace=KILL_GRACE):
+    """terminate_group for an asyncio subprocess."""
+    start = time.time()
+    signal_group(proc.pid, signal.SIGTERM)
+    try:
+        await asyncio.wait_for(proc.wait(), timeout=grace)
+        escalated = False
+    except asyncio.TimeoutError:
+        escalated = True
+    signal_group(proc.pid, signal.SIGKILL)
+    await proc.wait()
+    return time.time() - start, escalated
+
+def create_time(pid):
+    """Return the start time of a process, or None if it is gone."""
+    try:
+        return psutil.Process(pid).create_time()
+    except psutil.Error:
+        return None
+
+
+class ProcessRegistry(RedisClient):
+    """Redis hash per host of the ansible-playbook processes anmad daemons
+    have started, keyed by pid, so running jobs can be listed and kill
+    requests checked without scanning the whole process table.
+    Each entry records the pid, process group, start time, cmdline,
+    playbook, inventory and log file of a process.
+    Entries whose pid has gone, or been reused by a process started at
+    a different time, are dropped when read."""
+
+    def __init__(self, host=None, prefix='anmad:procs', **redis_kwargs):
+        """Init ProcessRegistry."""
+        super().__init__(**redis_kwargs)
+        self.host = host or getfqdn()
+        self.key = prefix + ':' + self.host
+
+    def register(self, pid, cmdline, **meta):
+        """Record a running process, returns its entry."""
+        try:
+            pgid = os.getpgid(pid)
+        except OSError:
+            pgid = None
+        entry = {"pid": pid,
+                 "pgid": pgid,
+                 "created": create_time(pid),
+                 "started": time.time(),
+                 "host": self.host,
+                 "daemon": os.getpid(),
+                 "cmdline": list(cmdline)}
+        entry.update(meta)
+        try:
+            self.redis.hset(self.key, str(pid), json.dumps(entry))
+        except redis.RedisError:
+            # never stop a playbook from running
+            pass
+        return entry
+
+    def unregister(self, pid):
+        """Remove a finished process."""
+        try:
+            self.redis.hdel(self.key, str(pid))
+        except redis.RedisError:
+            pass
+
+    @staticmethod
+    def alive(entry):
+        """Return True if the process an entry describes is still
+        running."""
+        created = create_time(entry["pid"])
+        return created is not None and (
+            entry.get("created") is None
+            or abs(created - entry["created"]) < 1)
+
+    def procs(self):
+        """Return list of entries for running processes, oldest first."""
+        entries = [json.loads(value) for value in
+                   self.redis.hvals(self.key)]
+        gone = [entry for entry in entries if not self.alive(entry)]
+        if gone:
+            self.redis.hdel(self.key, *[str(entry["pid"]) for entry in gone])
+        return sorted([entry for entry in entries if entry not in gone],
+                      key=lambda entry: entry["started"])
+
+    def lookup(self, pid):
+        """Return the entry for a running process, or None if pid is not
+        one anmad started."""
+        value = self.redis.hget(self.key, str(pid))
+        if value is None:
+            return None
+        entry = json.loads(value)
+        if not self.alive(entry):
+            self.unregister(pid)
+            return None
+        return entry
@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 """Simple script to add a restart job to anmad queue."""
-from anmad.common.queues import AnmadQueues
+from anmad.common.args import parse_redis_args
+from anmad.common.queues import AnmadQueues, redis_config
 
-QUEUES = AnmadQueues('prerun', 'playbooks', 'info')
+ARGS = parse_redis_args()
+QUEUES = AnmadQueues('prerun', 'playbooks', 'info', **redis_config(ARGS))
 
-QUEUES.queue_job(['restart_anmad_run'])
+QUEUES.queue_job([], jobtype='restart')
@@ -0,0 +1,130 @@
+"""Prune and compress old ansible-playbook logs in the background."""
+import os
+import threading
+import time
+
+from anmad.common.logfiles import compress_log, compressed, remove_log
+
+# seconds between passes over the log index
+RETENTION_INTERVAL = 3600
+
+
+class LogRetention:
+    """Background thread that compresses finished logs and deletes logs
+    by age, count per playbook and total size, working from a LogIndex
+    so it never lists the log directories.
+    Logs written to in the last active seconds are never touched."""
+    # pylint: disable=too-many-arguments
+
+    def __init__(self, logger, logindex, max_days=0, max_count=0,
+                 max_mb=0, compress_after=24, active=3600,
+                 interval=RETENTION_INTERVAL):
+        """Init LogRetention. Limits of 0 are disabled,
+        compress_after is in hours."""
+        self.logger = logger
+        self.logindex = logindex
+        self.max_days = max_days
+        self.max_count = max_count
+        self.max_mb = max_mb
+        self.compress_after = compress_after
+        self.active = active
+        self.interval = interval
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """Start the retention thread."""
+        self.thread = threading.Thread(
+            target=self.run, name='anmad-retention', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop the retention thread."""
+        self.stopping.set()
+
+    def run(self):
+        """Prune and compress logs every interval seconds until stopped."""
+        while True:
+            try:
+                self.prune()
+            except Exception: # pylint: disable=broad-except
+                self.logger.exception("Error pruning ansible logs")
+            if self.stopping.wait(self.interval):
+                return
+
+    def logs(self):
+        """Return list of (playbook, log path, start time, mtime, size)
+        for every log in this hosts index that still exists, oldest
+        first. Logs that have gone are dropped from the index."""
+        output = []
+        for playbook in self.logindex.playbooks():
+            for logfile, when in self.logindex.entries(playbook):
+                try:
+                    stat = os.stat(os.path.join(
+                        self.logindex.log_base, logfile))
+                except OSError:
+                    self.logindex.remove(playbook, logfile)
+                    continue
+                output.append(
+                    (playbook, logfile, when, stat.st_mtime, stat.st_size))
+        output.sort(key=lambda log: log[2])
+        return output
+
+    def expired(self, logs, now):
+        """Return the set of (playbook, log path) to delete."""
+        output = set()
+        if self.max_days:
+            output.update((log[0], log[1]) for log in logs
+                          if log[2] < now - self.max_days * 86400)
+        if self.max_count:
+            perplaybook = {}
+            for log in logs:
+                perplaybook.setdefault(log[0], []).append(log)
+            for playlogs in perplaybook.values():
+                output.update((log[0], log[1])
+                              for log in playlogs[:-self.max_count])
+        if self.max_mb:
+            total = sum(log[4] for log in logs
+                        if (log[0], log[1]) not in output)
+            for log in logs:
+                if total <= self.max_mb * 1024 * 1024:
+                    break
+                if (log[0], log[1]) not in output:
+                    output.add((log[0], log[1]))
+                    total -= log[4]
+        return output
+
+    def prune(self):
+        """Delete expired logs and compress finished ones.
+        Returns (deleted, compressed) counts."""
+        now = time.time()
+        logs = [log for log in self.logs() if log[3] < now - self.active]
+        expired = self.expired(logs, now)
+        deleted = 0
+        for playbook, logfile in expired:
+            try:
+                remove_log(os.path.join(self.logindex.log_base, logfile))
+            except OSError as error:
+                self.logger.warning("Unable to remove %s: %s",
+                                    logfile, str(error))
+                continue
+            self.logindex.remove(playbook, logfile)
+            deleted += 1
+        count = 0
+        if self.compress_after:
+            for playbook, logfile, _, mtime, _ in logs:
+                if ((playbook, logfile) in expired or compressed(logfile)
+                        or mtime > now - self.compress_after * 3600):
+                    continue
+                try:
+                    compress_log(os.path.join(self.logindex.log_base, logfile))
+                except OSError as error:
+                    self.logger.warning("Unable to compress %s: %s",
+                                        logfile, str(error))
+                    continue
+                self.logindex.replace(playbook, logfile, logfile + '.gz')
+                count += 1
+        if deleted or count:
+            self.logger.info("Deleted %s and compressed %s ansible logs",
+                             deleted, count)
+        return deleted, count
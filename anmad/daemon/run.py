@@ -1,14 +1,28 @@
 """Functions to run ansible playbooks."""
+import asyncio
 import os
 import subprocess
 import copy
 
+from contextlib import nullcontext
 from pathlib import Path
 from time import gmtime,strftime
-from anmad.daemon.process import killall
+from anmad.common.events import callback_env, summarize
+from anmad.common.logfiles import LOG_BASE
+from anmad.common import timings
+from anmad.daemon.process import KILL_GRACE, aterminate_group, terminate_group
 
 class AnmadRun:
-    """Ansible-playbook operations class."""
+    """Ansible-playbook operations class.
+    If a LogIndex is given, every log file is recorded in it, along with
+    a summary of the task / host events of each run, and task, role and
+    run durations are added to the timings kept across runs.
+    If AnmadMetrics are given, run times, timeouts and kills are
+    recorded in them.
+    If a ProcessRegistry is given, every ansible-playbook process is
+    recorded in it while it runs.
+    Each ansible-playbook runs in its own session, so on timeout its whole
+    process group is sent SIGTERM, then SIGKILL after kill_grace seconds."""
     # pylint: disable=too-many-arguments
 
 
@@ -17,7 +31,11 @@ class AnmadRun:
                  inventory,
                  ansible_playbook_cmd,
                  vault_password_file=None,
-                 timeout=1800):
+                 timeout=1800,
+                 logindex=None,
+                 metrics=None,
+                 registry=None,
+                 kill_grace=KILL_GRACE):
         """Init AnmadRun."""
         self.logger = logger
         self.inventory = inventory
@@ -26,12 +44,16 @@ class AnmadRun:
             self.ansible_playbook_cmd.extend(
                 ['--vault-password-file', vault_password_file])
         self.timeout = timeout
+        self.logindex = logindex
+        self.metrics = metrics
+        self.registry = registry
+        self.kill_grace = kill_grace
         self.time_format = '%H-%M-%S'
         self.date_format = '%Y-%m-%d'
 
-    def run_playbook(self, playbook, syncheck=False, checkmode=False):
-        """Run an ansible playbook, optionally in syntax check mode or
-        with --check --diff"""
+    def prepare_playbook(self, playbook, syncheck=False, checkmode=False):
+        """Return the command line and environment to run an ansible
+        playbook, optionally in syntax check mode or with --check --diff"""
         playbook = os.path.abspath(playbook)
         inventory = os.path.abspath(self.inventory)
         my_ansible_playbook_cmd = copy.deepcopy(self.ansible_playbook_cmd)
@@ -44,67 +66,177 @@ class AnmadRun:
         my_env = os.environ.copy()
         my_rundate = strftime(self.date_format, gmtime())
         my_runtime = strftime(self.time_format, gmtime())
-        my_logdir = ('/var/log/ansible/playbook/' + os.path.basename(playbook)
+        my_logdir = (LOG_BASE + '/' + os.path.basename(playbook)
             + '/' + my_rundate + '/')
         Path(my_logdir).mkdir(parents=True, exist_ok=True)
         my_env['ANSIBLE_LOG_PATH'] = ( my_logdir
                 + os.path.basename(playbook) + '.' + my_rundate
                 + '.' + my_runtime + '.log')
         #my_env['ANSIBLE_TRANSFORM_INVALID_GROUP_CHARS'] = 'silently'
+        if not syncheck:
+            callback_env(my_env, my_env['ANSIBLE_LOG_PATH'])
+        if self.logindex is not None:
+            try:
+                self.logindex.record(playbook, my_env['ANSIBLE_LOG_PATH'])
+            except Exception: # pylint: disable=broad-except
+                self.logger.exception("Unable to index log %s",
+                                      my_env['ANSIBLE_LOG_PATH'])
 
         self.logger.info(
             "Running '%s' and logging to '%s'",
             ' '.join(my_ansible_playbook_cmd), str(my_env['ANSIBLE_LOG_PATH']))
+        return my_ansible_playbook_cmd, my_env
+
+    def index_events(self, playbook, my_env):
+        """Record the event summary and timings of a finished run."""
+        if self.logindex is None or 'ANMAD_EVENTS_PATH' not in my_env:
+            return
         try:
-            ret = subprocess.run(
-                my_ansible_playbook_cmd,
-                env=my_env,
-                timeout=self.timeout,
-                check=False,
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL
-                )
-        except subprocess.TimeoutExpired:
-            # create a dummy completedProcess obj with a bad return code
-            ret = subprocess.CompletedProcess(
-                my_ansible_playbook_cmd,
-                255)
-            # killall ansible-playbook procs to tidy up after
-            # killing the main one
-            killedprocs = killall(
-                playtokill=' '.join(my_ansible_playbook_cmd))
-            self.logger.error(
-                "Timed out waiting %s seconds for '%s'",
-                self.timeout, ' '.join(my_ansible_playbook_cmd))
-            for proc in killedprocs:
-                self.logger.warning(
-                    "KILLED '%s' due to timeout", ' '.join(proc['cmdline']))
-            return ret
+            summary = summarize(my_env['ANMAD_EVENTS_PATH'])
+            if summary is not None:
+                self.logindex.record_run(my_env['ANSIBLE_LOG_PATH'], summary)
+                timings.record(self.logindex.redis,
+                               os.path.basename(playbook), summary)
+        except Exception: # pylint: disable=broad-except
+            self.logger.exception("Unable to index events of %s",
+                                  my_env['ANSIBLE_LOG_PATH'])
+
+    def timed_out(self, my_ansible_playbook_cmd, kill_time, escalated):
+        """Log and count a playbook that timed out and had its process
+        group killed, return a dummy completedProcess obj with a bad
+        return code."""
+        ret = subprocess.CompletedProcess(
+            my_ansible_playbook_cmd,
+            255)
+        self.logger.error(
+            "Timed out waiting %s seconds for '%s'",
+            self.timeout, ' '.join(my_ansible_playbook_cmd))
+        self.logger.warning(
+            "KILLED '%s' and its process group due to timeout, with %s "
+            "after %.1f seconds",
+            ' '.join(my_ansible_playbook_cmd),
+            'SIGKILL' if escalated else 'SIGTERM', kill_time)
+        if self.metrics is not None:
+            self.metrics.inc('playbook_timeouts_total')
+            self.metrics.inc('killed_processes_total')
+            if escalated:
+                self.metrics.inc('kill_escalations_total')
+            self.metrics.observe('kill_seconds', kill_time)
+        return ret
 
+    def register(self, pid, my_ansible_playbook_cmd, my_env, syncheck=False):
+        """Record a started ansible-playbook process in the registry."""
+        if self.registry is None:
+            return
+        self.registry.register(
+            pid,
+            my_ansible_playbook_cmd,
+            playbook=my_ansible_playbook_cmd[-1],
+            inventory=os.path.abspath(self.inventory),
+            log=os.path.relpath(my_env['ANSIBLE_LOG_PATH'], LOG_BASE),
+            syncheck=syncheck)
+
+    def unregister(self, pid):
+        """Remove a finished ansible-playbook process from the registry."""
+        if self.registry is not None:
+            self.registry.unregister(pid)
+
+    def metered(self, syncheck=False):
+        """Return a context manager counting a busy ansible-playbook
+        process in the metrics, if there are any."""
+        if self.metrics is None:
+            return nullcontext()
+        return self.metrics.busy(
+            'syncheck_seconds' if syncheck else 'playbook_run_seconds')
+
+    def log_returncode(self, playbook, ret):
+        """Log the return code of a finished playbook."""
         if ret.returncode == 0:
             self.logger.info(
                 "ansible-playbook %s return code: %s",
                 str(playbook), str(ret.returncode))
-            return ret
+            return
         ## should only log as an error if return code not 0
         self.logger.error(
             "ansible-playbook %s did not complete, return code: %s",
             str(playbook), str(ret.returncode))
+
+    def run_playbook(self, playbook, syncheck=False, checkmode=False):
+        """Run an ansible playbook, optionally in syntax check mode or
+        with --check --diff"""
+        my_ansible_playbook_cmd, my_env = self.prepare_playbook(
+            playbook, syncheck, checkmode)
+        with self.metered(syncheck), subprocess.Popen(
+                my_ansible_playbook_cmd,
+                env=my_env,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                start_new_session=True
+                ) as proc:
+            self.register(
+                proc.pid, my_ansible_playbook_cmd, my_env, syncheck)
+            try:
+                ret = subprocess.CompletedProcess(
+                    my_ansible_playbook_cmd, proc.wait(timeout=self.timeout))
+            except subprocess.TimeoutExpired:
+                ret = self.timed_out(
+                    my_ansible_playbook_cmd,
+                    *terminate_group(proc, self.kill_grace))
+                self.index_events(playbook, my_env)
+                return ret
+            finally:
+                self.unregister(proc.pid)
+
+        self.log_returncode(os.path.abspath(playbook), ret)
+        self.index_events(playbook, my_env)
         return ret
 
-    def syncheck_playbook(self, playbook):
-        """Check a single playbook against a single inventory.
-        Returns ansible-playbook command return code
-        (should be 0 if syntax checks pass)."""
-        self.logger.info(
-            "Syntax Checking ansible playbook %s against "
-            "inventory %s", str(playbook), str(self.inventory))
-        ret = self.run_playbook(playbook, syncheck=True)
+    async def arun_playbook(self, playbook, syncheck=False, checkmode=False):
+        """Run an ansible playbook as an asyncio subprocess, with the same
+        options and return value as run_playbook. If the task is
+        cancelled, the ansible-playbook process is killed."""
+        my_ansible_playbook_cmd, my_env = self.prepare_playbook(
+            playbook, syncheck, checkmode)
+        with self.metered(syncheck):
+            proc = await asyncio.create_subprocess_exec(
+                *my_ansible_playbook_cmd,
+                env=my_env,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                start_new_session=True
+                )
+            self.register(
+                proc.pid, my_ansible_playbook_cmd, my_env, syncheck)
+            try:
+                returncode = await asyncio.wait_for(
+                    proc.wait(), timeout=float(self.timeout))
+            except asyncio.TimeoutError:
+                ret = self.timed_out(
+                    my_ansible_playbook_cmd,
+                    *await aterminate_group(proc, self.kill_grace))
+                self.index_events(playbook, my_env)
+                return ret
+            except asyncio.CancelledError:
+                await aterminate_group(proc, self.kill_grace)
+                self.logger.warning(
+                    "KILLED '%s' due to cancellation",
+                    ' '.join(my_ansible_playbook_cmd))
+                raise
+            finally:
+                self.unregister(proc.pid)
+
+        ret = subprocess.CompletedProcess(my_ansible_playbook_cmd, returncode)
+        self.log_returncode(os.path.abspath(playbook), ret)
+        self.index_events(playbook, my_env)
+        return ret
+
+    def log_syncheck(self, playbook, ret):
+        """Log the result of a syntax check."""
         if ret.returncode == 0:
             self.logger.info(
                 "OK. ansible-playbook syntax check of %s return code: "
                 "%s", str(playbook), str(ret.returncode))
-            return ret
+            return
         # if syntax checks pass, the code below should NOT run
         self.logger.warning(
             "Playbook %s failed syntax check against inventory %s!!!",
@@ -112,4 +244,23 @@ class AnmadRun:
         self.logger.warning(
             "ansible-playbook syntax check return code for %s: "
             "%s", str(playbook), str(ret.returncode))
+
+    def syncheck_playbook(self, playbook):
+        """Check a single playbook against a single inventory.
+        Returns ansible-playbook command return code
+        (should be 0 if syntax checks pass)."""
+        self.logger.info(
+            "Syntax Checking ansible playbook %s against "
+            "inventory %s", str(playbook), str(self.inventory))
+        ret = self.run_playbook(playbook, syncheck=True)
+        self.log_syncheck(playbook, ret)
+        return ret
+
+    async def asyncheck_playbook(self, playbook):
+        """asyncio version of syncheck_playbook."""
+        self.logger.info(
+            "Syntax Checking ansible playbook %s against "
+            "inventory %s", str(playbook), str(self.inventory))
+        ret = await self.arun_playbook(playbook, syncheck=True)
+        self.log_syncheck(playbook, ret)
         return ret
@@ -0,0 +1,272 @@
+"""Content addressed cache of ansible-playbook syntax check results."""
+import hashlib
+import os
+import subprocess
+
+import yaml
+
+# task / play keywords that pull in other files, without any collection
+# prefix (ansible.builtin.include_tasks is treated as include_tasks)
+FILE_KEYS = ['include', 'import_playbook', 'include_tasks', 'import_tasks',
+             'include_vars', 'vars_files']
+ROLE_KEYS = ['include_role', 'import_role']
+# files next to a playbook or inventory that ansible reads implicitly
+IMPLICIT_DIRS = ['group_vars', 'host_vars']
+
+
+class Uncacheable(Exception):
+    """Raised when a playbooks dependencies cannot be worked out,
+    for example because an include is templated."""
+
+
+def short_key(key):
+    """Strip a collection prefix from a module / keyword name."""
+    if isinstance(key, str):
+        return key.rsplit('.', 1)[-1]
+    return key
+
+
+class SyntaxCheckCache:
+    """Caches passing syntax checks in redis, keyed by a hash of the
+    playbook, every file it includes, the roles it uses, the inventory,
+    the ansible version and the ansible config / environment.
+    Entries expire after ttl seconds. Failed checks are never cached."""
+
+    def __init__(self, logger, redis_conn, ttl=604800,
+                 prefix='anmad:syncache'):
+        """Init SyntaxCheckCache."""
+        self.logger = logger
+        self.redis = redis_conn
+        self.ttl = ttl
+        self.prefix = prefix
+        self.stats_key = prefix + ':stats'
+        # {filename: ((mtime, size), value)}, only the latest version of
+        # each file is kept
+        self.file_digests = {}
+        self.parsed = {}
+        self.versions = {}
+
+    @staticmethod
+    def memoized(memo, filename, compute):
+        """Return compute(filename), memoized in memo on the files mtime
+        and size."""
+        stat = os.stat(filename)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        cached = memo.get(filename)
+        if cached is None or cached[0] != stamp:
+            cached = memo[filename] = (stamp, compute(filename))
+        return cached[1]
+
+    @staticmethod
+    def sha256(filename):
+        """Return sha256 of a files contents."""
+        digest = hashlib.sha256()
+        with open(filename, 'rb') as my_file:
+            for chunk in iter(lambda: my_file.read(65536), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    @staticmethod
+    def parse(filename):
+        """Return parsed yaml from a file."""
+        with open(filename, 'r') as my_file:
+            return yaml.safe_load(my_file)
+
+    def file_digest(self, filename):
+        """Return sha256 of a files contents, memoized on mtime and size."""
+        return self.memoized(self.file_digests, filename, self.sha256)
+
+    def path_digest(self, path, digest):
+        """Add a file, or every file in a directory tree, to digest."""
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for filename in sorted(files):
+                    self.path_digest(os.path.join(root, filename), digest)
+        elif os.path.isfile(path):
+            digest.update(path.encode() + b'\0'
+                          + self.file_digest(path).encode() + b'\0')
+
+    def ansible_version(self, ansible_playbook_cmd):
+        """Return output of ansible-playbook --version, run once per cmd."""
+        if ansible_playbook_cmd not in self.versions:
+            try:
+                ret = subprocess.run(
+                    [ansible_playbook_cmd, '--version'],
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.DEVNULL,
+                    text=True,
+                    check=False)
+                self.versions[ansible_playbook_cmd] = ret.stdout
+            except OSError:
+                self.versions[ansible_playbook_cmd] = ''
+        return self.versions[ansible_playbook_cmd]
+
+    @staticmethod
+    def ansible_config():
+        """Return the path of the ansible.cfg that ansible would use."""
+        candidates = [os.environ.get('ANSIBLE_CONFIG', ''),
+                      os.path.join(os.getcwd(), 'ansible.cfg'),
+                      os.path.expanduser('~/.ansible.cfg'),
+                      '/etc/ansible/ansible.cfg']
+        for candidate in candidates:
+            if candidate and os.path.isfile(candidate):
+                return candidate
+        return None
+
+    @staticmethod
+    def find_file(name, searchdirs):
+        """Find an included file relative to searchdirs."""
+        if not isinstance(name, str) or '{{' in name or '{%' in name:
+            raise Uncacheable("cannot resolve include " + str(name))
+        for searchdir in searchdirs:
+            candidate = os.path.join(searchdir, name)
+            if os.path.exists(candidate):
+                return os.path.abspath(candidate)
+        raise Uncacheable("cannot find include " + name)
+
+    @staticmethod
+    def find_role(name, playbook_dir):
+        """Find a role directory the way ansible would."""
+        if not isinstance(name, str) or '{{' in name or '{%' in name:
+            raise Uncacheable("cannot resolve role " + str(name))
+        searchdirs = [os.path.join(playbook_dir, 'roles'), playbook_dir]
+        searchdirs.extend(
+            os.environ.get('ANSIBLE_ROLES_PATH', '').split(os.pathsep))
+        searchdirs.extend([os.path.expanduser('~/.ansible/roles'),
+                           '/usr/share/ansible/roles', '/etc/ansible/roles'])
+        for searchdir in searchdirs:
+            candidate = os.path.join(searchdir, name)
+            if searchdir and os.path.isdir(candidate):
+                return os.path.abspath(candidate)
+        raise Uncacheable("cannot find role " + name)
+
+    def load_yaml(self, filename):
+        """Return parsed yaml from a file, memoized on mtime and size."""
+        try:
+            return self.memoized(self.parsed, filename, self.parse)
+        except (OSError, yaml.YAMLError) as error:
+            raise Uncacheable(str(error)) from error
+
+    def add_role(self, name, playbook_dir, found):
+        """Add a role directory, and everything its tasks, handlers and
+        dependencies reference, to the set found."""
+        roledir = self.find_role(name, playbook_dir)
+        if roledir in found:
+            return
+        found.add(roledir)
+        for subdir in ['tasks', 'handlers', 'meta']:
+            for root, _, files in os.walk(os.path.join(roledir, subdir)):
+                for filename in sorted(files):
+                    if filename.endswith(('.yml', '.yaml')):
+                        self.references(os.path.join(root, filename),
+                                        playbook_dir, found)
+
+    def references(self, filename, playbook_dir, found):
+        """Add every file and role directory referenced by a yaml file
+        (recursively) to the set found."""
+        if filename in found:
+            return
+        found.add(filename)
+        if os.path.isdir(filename):
+            return
+        data = self.load_yaml(filename)
+        searchdirs = [os.path.dirname(filename), playbook_dir]
+
+        def walk(node):
+            if isinstance(node, list):
+                for item in node:
+                    walk(item)
+                return
+            if not isinstance(node, dict):
+                return
+            for key, value in node.items():
+                key = short_key(key)
+                if key in FILE_KEYS:
+                    if isinstance(value, dict):
+                        value = value.get('file', value.get('_raw_params'))
+                    for name in value if isinstance(value, list) else [value]:
+                        self.references(self.find_file(name, searchdirs),
+                                        playbook_dir, found)
+                elif key in ROLE_KEYS and isinstance(value, dict):
+                    self.add_role(value.get('name'), playbook_dir, found)
+                elif key in ['roles', 'dependencies'] and isinstance(
+                        value, list):
+                    for role in value:
+                        if isinstance(role, dict):
+                            role = role.get('role', role.get('name'))
+                        self.add_role(role, playbook_dir, found)
+                else:
+                    walk(value)
+
+        walk(data)
+
+    def fingerprint(self, playbookobj, playbook):
+        """Return the cache key for syntax checking playbook with an
+        AnmadRun object, or None if it cant be worked out."""
+        playbook = os.path.abspath(playbook)
+        playbook_dir = os.path.dirname(playbook)
+        inventory = os.path.abspath(playbookobj.inventory)
+        inventory_dir = (inventory if os.path.isdir(inventory)
+                         else os.path.dirname(inventory))
+        found = set()
+        try:
+            self.references(playbook, playbook_dir, found)
+        except Uncacheable as reason:
+            self.logger.debug(
+                "Not caching syntax check of %s: %s", playbook, str(reason))
+            return None
+        found.add(inventory)
+        for implicit in IMPLICIT_DIRS:
+            found.add(os.path.join(playbook_dir, implicit))
+            found.add(os.path.join(inventory_dir, implicit))
+        config = self.ansible_config()
+        if config is not None:
+            found.add(config)
+
+        digest = hashlib.sha256()
+        digest.update(' '.join(playbookobj.ansible_playbook_cmd).encode())
+        digest.update(self.ansible_version(
+            playbookobj.ansible_playbook_cmd[0]).encode())
+        for key in sorted(os.environ):
+            if key.startswith('ANSIBLE_') and key != 'ANSIBLE_LOG_PATH':
+                digest.update((key + '=' + os.environ[key] + '\0').encode())
+        digest.update(playbook.encode() + b'\0')
+        for path in sorted(found):
+            self.path_digest(path, digest)
+        return self.prefix + ':' + digest.hexdigest()
+
+    def lookup(self, fingerprint):
+        """Return True if fingerprint is a cached passing syntax check,
+        and record a hit or miss."""
+        if fingerprint is None:
+            self.redis.hincrby(self.stats_key, 'uncacheable', 1)
+            return False
+        if self.redis.exists(fingerprint):
+            self.redis.hincrby(self.stats_key, 'hits', 1)
+            return True
+        self.redis.hincrby(self.stats_key, 'misses', 1)
+        return False
+
+    def store(self, fingerprint, returncode):
+        """Cache a passing syntax check result."""
+        if fingerprint is not None and returncode == 0:
+            self.redis.set(fingerprint, returncode, ex=self.ttl)
+
+    def stats(self):
+        """Return hit / miss counts and hit rate."""
+        counts = {key.decode(): int(value) for key, value in
+                  self.redis.hgetall(self.stats_key).items()}
+        output = {"hits": counts.get('hits', 0),
+                  "misses": counts.get('misses', 0),
+                  "uncacheable": counts.get('uncacheable', 0),
+                  "entries": sum(1 for _ in self.redis.scan_iter(
+                      self.prefix + ':[0-9a-f]*', count=1000))}
+        lookups = output["hits"] + output["misses"] + output["uncacheable"]
+        output["hit_rate"] = output["hits"] / lookups if lookups else 0.0
+        return output
+
+    def clear(self):
+        """Remove all cached results and stats."""
+        for key in self.redis.scan_iter(self.prefix + ':*', count=1000):
+            self.redis.delete(key)
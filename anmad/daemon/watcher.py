@@ -0,0 +1,207 @@
+"""Watch playbook directories for changes, using inotify where possible."""
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+import time
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM
+              | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF)
+EVENT_HEADER = struct.Struct('iIII')
+
+# seconds between scans when inotify is not available
+POLL_INTERVAL = 5
+
+
+def hidden(path):
+    """Return True for paths inside hidden dirs like .git, or hidden files."""
+    return '/.' in path
+
+
+def watched_dirs(directories):
+    """Yield every non hidden directory under directories."""
+    for directory in directories:
+        for root, dirs, _ in os.walk(directory):
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            yield root
+
+
+class InotifyWatch:
+    """Recursive directory watch using linux inotify through libc."""
+
+    def __init__(self, directories):
+        """Init InotifyWatch, raises OSError if inotify is unavailable."""
+        libc_name = ctypes.util.find_library('c')
+        if libc_name is None:
+            raise OSError("libc not found")
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError("inotify not supported")
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}
+        for directory in watched_dirs(directories):
+            self.add_watch(directory)
+
+    def add_watch(self, directory):
+        """Watch one directory."""
+        wd = self.libc.inotify_add_watch(
+            self.fd, os.fsencode(directory), WATCH_MASK)
+        if wd >= 0:
+            self.watches[wd] = directory
+
+    def changes(self, timeout=None):
+        """Wait up to timeout seconds (forever if None) for changes.
+        Return list of changed paths, empty if none."""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        data = os.read(self.fd, 65536)
+        changed = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                changed.extend(self.watches.values())
+                continue
+            directory = self.watches.get(wd)
+            if directory is None:
+                continue
+            path = os.path.join(directory, name) if name else directory
+            if hidden(path):
+                continue
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                for newdir in watched_dirs([path]):
+                    self.add_watch(newdir)
+            if mask & IN_DELETE_SELF:
+                del self.watches[wd]
+            changed.append(path)
+        return changed
+
+    def close(self):
+        """Stop watching."""
+        os.close(self.fd)
+
+
+class PollingWatch:
+    """Directory watch that compares file mtimes and sizes every
+    POLL_INTERVAL seconds, for systems without inotify."""
+
+    def __init__(self, directories, interval=POLL_INTERVAL):
+        """Init PollingWatch."""
+        self.directories = directories
+        self.interval = interval
+        self.snapshot = self.scan()
+
+    def scan(self):
+        """Return {path: (mtime, size)} for every watched file."""
+        output = {}
+        for directory in watched_dirs(self.directories):
+            try:
+                entries = list(os.scandir(directory))
+            except OSError:
+                continue
+            for entry in entries:
+                if entry.name.startswith('.') or entry.is_dir():
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                output[entry.path] = (stat.st_mtime_ns, stat.st_size)
+        return output
+
+    def changes(self, timeout=None):
+        """Wait up to timeout seconds (forever if None) for changes.
+        Return list of changed paths, empty if none."""
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            wait = self.interval
+            if deadline is not None:
+                wait = min(wait, max(0, deadline - time.time()))
+            time.sleep(wait)
+            snapshot = self.scan()
+            changed = [path for path in set(snapshot) | set(self.snapshot)
+                       if snapshot.get(path) != self.snapshot.get(path)]
+            self.snapshot = snapshot
+            if changed or (deadline is not None and time.time() >= deadline):
+                return changed
+
+    def close(self):
+        """Stop watching."""
+
+
+class AnmadWatcher:
+    """Background thread that calls on_change with the list of changed
+    paths under directories. Bursts of changes, like a git pull, are
+    collected until nothing has changed for debounce seconds."""
+    # pylint: disable=too-many-arguments
+
+    def __init__(self, logger, directories, on_change, debounce=2.0,
+                 polling=False):
+        """Init AnmadWatcher."""
+        self.logger = logger
+        self.directories = [os.path.abspath(d) for d in directories if d]
+        self.on_change = on_change
+        self.debounce = debounce
+        self.polling = polling
+        self.watch = None
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """Start watching in a background thread."""
+        if not self.polling:
+            try:
+                self.watch = InotifyWatch(self.directories)
+                self.logger.info("Watching %s with inotify",
+                                 ' '.join(self.directories))
+            except OSError as error:
+                self.logger.warning(
+                    "inotify unavailable (%s), polling for changes instead",
+                    str(error))
+        if self.watch is None:
+            self.watch = PollingWatch(self.directories)
+            self.logger.info("Polling %s for changes",
+                             ' '.join(self.directories))
+        self.thread = threading.Thread(
+            target=self.run, name='anmad-watcher', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop watching."""
+        self.stopping.set()
+
+    def run(self):
+        """Wait for bursts of changes and hand them to on_change."""
+        while not self.stopping.is_set():
+            changed = set(self.watch.changes(POLL_INTERVAL))
+            if not changed:
+                continue
+            while not self.stopping.is_set():
+                more = self.watch.changes(self.debounce)
+                if not more:
+                    break
+                changed.update(more)
+            try:
+                self.on_change(sorted(changed))
+            except Exception: # pylint: disable=broad-except
+                self.logger.exception("Error handling changed files")
+        self.watch.close()
@@ -0,0 +1,281 @@
+"""Leased job consumer, so that many daemons can share one queue."""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from socket import getfqdn
+from uuid import uuid4
+
+from anmad.common.jobs import DEFAULT_PRIORITY, is_invalid, is_job
+from anmad.common.queues import (
+    lease_key_for, processing_key_for, requeue_key_for, status_key_for,
+    worker_ids, workers_key_for)
+
+# seconds a job may wait in a lower priority lane before it is claimed
+# ahead of jobs in higher priority lanes
+STARVE_AFTER = 900
+# seconds between checks of the lower priority lanes while waiting for
+# a job on the highest one
+LANE_POLL = 1.0
+
+class AnmadWorker:
+    """Claims jobs from a queue under a lease.
+
+    A claimed job is moved to a processing list owned by this worker,
+    and a lease key with a TTL is kept alive by a heartbeat thread.
+    If a worker dies its lease expires, and any other worker will move
+    its claimed jobs back to the head of the queue.
+
+    The heartbeat also keeps a status record for the interface, with
+    the workers start time, version, state, current job and the time
+    of its last progress. It expires along with the lease.
+
+    If lanes, a dict of queues by priority (highest first), is given,
+    jobs are claimed from the highest priority lane with jobs waiting,
+    unless the oldest job in a lane has waited more than starve_after
+    seconds, in which case the highest priority such lane goes first.
+    The lease, processing list and status keys are those of queue."""
+    # pylint: disable=too-many-instance-attributes,too-many-arguments
+
+    def __init__(self, logger, queue, lease_time=30, version=None,
+                 lanes=None, starve_after=STARVE_AFTER):
+        """Init AnmadWorker."""
+        self.logger = logger
+        self.queue = queue
+        self.lanes = lanes or {DEFAULT_PRIORITY: queue}
+        self.starve_after = starve_after
+        self.redis = queue.redis
+        self.lease_time = lease_time
+        self.worker_id = (getfqdn() + ':' + str(os.getpid()) + ':'
+                          + uuid4().hex[:8])
+        self.workers_key = workers_key_for(queue)
+        self.processing_key = processing_key_for(queue, self.worker_id)
+        self.requeue_key = requeue_key_for(queue, self.worker_id)
+        self.status_key = status_key_for(queue, self.worker_id)
+        self.version = version
+        self.locks = []
+        self.stopping = threading.Event()
+        self.heartbeat_thread = None
+
+    @property
+    def lease_key(self):
+        """Return the lease key name for this worker."""
+        return lease_key_for(self.queue, self.worker_id)
+
+    def start(self):
+        """Take out a lease and start the heartbeat thread."""
+        now = time.time()
+        self.redis.hset(self.status_key, mapping={
+            "host": getfqdn(),
+            "pid": os.getpid(),
+            "version": str(self.version),
+            "started": now,
+            "state": 'idle',
+            "job": 'null',
+            "progress": now})
+        self.renew()
+        self.redis.sadd(self.workers_key, self.worker_id)
+        self.heartbeat_thread = threading.Thread(
+            target=self.heartbeat, name='anmad-heartbeat', daemon=True)
+        self.heartbeat_thread.start()
+        self.logger.info("Worker %s started", self.worker_id)
+
+    def stop(self):
+        """Stop the heartbeat, requeue anything still claimed and give up
+        the lease."""
+        self.stopping.set()
+        if self.heartbeat_thread is not None:
+            # so a renew already under way cant recreate the status
+            self.heartbeat_thread.join()
+        self.requeue(self.worker_id)
+        self.redis.delete(self.lease_key, self.status_key)
+
+    def progress(self, state, job=None):
+        """Record what this worker is doing in its status."""
+        self.redis.hset(self.status_key, mapping={
+            "state": state,
+            "job": json.dumps(job),
+            "progress": time.time()})
+
+    def renew(self):
+        """Extend the lease and status, and any locks held by this
+        worker."""
+        pipe = self.redis.pipeline()
+        pipe.set(self.lease_key, self.worker_id, ex=self.lease_time)
+        pipe.hset(self.status_key, "beat", time.time())
+        pipe.expire(self.status_key, self.lease_time)
+        pipe.execute()
+        for lock in list(self.locks):
+            lock.reacquire()
+
+    def heartbeat(self):
+        """Renew the lease until stopped."""
+        while not self.stopping.wait(self.lease_time / 3):
+            try:
+                self.renew()
+            except Exception: # pylint: disable=broad-except
+                self.logger.exception("Worker %s heartbeat failed",
+                                      self.worker_id)
+
+    def lane(self, job):
+        """Return the lane a job belongs in."""
+        if isinstance(job, dict):
+            return self.lanes.get(job.get("priority"), self.queue)
+        return self.queue
+
+    def requeue(self, worker_id):
+        """Move jobs claimed by a worker back to the head of their lanes.
+        Each job is first moved atomically to this workers requeue list,
+        so that only one worker requeues it, then decoded and moved on
+        to its lane. A worker that dies in between leaves it in its own
+        requeue list, which is drained along with its processing list.
+        Returns number of jobs requeued."""
+        sources = [processing_key_for(self.queue, worker_id)]
+        if worker_id != self.worker_id:
+            sources.append(requeue_key_for(self.queue, worker_id))
+        count = 0
+        for source in sources:
+            while True:
+                msg = self.redis.lmove(
+                    source, self.requeue_key, 'RIGHT', 'LEFT')
+                if msg is None:
+                    break
+                job = self.queue.serializer.loads(msg)
+                lane = self.lane(job)
+                if is_invalid(job):
+                    lane.bury(msg, self.requeue_key)
+                    self.logger.error(
+                        "Moved malformed message from %s to %s: %s",
+                        source, lane.dead_key, job["error"])
+                    continue
+                self.redis.lmove(self.requeue_key, lane.key, 'LEFT', 'LEFT')
+                if is_job(job):
+                    # waiting again, so identical jobs coalesce with it
+                    lane.remember(job, msg)
+                lane.bump()
+                count += 1
+        return count
+
+    def requeue_expired(self):
+        """Requeue jobs claimed by any worker whose lease has expired."""
+        for worker_id in worker_ids(self.queue):
+            if self.redis.exists(lease_key_for(self.queue, worker_id)):
+                continue
+            count = self.requeue(worker_id)
+            self.redis.srem(self.workers_key, worker_id)
+            if count:
+                self.logger.warning(
+                    "Requeued %s job(s) from expired worker %s",
+                    count, worker_id)
+
+    def pick_lane(self):
+        """Return the lane to claim the next job from, or None if they
+        are all empty. A lane with a message that cant be decoded at its
+        head goes first, so that claim moves it to the dead letters."""
+        pipe = self.redis.pipeline()
+        for lane in self.lanes.values():
+            pipe.lindex(lane.key, 0)
+        waiting = [(lane, lane.serializer.loads(head)) for lane, head in
+                   zip(self.lanes.values(), pipe.execute())
+                   if head is not None]
+        if not waiting:
+            return None
+        for lane, job in waiting:
+            if is_invalid(job):
+                return lane
+        now = time.time()
+        for lane, job in waiting:
+            submitted = job.get("submitted") if isinstance(job, dict) else None
+            if (isinstance(submitted, (int, float))
+                    and now - submitted > self.starve_after):
+                return lane
+        return waiting[0][0]
+
+    def claim(self, timeout=None):
+        """Wait for a job and move it to this workers processing list.
+        Returns the job, or None if nothing arrived before timeout. With
+        a timeout of 0, only a job that is already waiting is claimed.
+        Messages that cant be decoded are moved to the dead letter list
+        of their lane, and waiting carries on."""
+        if timeout is None:
+            timeout = self.lease_time
+        deadline = time.time() + timeout
+        while True:
+            lane, msg = self.move_next(deadline)
+            if msg is None:
+                return None
+            job = self.claimed(lane, msg)
+            if job is not None:
+                return job
+
+    def move_next(self, deadline):
+        """Wait until deadline for a message and move it to this workers
+        processing list. Returns (lane, message), or (None, None) if
+        nothing arrived."""
+        toplane = next(iter(self.lanes.values()))
+        while True:
+            lane = self.pick_lane()
+            if lane is not None:
+                msg = self.redis.lmove(
+                    lane.key, self.processing_key, 'LEFT', 'RIGHT')
+                if msg is not None:
+                    return lane, msg
+                # another worker got there first
+                continue
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None, None
+            # wait on the highest priority lane, looking at the others
+            # every LANE_POLL seconds
+            msg = self.redis.blmove(
+                toplane.key, self.processing_key,
+                remaining if len(self.lanes) == 1
+                else min(remaining, LANE_POLL), 'LEFT', 'RIGHT')
+            if msg is not None:
+                return toplane, msg
+
+    def claimed(self, lane, msg):
+        """Return a job moved from a lane to the processing list, or None
+        if it couldnt be decoded, after moving it to the dead letter
+        list."""
+        job = lane.serializer.loads(msg)
+        if is_invalid(job):
+            lane.bury(msg, self.processing_key)
+            self.logger.error(
+                "Moved malformed message from %s to %s: %s",
+                lane.name, lane.dead_key, job["error"])
+        else:
+            lane.forget(job, msg)
+        lane.bump()
+        return None if is_invalid(job) else job
+
+    def release(self):
+        """Mark the claimed job as done."""
+        self.redis.delete(self.processing_key)
+
+    def consume(self):
+        """Generator yielding claimed jobs. Each job is released when the
+        caller asks for the next one."""
+        while not self.stopping.is_set():
+            self.requeue_expired()
+            job = self.claim()
+            if job is None:
+                continue
+            yield job
+            self.release()
+
+    @contextmanager
+    def lock(self, name):
+        """Hold a cluster-wide lock, kept alive by the heartbeat."""
+        lock = self.redis.lock(
+            self.queue.key + ':lock:' + name,
+            timeout=self.lease_time,
+            thread_local=False)
+        lock.acquire()
+        self.locks.append(lock)
+        try:
+            yield lock
+        finally:
+            self.locks.remove(lock)
+            lock.release()
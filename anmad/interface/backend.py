@@ -2,10 +2,11 @@
 """Functions for anmad_interface."""
 
 from time import localtime,gmtime,strftime,strptime
-from os.path import basename
+import json
 import subprocess
 
-from anmad.common.yaml import find_yaml_files
+from anmad.common.catalog import PlaybookCatalog
+from anmad.common.queues import processing_key_for, status_key_for, worker_ids
 
 TIME_FORMAT = '%a %d %b %H:%M:%S %Z'
 
@@ -17,13 +18,16 @@ def buttonlist(playbooks, prerun=None):
         my_buttonlist = (playbooks)
     return my_buttonlist
 
+def catalog(**config):
+    """Get the playbook catalog from config, or a new one for
+    playbook_root_dir if there isnt one."""
+    if config.get("catalog") is not None:
+        return config["catalog"]
+    return PlaybookCatalog(config["logger"], config["args"].playbook_root_dir)
+
 def extraplays(prerun=None, **config):
     """Get a list of yaml files in root dir that arent in buttonlist()."""
-    yamlfiles = find_yaml_files(
-        config["logger"], config["args"].playbook_root_dir)
-    yamlbasenames = []
-    for yml in yamlfiles:
-        yamlbasenames.append(basename(yml))
+    yamlbasenames = catalog(**config).playbooks()
     if prerun is None:
         my_buttonlist = buttonlist(config["args"].playbooks)
     else:
@@ -61,6 +65,59 @@ def service_status(service):
             "sub_state": sub_state,
             "state_change_time": state_change_time}
 
+def daemon_status(**config):
+    """Return daemon status from the heartbeat records of running daemons,
+    in the same form as service_status, plus a list of daemons. If no
+    daemon is running, fall back to systemctl when --systemctl_status
+    is set."""
+    queue = config["queues"].queue
+    redis_conn = config["queues"].redis
+    pipe = redis_conn.pipeline()
+    for worker_id in worker_ids(queue):
+        pipe.hgetall(status_key_for(queue, worker_id))
+    daemons = []
+    for status in pipe.execute():
+        if not status:
+            continue
+        status = {key.decode(): value.decode()
+                  for key, value in status.items()}
+        status["job"] = json.loads(status.get("job", 'null'))
+        for key in ['started', 'progress', 'beat']:
+            status[key] = float(status.get(key, 0))
+        daemons.append(status)
+    if not daemons:
+        if getattr(config["args"], 'systemctl_status', False):
+            return service_status('anmad')
+        return {"service": 'anmad',
+                "active_state": 'inactive',
+                "sub_state": 'dead',
+                "state_change_time": 'no daemon heartbeat',
+                "daemons": daemons}
+    daemons.sort(key=lambda status: status["started"])
+    return {"service": 'anmad',
+            "active_state": 'active',
+            "sub_state": 'running',
+            "state_change_time": strftime(
+                TIME_FORMAT, localtime(daemons[0]["started"])),
+            "daemons": daemons}
+
+def claimed_jobs(**config):
+    """Return list of (worker id, job) for every job claimed from the
+    playbooks queue by a daemon and not yet finished."""
+    queue = config["queues"].queue
+    redis_conn = config["queues"].redis
+    workers = worker_ids(queue)
+    pipe = redis_conn.pipeline()
+    for worker_id in workers:
+        pipe.lrange(processing_key_for(queue, worker_id), 0, -1)
+    return [(worker_id, queue.serializer.loads(msg))
+            for worker_id, msgs in zip(workers, pipe.execute())
+            for msg in msgs]
+
+def timeformat(when):
+    """Return a unix time formatted as a local time string."""
+    return strftime(TIME_FORMAT, localtime(when))
+
 def timestring():
     """Return a tuple with formatted strings for localtime, and GMT time as a
     second value if localtime is not GMT."""
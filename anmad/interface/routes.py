@@ -3,30 +3,58 @@
 
 from socket import getfqdn
 from glob import glob
-from os.path import basename, isfile, isdir, abspath, dirname, normpath, getctime, relpath
-from flask import Flask, render_template, request, abort, redirect
+from os.path import basename, isfile, isdir, abspath, dirname, normpath, relpath
+from flask import (
+    Flask, Response, render_template, request, abort, redirect, send_file)
 
-from anmad.interface.backend import service_status, extraplays, timestring
-from anmad.common.queues import AnmadQueues
+from anmad.interface.backend import (
+    daemon_status, extraplays, timeformat, timestring)
+from anmad.common.catalog import PlaybookCatalog
+from anmad.common.jobs import DEFAULT_PRIORITY, PRIORITIES
+from anmad.common import timings
+from anmad.common.logfiles import LOG_BASE, compressed, follow, read_page
+from anmad.common.lifecycle import JobRecords
+from anmad.common.logindex import LogIndex
+from anmad.common.metrics import AnmadMetrics
+from anmad.common.queues import AnmadQueues, redis_config
 from anmad.common.args import parse_anmad_args
 from anmad.common.logging import logsetup
-from anmad.daemon.process import get_ansible_playbook_procs
+from anmad.daemon.process import ProcessRegistry
+from anmad.daemon.syncache import SyntaxCheckCache
 
 import anmad.api.backend as apibackend
 import anmad.common.version as anmadver
 
+ARGS = parse_anmad_args()
+
 config = {
-    "args": parse_anmad_args(),
+    "args": ARGS,
     "version": anmadver.VERSION,
     "hostname": getfqdn(),
     "baseurl": "/",
-    "queues": AnmadQueues('prerun', 'playbooks', 'info'),
+    "queues": AnmadQueues(
+        'prerun', 'playbooks', 'info', **redis_config(ARGS)),
 }
 
 config["logger"] = logsetup(config["args"], 'ANMAD Interface')
+config["syncache"] = SyntaxCheckCache(
+    config["logger"], config["queues"].redis)
+config["logindex"] = LogIndex(**redis_config(ARGS))
+config["metrics"] = AnmadMetrics(**redis_config(ARGS))
+config["registry"] = ProcessRegistry(**redis_config(ARGS))
+config["jobrecords"] = JobRecords(
+    ARGS.job_history_days * 86400, **redis_config(ARGS))
+if not config["logindex"].playbooks():
+    # the daemon has not indexed logs yet
+    config["logindex"].rebuild()
+config["catalog"] = PlaybookCatalog(
+    config["logger"],
+    config["args"].playbook_root_dir,
+    config["args"].recursive_catalog)
 
 flaskapp = Flask(__name__)
 flaskapp.add_template_filter(basename)
+flaskapp.add_template_filter(timeformat)
 
 @flaskapp.route(config["baseurl"])
 def mainpage():
@@ -37,13 +65,15 @@ def mainpage():
         'time': timestring(),
         'version': config["version"],
         'hostname': config["hostname"],
-        'daemon_status': service_status('anmad'),
+        'daemon_status': daemon_status(**config),
         'preq_message': config["queues"].prequeue_list,
         'queue_message': config["queues"].queue_list,
         'messages': config["queues"].info_list[0:config["args"].messagelist_size],
         'playbooks': config["args"].playbooks,
         'prerun': config["args"].pre_run_playbooks,
-        'jobs': get_ansible_playbook_procs()
+        'priorities': PRIORITIES,
+        'default_priority': DEFAULT_PRIORITY,
+        'jobs': config["registry"].procs()
         }
     config["logger"].debug("Rendering control page")
     return render_template('main.html',
@@ -58,7 +88,7 @@ def log_page():
         'time': timestring(),
         'version': config["version"],
         'hostname': config["hostname"],
-        'daemon_status': service_status('anmad'),
+        'daemon_status': daemon_status(**config),
         'messages_long': config["queues"].info_list,
         }
     config["logger"].debug("Rendering log page")
@@ -66,15 +96,16 @@ def log_page():
 
 @flaskapp.route(config["baseurl"] + "jobs")
 def jobs_page():
-    """Display running jobs (like ps -ef | grep ansible-playbook)."""
+    """Display ansible-playbook processes started by anmad daemons on this
+    host."""
     template_data = {
         'title' : 'ansible-playbook processes',
         'time': timestring(),
         'version': config["version"],
         'hostname': config["hostname"],
-        'daemon_status': service_status('anmad'),
+        'daemon_status': daemon_status(**config),
         'messages': config["queues"].info_list[0:config["args"].messagelist_size],
-        'jobs': get_ansible_playbook_procs()
+        'jobs': config["registry"].procs()
         }
     config["logger"].debug("Rendering job page")
     return render_template('job.html', **template_data)
@@ -87,8 +118,10 @@ def otherplaybooks_page():
         'time': timestring(),
         'version': config["version"],
         'hostname': config["hostname"],
-        'daemon_status': service_status('anmad'),
+        'daemon_status': daemon_status(**config),
         'messages': config["queues"].info_list[0:config["args"].messagelist_size],
+        'priorities': PRIORITIES,
+        'default_priority': DEFAULT_PRIORITY,
         'extras': extraplays(**config)
         }
     config["logger"].debug("Rendering other playbooks page")
@@ -105,7 +138,7 @@ def ansiblelog_page():
     if not play or normpath(play) == '/' or normpath(play) == '//':
         play = '/'
         toplevel = True
-    log_base = '/var/log/ansible/playbook'
+    log_base = LOG_BASE
     try_path = (log_base + play)
     latest = request.args.get('latest')
     parent = dirname(play)
@@ -127,7 +160,7 @@ def ansiblelog_page():
             'time': timestring(),
             'version': config["version"],
             'hostname': config["hostname"],
-            'daemon_status': service_status('anmad'),
+            'daemon_status': daemon_status(**config),
             'messages': config["queues"].info_list[0:config["args"].messagelist_size],
             'logs': loglist,
             'parent': parent,
@@ -136,48 +169,94 @@ def ansiblelog_page():
             'playbook': playbook,
             }
         return render_template('playbooklogs.html', **template_data)
-    # Try to find the latest logfile for play in the directory hierarchy
+    # Find the latest logfile for play in the log index
     if latest == 'True':
         config["logger"].debug("Finding latest log for " + play)
-        list_of_logs = glob(log_base + '/' + play + '/**/*.log', recursive=True)
-        if list_of_logs:
-            latest_log = max(list_of_logs, key=getctime)
-            relative_path = relpath(latest_log, start=log_base)
-            try_path = (log_base + '/' + relative_path)
-            parent = dirname('/' + relative_path)
-        else:
+        relative_path = config["logindex"].latest(play)
+        if relative_path is None:
             return abort(404, 'No logs found yet for ' + play)
+        try_path = (log_base + '/' + relative_path)
+        parent = dirname('/' + relative_path)
     # If we get here, we should be looking at a file, not a dir
     if isfile(try_path):
         config["logger"].debug("Displaying ansible log file " + try_path)
-        text = open(try_path, 'r+')
-        content = text.readlines()
-        text.close()
+        # show the last N lines, unless asked for a page at a byte offset
+        page = read_page(
+            try_path,
+            offset=request.args.get('offset', type=int),
+            before=request.args.get('before', type=int),
+            lines=request.args.get('lines', default=500, type=int))
         template_data = {
             'title' : 'ansible log for ' + play,
             'time': timestring(),
             'version': config["version"],
             'hostname': config["hostname"],
-            'daemon_status': service_status('anmad'),
+            'daemon_status': daemon_status(**config),
             'log': play,
+            'logpath': relpath(try_path, start=log_base),
             'messages': config["queues"].info_list[0:config["args"].messagelist_size],
-            'text': content,
+            'text': page["text"],
+            'page': page,
+            'run': config["logindex"].run(relpath(try_path, start=log_base)),
             'parent': parent,
             }
         return render_template('ansiblelog.html', **template_data)
     # Abort if it turns out to not be a file, or a dir.
     return abort(403, 'Not a logfile or directory containing logfiles')
 
+@flaskapp.route(config["baseurl"] + "ansiblelog/raw")
+def ansiblelog_raw():
+    """Download a raw ansible log, supports HTTP Range requests."""
+    play = request.args.get('play')
+    if not play or '..' in play:
+        return abort(403)
+    try_path = normpath(LOG_BASE + '/' + play)
+    if not isfile(try_path):
+        return abort(404)
+    if compressed(try_path):
+        return send_file(try_path, mimetype='application/gzip',
+                         as_attachment=True, conditional=True)
+    return send_file(try_path, mimetype='text/plain', conditional=True)
+
+@flaskapp.route(config["baseurl"] + "ansiblelog/stream")
+def ansiblelog_stream():
+    """Stream lines appended to an ansible log as server-sent events.
+    Each event id is the byte offset after it, so a reconnecting browser
+    resumes where it left off."""
+    play = request.args.get('play')
+    if not play or '..' in play:
+        return abort(403)
+    try_path = normpath(LOG_BASE + '/' + play)
+    if not isfile(try_path):
+        return abort(404)
+    offset = request.headers.get('Last-Event-ID', type=int)
+    if offset is None:
+        offset = request.args.get('offset', default=0, type=int)
+
+    def events():
+        for position, data in follow(try_path, offset):
+            if not data:
+                yield ': keepalive\n\n'
+                continue
+            lines = data.decode(errors='replace').splitlines()
+            yield ('id: ' + str(position) + '\n'
+                   + ''.join('data: ' + line + '\n' for line in lines)
+                   + '\n')
+
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
+
 @flaskapp.route(config["baseurl"] + "kill")
 def kill_route():
     """Route to kill a proc by PID.
-    Hopefully a PID thats verified by psutil to be an ansible-playbook!"""
+    Only PIDs in the registry of processes started by anmad are killed."""
     requestedpid = request.args.get('pid', type=int)
     return apibackend.kill_proc_by_pid(requestedpid, **config)
 
 @flaskapp.route(config["baseurl"] + "killall")
 def killall_route():
-    """equivalent to killall ansible-playbook."""
+    """Kill every ansible-playbook process started by anmad on this host."""
     return apibackend.killall_ansible(**config)
 
 @flaskapp.route(config["baseurl"] + "clearqueues")
@@ -185,6 +264,70 @@ def clearqueues_route():
     """Clear redis queues."""
     return apibackend.clearqueues(**config)
 
+@flaskapp.route(config["baseurl"] + "catalog")
+def catalog_route():
+    """List playbooks in playbook_root_dir as json."""
+    return apibackend.playbook_catalog(**config)
+
+@flaskapp.route(config["baseurl"] + "loghistory")
+def loghistory_route():
+    """List logs for a playbook, newest first, as json."""
+    return apibackend.log_history(**config)
+
+@flaskapp.route(config["baseurl"] + "runevents")
+def runevents_route():
+    """Task / host results of a run as json."""
+    return apibackend.run_events(**config)
+
+@flaskapp.route(config["baseurl"] + "timings")
+def timings_page():
+    """Report the slowest tasks and roles across runs."""
+    play = request.args.get('play') or None
+    template_data = {
+        'title' : 'anmad task timings',
+        'time': timestring(),
+        'version': config["version"],
+        'hostname': config["hostname"],
+        'daemon_status': daemon_status(**config),
+        'messages': config["queues"].info_list[0:config["args"].messagelist_size],
+        'play': play,
+        'report': timings.report(
+            config["queues"].redis, play,
+            request.args.get('count', default=20, type=int)),
+        }
+    return render_template('timings.html', **template_data)
+
+@flaskapp.route(config["baseurl"] + "jobhistory")
+def jobhistory_page():
+    """Show where recent jobs spent their time."""
+    template_data = {
+        'title' : 'anmad job history',
+        'time': timestring(),
+        'version': config["version"],
+        'hostname': config["hostname"],
+        'daemon_status': daemon_status(**config),
+        'messages': config["queues"].info_list[0:config["args"].messagelist_size],
+        'records': config["jobrecords"].recent(
+            request.args.get('start', default=0, type=int),
+            request.args.get('count', default=50, type=int)),
+        }
+    return render_template('jobhistory.html', **template_data)
+
+@flaskapp.route(config["baseurl"] + "timings.json")
+def timings_route():
+    """Slowest tasks and roles across runs as json."""
+    return apibackend.timing_report(**config)
+
+@flaskapp.route(config["baseurl"] + "metrics")
+def metrics_route():
+    """Prometheus metrics."""
+    return apibackend.metrics(**config)
+
+@flaskapp.route(config["baseurl"] + "syncache")
+def syncache_route():
+    """Syntax check cache hit rates."""
+    return apibackend.syncache_stats(**config)
+
 @flaskapp.route(config["baseurl"] + "runall")
 def runall_button():
     """Run all playbooks after verifying that files exist."""
@@ -213,3 +356,38 @@ def configuredplaybook_button(playbook):
 def otherplaybook_button(playbook):
     """Runs one playbook, if its one of the other ones found by extraplays."""
     return apibackend.otherplaybook(playbook, **config)
+
+@flaskapp.route(config["baseurl"] + 'api/v1')
+def api_version_route():
+    """Versions of anmad and of the json api."""
+    return {"anmad": config["version"], "api": 1}
+
+@flaskapp.route(config["baseurl"] + 'api/v1/jobs', methods=['POST'])
+def api_submit_route():
+    """Queue one or many jobs, returns their ids."""
+    return apibackend.submit_jobs(**config)
+
+@flaskapp.route(config["baseurl"] + 'api/v1/jobs')
+def api_jobs_route():
+    """Lifecycle records of recent jobs."""
+    return apibackend.job_history(**config)
+
+@flaskapp.route(config["baseurl"] + 'api/v1/jobs/<job_id>')
+def api_job_route(job_id):
+    """Status of one job."""
+    return apibackend.job_status(job_id, **config)
+
+@flaskapp.route(config["baseurl"] + 'api/v1/queues')
+def api_queues_route():
+    """Queued and running jobs."""
+    return apibackend.queue_state(**config)
+
+@flaskapp.route(config["baseurl"] + 'api/v1/history')
+def api_playbooks_route():
+    """Playbooks that have run history."""
+    return {"playbooks": config["logindex"].playbooks()}
+
+@flaskapp.route(config["baseurl"] + 'api/v1/history/<path:playbook>')
+def api_history_route(playbook):
+    """Recent runs of a playbook and their results."""
+    return apibackend.run_history(playbook, **config)
@@ -1,3 +1,24 @@
 #!/bin/bash
 /usr/bin/perl -MPOSIX -e '$0="/opt/bin/ansible-playbook param1 param2 /srv/config/deploy.yaml"; pause' &
+DEPLOY_PID=$!
 /usr/bin/perl -MPOSIX -e '$0="/opt/bin/ansible-playbook /srv/config/deploy2.yaml"; pause' &
+DEPLOY2_PID=$!
+
+# register them as if an anmad daemon had started them
+/home/vagrant/venv/bin/python - "$DEPLOY_PID" "$DEPLOY2_PID" <<'EOF'
+import sys
+from anmad.daemon.process import ProcessRegistry
+
+REGISTRY = ProcessRegistry()
+for pid, args in zip(sys.argv[1:], [
+        ['param1', 'param2', '/srv/config/deploy.yaml'],
+        ['/srv/config/deploy2.yaml']]):
+    playbook = args[-1].split('/')[-1]
+    REGISTRY.register(
+        int(pid), ['/opt/bin/ansible-playbook'] + args,
+        playbook=args[-1],
+        inventory='/srv/config/inventory',
+        log=(playbook + '/2020-01-01/' + playbook
+             + '.2020-01-01.00-00-00.log'),
+        syncheck=False)
+EOF
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""Tests for anmad.catalog module."""
+
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+import __main__ as main
+
+from anmad.common.catalog import PlaybookCatalog
+
+class TestCatalog(unittest.TestCase):
+    """Tests for anmad.catalog module."""
+
+    def setUp(self):
+        """Set up a temporary playbook dir."""
+        self.logger = logging.getLogger(os.path.basename(main.__file__))
+        self.logger.setLevel(logging.CRITICAL)
+        self.playbookroot = tempfile.mkdtemp()
+        for name in ['deploy.yaml', 'deploy2.yml', 'sub/deploy3.yaml',
+                     'roles/myrole/tasks/main.yml']:
+            os.makedirs(os.path.dirname(
+                os.path.join(self.playbookroot, name)), exist_ok=True)
+            open(os.path.join(self.playbookroot, name), 'w').close()
+
+    def tearDown(self):
+        """Remove the temporary playbook dir."""
+        shutil.rmtree(self.playbookroot)
+
+    def test_playbooks(self):
+        """Test non recursive and recursive listings."""
+        catalog = PlaybookCatalog(self.logger, self.playbookroot)
+        self.assertEqual(catalog.playbooks(), ['deploy.yaml', 'deploy2.yml'])
+        self.assertIn('deploy.yaml', catalog)
+        catalog = PlaybookCatalog(
+            self.logger, self.playbookroot, recursive=True)
+        self.assertEqual(catalog.playbooks(),
+                         ['deploy.yaml', 'deploy2.yml', 'sub/deploy3.yaml'])
+
+    def test_invalidation(self):
+        """Test that the index is cached until a directory changes."""
+        catalog = PlaybookCatalog(
+            self.logger, self.playbookroot, recursive=True)
+        catalog.playbooks()
+        self.assertFalse(catalog.stale())
+        os.remove(os.path.join(self.playbookroot, 'sub/deploy3.yaml'))
+        # force a visible mtime change on filesystems with coarse mtimes
+        os.utime(os.path.join(self.playbookroot, 'sub'), ns=(0, 0))
+        self.assertTrue(catalog.stale())
+        self.assertEqual(catalog.playbooks(), ['deploy.yaml', 'deploy2.yml'])
+        catalog.invalidate()
+        self.assertTrue(catalog.stale())
+
+    def test_missing_dir(self):
+        """Test that a missing dir is empty, and never cached."""
+        catalog = PlaybookCatalog(self.logger, self.playbookroot + '/missing')
+        self.assertEqual(catalog.playbooks(), [])
+        self.assertTrue(catalog.stale())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""Tests for anmad.events module."""
+
+import json
+import os
+import tempfile
+import unittest
+
+from anmad.common.events import (
+    CALLBACK_DIR, callback_env, events_file, summarize)
+
+class TestEvents(unittest.TestCase):
+    """Tests for anmad.events module."""
+
+    def setUp(self):
+        """Write a temporary events file."""
+        events = [
+            {"event": "play_start", "play": "all", "time": 10.0},
+            {"event": "task_start", "play": "all", "task": "works",
+             "role": None, "uuid": "1", "time": 10.0},
+            {"event": "host", "host": "a", "status": "ok", "changed": False,
+             "start": 10.0, "duration": 1.0, "task": "works", "role": None,
+             "uuid": "1", "time": 11.0},
+            {"event": "host", "host": "b", "status": "ok", "changed": True,
+             "start": 10.0, "duration": 2.0, "task": "works", "role": None,
+             "uuid": "1", "time": 12.0},
+            {"event": "task_start", "play": "all", "task": "breaks",
+             "role": "myrole", "uuid": "2", "time": 12.0},
+            {"event": "host", "host": "b", "status": "failed",
+             "changed": False, "start": 12.0, "duration": 0.5,
+             "task": "breaks", "role": "myrole", "uuid": "2",
+             "msg": "oops", "time": 12.5},
+            {"event": "stats", "hosts": {"a": {"ok": 1}, "b": {"ok": 1}},
+             "time": 13.0}]
+        handle, self.events = tempfile.mkstemp()
+        with os.fdopen(handle, 'w') as my_file:
+            for event in events:
+                my_file.write(json.dumps(event) + '\n')
+            my_file.write('{"event": "host", "cut sh')
+
+    def tearDown(self):
+        """Remove the temporary events file."""
+        os.remove(self.events)
+
+    def test_summarize(self):
+        """Test summarizing a run."""
+        summary = summarize(self.events)
+        self.assertEqual(summary["start"], 10.0)
+        self.assertEqual(summary["end"], 13.0)
+        self.assertEqual(summary["failed"], [
+            {"host": "b", "task": "breaks", "role": "myrole",
+             "status": "failed", "msg": "oops"}])
+        self.assertEqual([task["task"] for task in summary["tasks"]],
+                         ['works', 'breaks'])
+        self.assertEqual(summary["tasks"][0]["duration"], 2.0)
+        self.assertEqual(summary["tasks"][0]["changed"], 1)
+        self.assertEqual(summary["tasks"][1]["status"], {"failed": 1})
+        self.assertIsNone(summarize(self.events + '.missing'))
+
+    def test_callback_env(self):
+        """Test enabling the callback plugin alongside others."""
+        env = callback_env({"ANSIBLE_CALLBACKS_ENABLED": 'timer'},
+                           '/var/log/x.log')
+        self.assertEqual(env["ANSIBLE_CALLBACKS_ENABLED"],
+                         'timer,anmad_events')
+        self.assertEqual(env["ANSIBLE_CALLBACK_PLUGINS"], CALLBACK_DIR)
+        self.assertEqual(env["ANMAD_EVENTS_PATH"],
+                         '/var/log/x.log.events.jsonl')
+        self.assertEqual(events_file('/var/log/x.log.gz'),
+                         '/var/log/x.log.events.jsonl')
+        self.assertTrue(os.path.isfile(
+            os.path.join(CALLBACK_DIR, 'anmad_events.py')))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,6 +4,7 @@
 import logging
 import os
 import unittest
+import unittest.mock
 
 import __main__ as main
 
@@ -117,6 +118,105 @@ class TestInterfaceApp(unittest.TestCase):
         self.assertEqual(response.status, '302 FOUND')
         self.assertEqual(len(self.queues.queue_list), 0)
         self.assertEqual(len(self.queues.prequeue_list), 0)
+    def test_api_jobs(self):
+        """Test submitting a batch of jobs to the json api, and looking
+        them up."""
+        response = self.app.post('/api/v1/jobs', json={"jobs": [
+            {"playbooks": ['deploy.yaml', 'deploy8.yaml']},
+            {"playbooks": ['deploy2.yaml']}]})
+        self.assertEqual(response.status, '202 ACCEPTED')
+        jobs = response.get_json()["jobs"]
+        self.assertEqual(len(jobs), 2)
+        self.assertEqual(jobs[0]["playbooks"],
+                         [self.playbookroot + '/deploy.yaml',
+                          self.playbookroot + '/deploy8.yaml'])
+        response = self.app.get(jobs[1]["url"])
+        self.assertEqual(response.status, '200 OK')
+        self.assertEqual(response.get_json()["status"], 'queued')
+        self.assertEqual(response.get_json()["position"], 1)
+        response = self.app.get('/api/v1/queues')
+        self.assertEqual([job["id"] for job in
+                          response.get_json()["playbooks"]],
+                         [job["id"] for job in jobs])
+        self.assertEqual(response.get_json()["running"], [])
+        response = self.app.get('/api/v1/jobs/nosuchjob')
+        self.assertEqual(response.status, '404 NOT FOUND')
+
+    def test_api_priority(self):
+        """Test jobs can be queued at a priority, and bad priorities are
+        refused."""
+        with unittest.mock.patch.object(
+                self.queues, 'queue_jobs',
+                wraps=self.queues.queue_jobs) as queue_jobs:
+            response = self.app.post('/api/v1/jobs', json={
+                "priority": 'bulk', "jobs": [
+                    {"playbooks": ['deploy.yaml']},
+                    {"playbooks": ['deploy2.yaml'], "priority": 'urgent'},
+                    {"playbooks": ['deploy8.yaml']}]})
+        self.assertEqual(response.status, '202 ACCEPTED')
+        # one batch per lane
+        self.assertEqual(queue_jobs.call_count, 2)
+        jobs = response.get_json()["jobs"]
+        self.assertEqual([job["priority"] for job in jobs],
+                         ['bulk', 'urgent', 'bulk'])
+        response = self.app.get(jobs[1]["url"])
+        self.assertEqual(response.get_json()["queue"],
+                         self.queues.lanes['urgent'].name)
+        response = self.app.get('/api/v1/queues')
+        self.assertEqual(response.get_json()["playbooks"][0]["id"],
+                         jobs[1]["id"])
+        self.assertEqual(len(response.get_json()["lanes"]["bulk"]), 2)
+        response = self.app.post('/api/v1/jobs', json={
+            "playbooks": ['deploy.yaml'], "priority": 'whenever'})
+        self.assertEqual(response.status, '400 BAD REQUEST')
+        response = self.app.get('/playbooks/deploy.yaml?priority=urgent')
+        self.assertEqual(response.status, '302 FOUND')
+        response = self.app.get('/playbooks/deploy.yaml?priority=whenever')
+        self.assertEqual(response.status, '400 BAD REQUEST')
+
+    def test_job_history(self):
+        """Test lifecycle records are shown on the job history page and
+        in the json api."""
+        job = self.queues.queue_job(['/vagrant/samples/deploy.yaml'])
+        records = anmad.interface.routes.config["jobrecords"]
+        records.start(job, 'testworker')
+        records.mark(job["id"], 'run_end', 'finished',
+                     returncodes={'/vagrant/samples/deploy.yaml': 0})
+        response = self.app.get('/api/v1/jobs/' + job["id"])
+        self.assertEqual(response.get_json()["status"], 'queued')
+        self.assertEqual(response.get_json()["lifecycle"]["worker"],
+                         'testworker')
+        self.queues.clear()
+        response = self.app.get('/api/v1/jobs/' + job["id"])
+        self.assertEqual(response.get_json()["status"], 'finished')
+        response = self.app.get('/api/v1/jobs')
+        self.assertIn(job["id"], [record["id"] for record in
+                                  response.get_json()["jobs"]])
+        response = self.app.get('/jobhistory')
+        self.assertEqual(response.status, '200 OK')
+        self.assertIn('testworker', str(response.data))
+        records.redis.delete(records.key(job["id"]))
+        records.redis.zrem(records.recent_key, job["id"])
+
+    def test_api_bad_jobs(self):
+        """Test the json api queues nothing if any job is bad."""
+        response = self.app.post('/api/v1/jobs', json=[
+            {"playbooks": ['deploy.yaml']},
+            {"playbooks": ['../../etc/passwd']},
+            {"runall": True}])
+        self.assertEqual(response.status, '400 BAD REQUEST')
+        self.assertEqual(response.get_json()["jobs"][0]["job"], 1)
+        response = self.app.post('/api/v1/jobs', data='deploy.yaml')
+        self.assertEqual(response.status, '400 BAD REQUEST')
+        self.queues.update_job_lists()
+        self.assertEqual(len(self.queues.queue_list), 0)
+        self.assertEqual(len(self.queues.prequeue_list), 0)
+        response = self.app.post('/api/v1/jobs', json={"runall": True})
+        self.assertEqual(response.status, '202 ACCEPTED')
+        self.queues.update_job_lists()
+        self.assertEqual(len(self.queues.queue_list), 1)
+        self.assertEqual(len(self.queues.prequeue_list), 1)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -10,6 +10,7 @@ import __main__ as main
 import anmad.interface.backend
 import anmad.api.backend
 from anmad.common.queues import AnmadQueues
+from anmad.daemon.worker import AnmadWorker
 
 class TestInterfaceBackend(unittest.TestCase):
     """Tests for anmad_buttons module."""
@@ -87,7 +88,8 @@ class TestInterfaceBackend(unittest.TestCase):
             self.config["args"].playbooks,
             **self.config)
         self.config["queues"].update_job_lists()
-        self.assertTrue([('/vagrant/samples/' + playbook)] in self.config["queues"].queue_list)
+        queued = [job["playbooks"] for job in self.config["queues"].queue_list]
+        self.assertTrue([('/vagrant/samples/' + playbook)] in queued)
 
     def test_one_badplaybook(self):
         """Test that requests are denied to add playbooks not in list."""
@@ -98,7 +100,24 @@ class TestInterfaceBackend(unittest.TestCase):
                 self.config["args"].playbooks,
                 **self.config)
         self.config["queues"].update_job_lists()
-        self.assertFalse([('/vagrant/samples/' + playbook)] in self.config["queues"].queue_list)
+        queued = [job["playbooks"] for job in self.config["queues"].queue_list]
+        self.assertFalse([('/vagrant/samples/' + playbook)] in queued)
+
+    def test_daemon_status(self):
+        """Test daemon status comes from worker heartbeats."""
+        status = anmad.interface.backend.daemon_status(**self.config)
+        self.assertEqual(status["active_state"], 'inactive')
+        worker = AnmadWorker(
+            self.config["logger"], self.config["queues"].queue, version='1')
+        worker.start()
+        worker.progress('running', {"playbooks": ['deploy.yaml']})
+        status = anmad.interface.backend.daemon_status(**self.config)
+        worker.stop()
+        self.assertEqual(status["active_state"], 'active')
+        self.assertEqual(status["sub_state"], 'running')
+        self.assertEqual(status["daemons"][0]["state"], 'running')
+        self.assertEqual(status["daemons"][0]["job"]["playbooks"],
+                         ['deploy.yaml'])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""Tests for anmad.jobs module."""
+
+import os
+import pickle
+import unittest
+
+from anmad.common.jobs import (
+    JobSerializer, job_signature, make_job, is_invalid, is_job)
+
+class TestJobs(unittest.TestCase):
+    """Tests for anmad.jobs module."""
+
+    def setUp(self):
+        self.playbooks = ['/vagrant/samples/deploy.yaml',
+                          '/vagrant/samples/deploy2.yaml']
+        self.serializer = JobSerializer('run')
+
+    def test_make_job(self):
+        """Test job envelope fields."""
+        job = make_job(self.playbooks, requester='127.0.0.1')
+        self.assertTrue(is_job(job, 'run'))
+        self.assertFalse(is_job(job, 'prerun'))
+        self.assertEqual(job["playbooks"], self.playbooks)
+        self.assertEqual(job["requester"], '127.0.0.1')
+        self.assertIsNotNone(job["id"])
+        self.assertNotEqual(job["id"], make_job(self.playbooks)["id"])
+        self.assertEqual(make_job('deploy.yaml')["playbooks"], ['deploy.yaml'])
+
+    def test_job_signature(self):
+        """Test jobs running the same playbooks have the same signature."""
+        signature = job_signature(make_job(self.playbooks))
+        self.assertEqual(
+            job_signature(make_job(list(reversed(self.playbooks)))),
+            signature)
+        self.assertNotEqual(
+            job_signature(make_job(self.playbooks, jobtype='prerun')),
+            signature)
+        self.assertNotEqual(
+            job_signature(make_job(self.playbooks[:1])), signature)
+
+    def test_json_roundtrip(self):
+        """Test that jobs survive a round trip through the serializer."""
+        job = make_job(self.playbooks)
+        data = self.serializer.dumps(job)
+        self.assertNotIn(' ', data)
+        self.assertEqual(self.serializer.loads(data), job)
+        self.assertEqual(self.serializer.loads(data.encode()), job)
+
+    def test_foreign_job(self):
+        """Test that minimal jobs pushed by other tools get defaults."""
+        job = self.serializer.loads(b'{"playbooks":["deploy.yaml"]}')
+        self.assertTrue(is_job(job, 'run'))
+        self.assertIsNone(job["id"])
+
+    def test_legacy_pickle(self):
+        """Test that pickled jobs from older versions are upgraded."""
+        job = self.serializer.loads(pickle.dumps(self.playbooks))
+        self.assertTrue(is_job(job, 'run'))
+        self.assertEqual(job["playbooks"], self.playbooks)
+        job = self.serializer.loads(pickle.dumps(['restart_anmad_run']))
+        self.assertTrue(is_job(job, 'restart'))
+        self.assertEqual(JobSerializer().loads(pickle.dumps('info')), 'info')
+
+    def test_unsafe_pickle(self):
+        """Test that pickles referencing globals are refused."""
+        job = self.serializer.loads(pickle.dumps(os.getcwd))
+        self.assertTrue(is_invalid(job))
+        self.assertFalse(is_job(job))
+        self.assertIn('refusing', job["error"])
+
+    def test_malformed(self):
+        """Test that messages that arent JSON or pickle are read as
+        invalid markers instead of raising."""
+        for data in [b'{"type": "run", "playbooks": [', b'\x80\x04junk',
+                     b'\xff\xfe']:
+            job = self.serializer.loads(data)
+            self.assertTrue(is_invalid(job))
+            self.assertFalse(is_job(job))
+
+    def test_not_a_job(self):
+        """Test that valid JSON that isnt a job envelope is read as an
+        invalid marker."""
+        for data in [b'["deploy.yaml"]', b'"deploy.yaml"', b'42', b'null',
+                     b'{"type": "bogus"}', b'{"playbooks": "deploy.yaml"}']:
+            job = self.serializer.loads(data)
+            self.assertTrue(is_invalid(job))
+            self.assertFalse(is_job(job))
+
+
+if __name__ == '__main__':
+    unittest.main()
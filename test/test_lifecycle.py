@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""Tests for anmad.lifecycle module."""
+
+import pickle
+import unittest
+
+from anmad.common.jobs import make_job
+from anmad.common.lifecycle import JobRecords
+
+class TestJobRecords(unittest.TestCase):
+    """Tests for anmad.lifecycle module."""
+
+    def setUp(self):
+        """Set up test job records."""
+        self.records = JobRecords(ttl=60, prefix='test:jobs')
+        self.tearDown()
+        self.job = make_job(['/x/deploy.yaml', '/x/deploy2.yaml'])
+
+    def tearDown(self):
+        """Remove test job records."""
+        for key in self.records.redis.scan_iter('test:jobs*'):
+            self.records.redis.delete(key)
+
+    def test_lifecycle(self):
+        """Test a job record follows a job through the daemon."""
+        self.records.start(self.job, 'worker1', self.job["submitted"] + 2)
+        record = self.records.get(self.job["id"])
+        self.assertEqual(record["state"], 'dequeued')
+        self.assertEqual(record["worker"], 'worker1')
+        self.assertEqual(record["playbooks"], self.job["playbooks"])
+        self.assertEqual(record["phases"]["wait"], 2)
+        self.assertIsNone(record["phases"]["run"])
+        for point in ['prerun_done', 'syncheck_start']:
+            self.records.mark(self.job["id"], point)
+        self.records.mark(self.job["id"], 'syncheck_end',
+                          syncheck_problems=0)
+        self.records.mark(self.job["id"], 'run_start', 'running')
+        self.records.mark(self.job["id"], 'run_end', returncodes={
+            '/x/deploy.yaml': 0, '/x/deploy2.yaml': 2})
+        self.records.mark(self.job["id"], 'finished', 'failed')
+        record = self.records.get(self.job["id"])
+        self.assertEqual(record["state"], 'failed')
+        self.assertEqual(record["syncheck_problems"], 0)
+        self.assertEqual(record["returncodes"]['/x/deploy2.yaml'], 2)
+        for phase in ['prerun', 'syncheck', 'run', 'total']:
+            self.assertIsNotNone(record["phases"][phase])
+        self.assertLessEqual(
+            0, self.records.redis.ttl(self.records.key(self.job["id"])))
+
+    def test_recent(self):
+        """Test recent jobs are listed newest first."""
+        jobs = [make_job(['/x/deploy.yaml']) for _ in range(3)]
+        for num, job in enumerate(jobs):
+            self.records.start(job, 'worker1', job["submitted"] + num)
+        self.assertEqual([record["id"] for record in self.records.recent()],
+                         [job["id"] for job in reversed(jobs)])
+        self.assertEqual(len(self.records.recent(count=2)), 2)
+        self.assertIsNone(self.records.get('nosuchjob'))
+
+    def test_pickle(self):
+        """Test job records can be sent to pool workers."""
+        self.records.start(self.job, 'worker1')
+        records = pickle.loads(pickle.dumps(self.records))
+        self.assertEqual(records.get(self.job["id"])["state"], 'dequeued')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""Tests for anmad.logfiles module."""
+
+import os
+import tempfile
+import unittest
+import unittest.mock
+
+from anmad.common.logfiles import (
+    compress_log, follow, log_size, read_page, tail_offset)
+
+class TestLogfiles(unittest.TestCase):
+    """Tests for anmad.logfiles module."""
+
+    def setUp(self):
+        """Write a temporary log file."""
+        self.lines = ['line ' + str(i) + '\n' for i in range(1000)]
+        handle, self.logfile = tempfile.mkstemp(suffix='.log')
+        with os.fdopen(handle, 'w') as logfile:
+            logfile.writelines(self.lines)
+
+    def tearDown(self):
+        """Remove the temporary log file."""
+        os.remove(self.logfile)
+
+    def test_tail(self):
+        """Test reading the last lines of a log."""
+        page = read_page(self.logfile, lines=10)
+        self.assertEqual(page["text"], self.lines[-10:])
+        self.assertEqual(page["end"], page["size"])
+        self.assertIsNone(page["newer"])
+        self.assertEqual(page["older"], page["start"])
+        self.assertEqual(page["start"], tail_offset(self.logfile, 10))
+
+    def test_paging(self):
+        """Test paging backwards and forwards covers the whole log."""
+        text = []
+        page = read_page(self.logfile, offset=0, limit=1000)
+        self.assertIsNone(page["older"])
+        text.extend(page["text"])
+        while page["newer"] is not None:
+            page = read_page(self.logfile, offset=page["newer"], limit=1000)
+            text.extend(page["text"])
+        self.assertEqual(text, self.lines)
+        text = []
+        page = read_page(self.logfile, lines=1000, limit=1000)
+        text[:0] = page["text"]
+        while page["older"] is not None:
+            page = read_page(self.logfile, before=page["older"], limit=1000)
+            text[:0] = page["text"]
+        self.assertEqual(text, self.lines)
+    def test_follow(self):
+        """Test following appended lines from an offset."""
+        size = os.path.getsize(self.logfile)
+        stream = follow(self.logfile, offset=size, interval=0.01,
+                        idle=0.01)
+        self.assertEqual(next(stream), (size, b''))
+        with open(self.logfile, 'a') as logfile:
+            logfile.write('appended\npartial')
+        self.assertEqual(next(stream), (size + 9, b'appended\n'))
+        self.assertEqual(next(stream), (size + 9, b''))
+        self.assertEqual(list(stream), [])
+    def test_compressed(self):
+        """Test compressed logs read the same as uncompressed ones."""
+        tail = read_page(self.logfile, lines=10, limit=1000)
+        older = read_page(self.logfile, before=tail["older"], limit=1000)
+        page = read_page(self.logfile, offset=2000, limit=1000)
+        mtime = os.path.getmtime(self.logfile)
+        gzname = compress_log(self.logfile)
+        self.assertFalse(os.path.exists(self.logfile))
+        self.assertEqual(os.path.getmtime(gzname), mtime)
+        self.assertEqual(log_size(gzname), tail["size"])
+        # as if the log could be too big for the size in the gzip trailer
+        with unittest.mock.patch(
+                'anmad.common.logfiles.MAX_DEFLATE_RATIO', 2 ** 32):
+            self.assertEqual(log_size(gzname), tail["size"])
+        self.assertEqual(read_page(gzname, lines=10, limit=1000), tail)
+        self.assertEqual(
+            read_page(gzname, before=tail["older"], limit=1000), older)
+        self.assertEqual(read_page(gzname, offset=2000, limit=1000), page)
+        self.logfile = gzname
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""Tests for anmad.logindex module."""
+
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+from anmad.common.logindex import LogIndex
+
+class TestLogIndex(unittest.TestCase):
+    """Tests for anmad.logindex module."""
+
+    def setUp(self):
+        """Set up a temporary log dir and index."""
+        self.log_base = tempfile.mkdtemp()
+        for logfile in ['deploy.yml/2020-01-01/deploy.yml.2020-01-01.log',
+                        'deploy.yml/2020-01-02/deploy.yml.2020-01-02.log',
+                        'deploy2.yml/2020-01-01/deploy2.yml.2020-01-01.log']:
+            os.makedirs(os.path.dirname(
+                os.path.join(self.log_base, logfile)), exist_ok=True)
+            open(os.path.join(self.log_base, logfile), 'w').close()
+        self.logindex = LogIndex(self.log_base, prefix='test:logs')
+
+    def tearDown(self):
+        """Remove the temporary log dir and index."""
+        for key in self.logindex.redis.scan_iter('test:logs*'):
+            self.logindex.redis.delete(key)
+        shutil.rmtree(self.log_base)
+
+    def test_rebuild(self):
+        """Test rebuilding the index from disk."""
+        self.logindex.record('stale.yml', self.log_base + '/stale.yml/x.log')
+        self.assertEqual(self.logindex.rebuild(), 3)
+        self.assertEqual(self.logindex.playbooks(),
+                         ['deploy.yml', 'deploy2.yml'])
+        self.assertEqual(
+            len(self.logindex.history('deploy.yml')), 2)
+        self.assertIsNone(self.logindex.latest('stale.yml'))
+
+    def test_record(self):
+        """Test the latest recorded log is returned, newest first."""
+        self.logindex.rebuild()
+        newlog = self.log_base + '/deploy.yml/2020-01-03/new.log'
+        self.logindex.record('/srv/playbooks/deploy.yml', newlog)
+        self.assertEqual(self.logindex.latest('deploy.yml'),
+                         'deploy.yml/2020-01-03/new.log')
+        self.assertEqual(self.logindex.latest('/deploy.yml'),
+                         'deploy.yml/2020-01-03/new.log')
+        self.assertEqual(self.logindex.history('deploy.yml', count=1)[0][0],
+                         'deploy.yml/2020-01-03/new.log')
+
+    def test_hosts(self):
+        """Test that rebuilding one hosts index leaves other hosts
+        indexes alone."""
+        otherindex = LogIndex(self.log_base, prefix='test:logs',
+                              host='otherhost')
+        otherindex.record('other.yml', self.log_base + '/other.yml/x.log')
+        self.logindex.rebuild()
+        self.assertEqual(otherindex.latest('other.yml'), 'other.yml/x.log')
+        self.assertIsNone(self.logindex.latest('other.yml'))
+        self.assertEqual(otherindex.playbooks(), ['other.yml'])
+
+    def test_pickle(self):
+        """Test the index can be sent to pool workers."""
+        self.logindex.rebuild()
+        copied = pickle.loads(pickle.dumps(self.logindex))
+        self.assertEqual(copied.playbooks(), self.logindex.playbooks())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""Tests for anmad.metrics module."""
+
+import logging
+import pickle
+import unittest
+from socket import getfqdn
+
+from anmad.common.metrics import AnmadMetrics, PREFIX
+from anmad.common.queues import AnmadQueues
+from anmad.daemon.worker import AnmadWorker
+
+class TestMetrics(unittest.TestCase):
+    """Tests for anmad.metrics module."""
+
+    def setUp(self):
+        """Set up test metrics and queues."""
+        self.metrics = AnmadMetrics(host='testhost')
+        for key in self.metrics.redis.scan_iter(PREFIX + ':*'):
+            self.metrics.redis.delete(key)
+        self.queues = AnmadQueues('test_prerun', 'test_playbooks', 'test_info')
+        self.queues.clear()
+        self.queues.queue_job(['test.yml'])
+
+    def tearDown(self):
+        """Remove test metrics and queues."""
+        for key in self.metrics.redis.scan_iter(PREFIX + ':*'):
+            self.metrics.redis.delete(key)
+        self.queues.clear()
+
+    def test_render(self):
+        """Test recorded metrics are rendered."""
+        self.metrics.observe('job_wait_seconds', 3)
+        self.metrics.observe('job_wait_seconds', 7000)
+        self.metrics.inc('jobs_total', 2)
+        self.metrics.set_gauge('pool_workers', 4)
+        worker = AnmadWorker(logging.getLogger(), self.queues.queue)
+        worker.start()
+        self.metrics.attach(worker.status_key, worker.lease_time)
+        busy = 'anmad_pool_busy{host="%s",worker="%s"} ' % (
+            getfqdn(), worker.worker_id)
+        with self.metrics.busy('syncheck_seconds'):
+            self.assertIn(busy + '1', self.metrics.render(self.queues))
+        worker.claim(timeout=1)
+        text = self.metrics.render(self.queues).splitlines()
+        worker.stop()
+        self.assertNotIn(busy + '0', self.metrics.render(self.queues))
+        self.assertIn('anmad_job_wait_seconds_bucket{le="1"} 0', text)
+        self.assertIn('anmad_job_wait_seconds_bucket{le="5"} 1', text)
+        self.assertIn('anmad_job_wait_seconds_bucket{le="+Inf"} 2', text)
+        self.assertIn('anmad_job_wait_seconds_count 2', text)
+        self.assertIn('anmad_syncheck_seconds_count 1', text)
+        self.assertIn('anmad_jobs_total 2', text)
+        self.assertIn('anmad_pool_workers{host="testhost"} 4', text)
+        self.assertIn(busy + '0', text)
+        self.assertIn('anmad_queue_processing 1', text)
+        self.assertIn('anmad_queue_depth{queue="test_playbooks"} 0', text)
+        self.assertIn('anmad_queue_depth{queue="test_prerun"} 0', text)
+
+    def test_pickle(self):
+        """Test metrics can be sent to pool workers."""
+        self.metrics.inc('jobs_total')
+        copied = pickle.loads(pickle.dumps(self.metrics))
+        copied.inc('jobs_total')
+        self.assertIn('anmad_jobs_total 2',
+                      self.metrics.render(self.queues).splitlines())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -38,6 +38,26 @@ class TestMulti(unittest.TestCase):
             self.ansible_playbook_cmd,
             self.vaultpw)
 
+    def tearDown(self):
+        """Shut down worker pools."""
+        self.multiobj.close()
+        self.multimultiobj.close()
+
+    def test_pool(self):
+        """Test that the worker pool respects concurrency and is reused."""
+        poolobj = AnmadMulti(
+            self.logger,
+            self.testinv,
+            self.ansible_playbook_cmd,
+            self.vaultpw,
+            concurrency=2)
+        self.assertEqual(poolobj.concurrency, 2)
+        pool = poolobj.start()
+        self.assertIs(poolobj.start(), pool)
+        poolobj.close()
+        self.assertIsNone(poolobj.pool)
+        self.assertEqual(self.multiobj.concurrency, os.cpu_count())
+
     def test_one_play_many_inv(self):
         """Test syntax_check_one_play_many_inv func with single inv
         and multi inv."""
@@ -48,6 +68,26 @@ class TestMulti(unittest.TestCase):
             self.testplay)
         self.assertEqual(output, 0)
 
+    def test_syntax_check_matrix(self):
+        """Test per playbook x inventory results of syntax_check_matrix."""
+        results = self.multimultiobj.syntax_check_matrix(
+            [self.testplay, self.badplay, '/vagrant/test/badyaml.yml'])
+        self.assertEqual(results[(self.testplay, self.testinv)], 0)
+        self.assertEqual(results[(self.badplay, self.testinv)], 3)
+        self.assertEqual(
+            results[('/vagrant/test/badyaml.yml', self.testinv)], 1)
+        output = self.multimultiobj.checkmatrix(
+            [self.testplay, self.badplay])
+        self.assertEqual(output, 1)
+
+    def test_matrix_duplicates(self):
+        """Test that duplicate inventories and playbooks are checked and
+        counted once."""
+        self.assertEqual(self.multimultiobj.inventories, [self.testinv])
+        output = self.multimultiobj.checkmatrix(
+            [self.badplay, self.badplay])
+        self.assertEqual(output, 1)
+
     def test_checkplaybooks(self):
         """Test that checkplaybooks func returns 0 when everything passed,
         and not 0 if there is a bad playbook or inventory."""
@@ -84,6 +124,7 @@ class TestMulti(unittest.TestCase):
             self.timeout)
         output = timedmultiobj.runplaybooks(self.timedplay)
         self.assertEqual(output, 1)
+        timedmultiobj.close()
 
         output = self.multiobj.runplaybooks(self.timedplay)
         self.assertEqual(output, 0)
@@ -102,5 +143,26 @@ class TestMulti(unittest.TestCase):
             [self.testplay, self.timedplay])
         self.assertEqual(output, 1)
 
+    def test_runplaybooks_asyncio(self):
+        """Test that the asyncio engine returns the same results as the
+        pool engine, including timeouts."""
+        #pylint: disable=duplicate-code
+        asyncobj = AnmadMulti(
+            self.logger,
+            self.testinv,
+            self.ansible_playbook_cmd,
+            self.vaultpw,
+            self.timeout,
+            engine='asyncio')
+        output = asyncobj.runplaybooks(self.timedplay)
+        self.assertEqual(output, 1)
+        output = asyncobj.checkplaybooks(
+            [self.testplay, self.badplay])
+        self.assertEqual(output, 1)
+        output = asyncobj.runplaybooks(
+            [self.testplay, self.testplay])
+        self.assertEqual(output, 2)
+        self.assertIsNone(asyncobj.pool)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""Tests for anmad.process module."""
+
+import asyncio
+import pickle
+import subprocess
+import unittest
+
+import psutil
+
+from anmad.daemon.process import (
+    ProcessRegistry, aterminate_group, terminate_group)
+
+class TestTerminateGroup(unittest.TestCase):
+    """Tests for anmad.process process group kills."""
+
+    @staticmethod
+    def start(script):
+        """Start a shell script in its own session, with a background
+        child, returns the Popen object and the child process."""
+        proc = subprocess.Popen(
+            ['sh', '-c', script + '; sleep 30 & wait'],
+            start_new_session=True)
+        for _ in range(50):
+            children = psutil.Process(proc.pid).children()
+            if children:
+                return proc, children[0]
+            psutil.wait_procs([], timeout=0.1)
+        raise RuntimeError('child not started')
+
+    def test_sigterm(self):
+        """Test a group that exits on SIGTERM is not sent SIGKILL."""
+        proc, child = self.start('true')
+        kill_time, escalated = terminate_group(proc, 5)
+        self.assertFalse(escalated)
+        self.assertLess(kill_time, 5)
+        self.assertIsNotNone(proc.returncode)
+        child.wait(timeout=5)
+        self.assertFalse(child.is_running())
+
+    def test_sigkill(self):
+        """Test a group that ignores SIGTERM is sent SIGKILL after the
+        grace period, forks included."""
+        proc, child = self.start("trap '' TERM")
+        kill_time, escalated = terminate_group(proc, 0.5)
+        self.assertTrue(escalated)
+        self.assertGreaterEqual(kill_time, 0.5)
+        self.assertEqual(proc.returncode, -9)
+        child.wait(timeout=5)
+        self.assertFalse(child.is_running())
+
+    def test_aterminate_group(self):
+        """Test the asyncio version escalates to SIGKILL too."""
+        async def run():
+            proc = await asyncio.create_subprocess_exec(
+                'sh', '-c', "trap '' TERM; sleep 30 & wait",
+                start_new_session=True)
+            # let the shell set its trap before signalling it
+            await asyncio.sleep(0.5)
+            return proc, await aterminate_group(proc, 0.5)
+        proc, (_, escalated) = asyncio.run(run())
+        self.assertTrue(escalated)
+        self.assertEqual(proc.returncode, -9)
+
+
+class TestProcessRegistry(unittest.TestCase):
+    """Tests for anmad.process ProcessRegistry."""
+
+    def setUp(self):
+        """Set up a test registry and a process to register."""
+        self.registry = ProcessRegistry(host='testhost', prefix='test:procs')
+        self.registry.redis.delete(self.registry.key)
+        self.proc = subprocess.Popen(['sleep', '30'])
+
+    def tearDown(self):
+        """Remove the test registry and process."""
+        self.proc.kill()
+        self.proc.wait()
+        self.registry.redis.delete(self.registry.key)
+
+    def test_register(self):
+        """Test registered processes are listed and looked up."""
+        entry = self.registry.register(
+            self.proc.pid, self.proc.args, playbook='deploy.yaml')
+        self.assertEqual(entry["playbook"], 'deploy.yaml')
+        self.assertEqual(entry["cmdline"], ['sleep', '30'])
+        self.assertEqual(self.registry.procs(), [entry])
+        self.assertEqual(self.registry.lookup(self.proc.pid), entry)
+        self.assertIsNone(self.registry.lookup(1))
+        self.registry.unregister(self.proc.pid)
+        self.assertEqual(self.registry.procs(), [])
+        self.assertIsNone(self.registry.lookup(self.proc.pid))
+
+    def test_stale(self):
+        """Test entries for processes that have gone, or whose pid was
+        reused, are dropped."""
+        entry = self.registry.register(self.proc.pid, self.proc.args)
+        self.registry.redis.hset(
+            self.registry.key, '1', '{"pid": 1, "created": 1, "started": 1,'
+            ' "cmdline": ["ansible-playbook"]}')
+        self.assertEqual(self.registry.procs(), [entry])
+        self.assertEqual(self.registry.redis.hlen(self.registry.key), 1)
+        self.proc.kill()
+        self.proc.wait()
+        self.assertIsNone(self.registry.lookup(self.proc.pid))
+        self.assertEqual(self.registry.procs(), [])
+
+    def test_pickle(self):
+        """Test the registry can be sent to pool workers."""
+        self.registry.register(self.proc.pid, self.proc.args)
+        registry = pickle.loads(pickle.dumps(self.registry))
+        self.assertEqual(len(registry.procs()), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
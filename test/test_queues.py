@@ -2,7 +2,7 @@
 """Tests for anmad.queues module."""
 
 import unittest
-from anmad.common.queues import AnmadQueues
+from anmad.common.queues import AnmadQueues, redis_pool
 
 class TestQueues(unittest.TestCase):
     """Tests for anmad.queues module."""
@@ -37,6 +37,26 @@ class TestQueues(unittest.TestCase):
         self.assertEqual(self.queues.queue.name, 'test_playbooks')
         self.assertEqual(self.queues.info.name, 'test_info')
 
+    def test_shared_pool(self):
+        """Test that all queues share one process-wide connection pool."""
+        otherqueues = AnmadQueues('test_prerun', 'test_playbooks', 'test_info')
+        self.assertIs(self.queues.pool, redis_pool())
+        self.assertIs(otherqueues.pool, self.queues.pool)
+
+    def test_cached_snapshot(self):
+        """Test that unchanged queues are not re-read, and changed ones are."""
+        queue_list = self.queues.queue_list
+        prequeue_list = self.queues.prequeue_list
+        self.queues.update_job_lists()
+        self.assertIs(self.queues.queue_list, queue_list)
+        self.assertIs(self.queues.prequeue_list, prequeue_list)
+        otherqueues = AnmadQueues('test_prerun', 'test_playbooks', 'test_info')
+        otherqueues.queue_job(['queue_test5.yml'])
+        self.queues.update_job_lists()
+        self.assertIsNot(self.queues.queue_list, queue_list)
+        self.assertEqual(len(self.queues.queue_list), 3)
+        self.assertIs(self.queues.prequeue_list, prequeue_list)
+
     def test_queue_initial_lengths(self):
         """Test initial queue lengths."""
         self.assertEqual(len(self.queues.queue_list), 2)
@@ -46,18 +66,74 @@ class TestQueues(unittest.TestCase):
     def test_getfromqueues(self):
         """Test that queues can be consumed in correct order."""
         # get first item from each queue
-        self.assertEqual(self.queues.prequeue.get(), [self.prequeue1])
-        self.assertEqual(self.queues.queue.get(), self.queue1)
+        self.assertEqual(
+            self.queues.prequeue.get()["playbooks"], [self.prequeue1])
+        self.assertEqual(self.queues.queue.get()["playbooks"], self.queue1)
         self.queues.update_job_lists()
         self.assertEqual(len(self.queues.queue_list), 1)
         self.assertEqual(len(self.queues.prequeue_list), 1)
         # get second item from each queue
-        self.assertEqual(self.queues.prequeue.get(), [self.prequeue2])
-        self.assertEqual(self.queues.queue.get(), self.queue2)
+        self.assertEqual(
+            self.queues.prequeue.get()["playbooks"], [self.prequeue2])
+        self.assertEqual(self.queues.queue.get()["playbooks"], self.queue2)
         self.queues.update_job_lists()
         self.assertEqual(len(self.queues.queue_list), 0)
         self.assertEqual(len(self.queues.prequeue_list), 0)
 
+    def test_coalesce(self):
+        """Test that jobs already waiting are not queued again, whatever
+        order their playbooks are in, and can be queued after they are
+        taken off the queue."""
+        job = self.queues.queue_job(list(reversed(self.queue1)))
+        self.assertTrue(job["coalesced"])
+        self.assertEqual(job["id"], self.queues.queue_list[0]["id"])
+        self.assertTrue(self.queues.prequeue_job(self.prequeue2)["coalesced"])
+        jobs = self.queues.queue_jobs(
+            [self.queue2, ['queue_test5.yml'], ['queue_test5.yml']])
+        self.assertEqual([job.get("coalesced") for job in jobs],
+                         [True, None, True])
+        self.assertEqual(jobs[1]["id"], jobs[2]["id"])
+        self.assertEqual(len(self.queues.queue), 3)
+        self.queues.queue.get()
+        self.assertNotIn("coalesced", self.queues.queue_job(self.queue1))
+        self.assertEqual(len(self.queues.queue), 3)
+
+    def test_coalesce_stale(self):
+        """Test that a job is not coalesced into one that has already
+        left the queue, however it left."""
+        queue = self.queues.queue
+        # claimed, but not yet removed from the pending jobs
+        msg = queue.redis.lmove(queue.key, queue.key + ':test', 'LEFT', 'LEFT')
+        job = self.queues.queue_job(self.queue1)
+        self.assertNotIn("coalesced", job)
+        queue.forget(queue.serializer.loads(msg), msg)
+        self.assertEqual(self.queues.queue_job(self.queue1)["id"], job["id"])
+        queue.redis.delete(queue.key + ':test')
+        # removed without going through the pending jobs at all
+        queue.redis.lrem(queue.key, 0, queue.serializer.dumps(job))
+        self.assertNotIn("coalesced", self.queues.queue_job(self.queue1))
+        self.assertEqual(len(queue), 2)
+
+    def test_lanes(self):
+        """Test that jobs go into the lane for their priority, and are
+        listed highest priority first."""
+        urgent = self.queues.queue_job(['queue_test5.yml'], priority='urgent')
+        bulk = self.queues.queue_job(['queue_test6.yml'], priority='bulk')
+        self.assertEqual(self.queues.lanes['urgent'].name,
+                         'test_playbooks-urgent')
+        self.assertEqual(len(self.queues.lanes['urgent']), 1)
+        self.assertIs(self.queues.lanes['normal'], self.queues.queue)
+        self.queues.update_job_lists()
+        self.assertEqual(self.queues.queue_list[0]["id"], urgent["id"])
+        self.assertEqual(self.queues.queue_list[-1]["id"], bulk["id"])
+        self.assertEqual(self.queues.lane_lists['bulk'][0]["priority"], 'bulk')
+        self.assertNotIn(
+            "coalesced",
+            self.queues.queue_job(['queue_test5.yml'], priority='bulk'))
+        self.queues.clear()
+        self.queues.update_job_lists()
+        self.assertEqual(len(self.queues.queue_list), 0)
+
     def test_clear_queues(self):
         """Test that clear_queues clears queues."""
         self.queues.clear()
@@ -45,8 +45,8 @@ class TestReturnCodes(unittest.TestCase):
         self.assertEqual(200, output.status_code)
         self.assertIn("/srv/config/deploy.yaml", output.text)
         self.assertIn("/srv/config/deploy2.yaml", output.text)
-        self.assertIn("self.location.href='/ansiblelog?play=deploy.yaml&latest=True'", output.text)
-        self.assertIn("self.location.href='/ansiblelog?play=deploy2.yaml&latest=True'", output.text)
+        self.assertIn("self.location.href='/ansiblelog?play=/deploy.yaml/2020-01-01/deploy.yaml.2020-01-01.00-00-00.log'", output.text)
+        self.assertIn("self.location.href='/ansiblelog?play=/deploy2.yaml/2020-01-01/deploy2.yaml.2020-01-01.00-00-00.log'", output.text)
         self.assertIn("Home", output.text)
         self.assertIn("KILL PID", output.text)
         self.assertIn("Kill all running jobs", output.text)
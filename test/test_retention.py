@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""Tests for anmad.retention module."""
+
+import logging
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import __main__ as main
+
+from anmad.common.logfiles import compress_log
+from anmad.common.logindex import LogIndex
+from anmad.daemon.retention import LogRetention
+
+class TestRetention(unittest.TestCase):
+    """Tests for anmad.retention module."""
+
+    def setUp(self):
+        """Set up a temporary log dir with a log per day for 5 days."""
+        self.logger = logging.getLogger(os.path.basename(main.__file__))
+        self.logger.setLevel(logging.CRITICAL)
+        self.log_base = tempfile.mkdtemp()
+        self.logindex = LogIndex(self.log_base, prefix='test:retention')
+        now = time.time()
+        for day in range(5):
+            logfile = os.path.join(
+                self.log_base, 'deploy.yml', str(day), 'deploy.yml.log')
+            os.makedirs(os.path.dirname(logfile))
+            with open(logfile, 'w') as my_file:
+                my_file.write('x' * 1024 * 1024)
+            when = now - (5 - day) * 86400 + 60
+            os.utime(logfile, (when, when))
+            self.logindex.record('deploy.yml', logfile, when)
+
+    def tearDown(self):
+        """Remove the temporary log dir and index."""
+        for key in self.logindex.redis.scan_iter('test:retention*'):
+            self.logindex.redis.delete(key)
+        shutil.rmtree(self.log_base)
+
+    def test_count(self):
+        """Test keeping the newest logs per playbook."""
+        retention = LogRetention(self.logger, self.logindex, max_count=2,
+                                 compress_after=0)
+        self.assertEqual(retention.prune(), (3, 0))
+        self.assertEqual(
+            [logfile for logfile, _ in self.logindex.entries('deploy.yml')],
+            ['deploy.yml/3/deploy.yml.log', 'deploy.yml/4/deploy.yml.log'])
+        self.assertFalse(os.path.exists(
+            os.path.join(self.log_base, 'deploy.yml', '0')))
+
+    def test_age_and_size(self):
+        """Test deleting logs by age, then by total size."""
+        retention = LogRetention(self.logger, self.logindex, max_days=3,
+                                 compress_after=0)
+        self.assertEqual(retention.prune(), (2, 0))
+        retention = LogRetention(self.logger, self.logindex, max_mb=2,
+                                 compress_after=0)
+        self.assertEqual(retention.prune(), (1, 0))
+        self.assertEqual(len(self.logindex.entries('deploy.yml')), 2)
+
+    def test_compress(self):
+        """Test finished logs are compressed and stay in the index."""
+        retention = LogRetention(self.logger, self.logindex,
+                                 compress_after=48)
+        self.assertEqual(retention.prune(), (0, 3))
+        self.assertEqual(self.logindex.latest('deploy.yml'),
+                         'deploy.yml/4/deploy.yml.log')
+        self.assertEqual(
+            self.logindex.entries('deploy.yml')[0][0],
+            'deploy.yml/0/deploy.yml.log.gz')
+        self.assertEqual(retention.prune(), (0, 0))
+
+    def test_rebuild_compressed(self):
+        """Test a compressed log isnt indexed as the latest run when the
+        index is rebuilt."""
+        names = ['deploy.yml.2020-01-01.00-00-00.log',
+                 'deploy.yml.2020-01-02.00-00-00.log']
+        for name in names:
+            logfile = os.path.join(self.log_base, 'deploy.yml', 'x', name)
+            os.makedirs(os.path.dirname(logfile), exist_ok=True)
+            open(logfile, 'w').close()
+        compress_log(os.path.join(self.log_base, 'deploy.yml', 'x', names[0]))
+        self.logindex.rebuild()
+        self.assertEqual(self.logindex.latest('deploy.yml'),
+                         'deploy.yml/4/deploy.yml.log')
+        self.assertEqual(
+            self.logindex.history('deploy.yml')[-2:],
+            [('deploy.yml/x/' + names[1], 1577923200.0),
+             ('deploy.yml/x/' + names[0] + '.gz', 1577836800.0)])
+
+    def test_other_hosts(self):
+        """Test logs indexed by other hosts are never pruned."""
+        otherindex = LogIndex(self.log_base, prefix='test:retention',
+                              host='otherhost')
+        # on the other hosts disk, but not this ones
+        otherindex.record('deploy.yml',
+                          self.log_base + '/deploy.yml/9/other.log', 1)
+        retention = LogRetention(self.logger, self.logindex, max_days=3,
+                                 compress_after=0)
+        self.assertEqual(retention.prune(), (2, 0))
+        self.assertEqual(otherindex.latest('deploy.yml'),
+                         'deploy.yml/9/other.log')
+
+if __name__ == '__main__':
+    unittest.main()
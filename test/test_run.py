@@ -1,12 +1,16 @@
 #!/usr/bin/env python3
 """Tests for anmad.run module."""
 
+import asyncio
 import logging
 import os
+import threading
+import time
 import unittest
 
 import __main__ as main
 
+from anmad.daemon.process import ProcessRegistry
 from anmad.daemon.run import AnmadRun
 
 class TestPlaybook(unittest.TestCase):
@@ -84,6 +88,48 @@ class TestPlaybook(unittest.TestCase):
         returned = playbookobject.run_playbook(self.timedplay, syncheck = True)
         self.assertEqual(returned.returncode, 0)
 
+    def test_arun_playbook(self):
+        """Test arun_playbook gives the same return codes as run_playbook,
+        and times out."""
+        #pylint: disable=duplicate-code
+        playbookobject = AnmadRun(
+            self.logger,
+            self.testinv,
+            self.ansible_playbook_cmd,
+            self.vaultpw,
+            self.timeout)
+        returned = asyncio.run(playbookobject.asyncheck_playbook(
+            self.testplay))
+        self.assertEqual(returned.returncode, 0)
+        returned = asyncio.run(playbookobject.arun_playbook(self.testplay))
+        self.assertEqual(returned.returncode, 4)
+        returned = asyncio.run(playbookobject.arun_playbook(self.timedplay))
+        self.assertEqual(returned.returncode, 255)
+
+    def test_registry(self):
+        """Test running ansible-playbook processes are registered."""
+        registry = ProcessRegistry(host='testhost', prefix='test:procs')
+        playbookobject = AnmadRun(
+            self.logger,
+            self.testinv,
+            self.ansible_playbook_cmd,
+            self.vaultpw,
+            self.timeout,
+            registry=registry)
+        thread = threading.Thread(
+            target=playbookobject.run_playbook, args=[self.timedplay])
+        thread.start()
+        for _ in range(50):
+            procs = registry.procs()
+            if procs:
+                break
+            time.sleep(0.1)
+        self.assertEqual(len(procs), 1)
+        self.assertEqual(procs[0]["playbook"], self.timedplay)
+        self.assertTrue(procs[0]["log"].startswith('deploy6.yaml/'))
+        thread.join()
+        self.assertEqual(registry.procs(), [])
+
 
 if __name__ == '__main__':
     unittest.main()
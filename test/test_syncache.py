@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""Tests for anmad.syncache module."""
+
+import logging
+import os
+import tempfile
+import unittest
+
+import __main__ as main
+
+from anmad.common.queues import AnmadQueues
+from anmad.daemon.run import AnmadRun
+from anmad.daemon.syncache import SyntaxCheckCache
+
+class TestSyncache(unittest.TestCase):
+    """Tests for anmad.syncache module."""
+
+    def setUp(self):
+        """Set up a cache under a test prefix."""
+        self.logger = logging.getLogger(os.path.basename(main.__file__))
+        self.logger.setLevel(logging.CRITICAL)
+        self.testplay = '/vagrant/samples/deploy.yaml'
+        self.badplay = '/vagrant/test/badyaml.yml'
+        self.testinv = '/vagrant/samples/inventory-internal'
+        self.ansible_playbook_cmd = '/home/vagrant/venv/bin/ansible-playbook'
+        self.queues = AnmadQueues('test_prerun', 'test_playbooks', 'test_info')
+        self.cache = SyntaxCheckCache(
+            self.logger, self.queues.redis, ttl=60,
+            prefix='anmad:test_syncache')
+        self.cache.clear()
+        self.playbookobj = AnmadRun(
+            self.logger, self.testinv, self.ansible_playbook_cmd)
+
+    def tearDown(self):
+        """Clear the test cache."""
+        self.cache.clear()
+
+    def test_fingerprint(self):
+        """Test that fingerprints are stable, and differ per inventory."""
+        fingerprint = self.cache.fingerprint(self.playbookobj, self.testplay)
+        self.assertIsNotNone(fingerprint)
+        self.assertEqual(
+            fingerprint,
+            self.cache.fingerprint(self.playbookobj, self.testplay))
+        otherobj = AnmadRun(
+            self.logger, '/vagrant/test/bad-inventory',
+            self.ansible_playbook_cmd)
+        self.assertNotEqual(
+            fingerprint, self.cache.fingerprint(otherobj, self.testplay))
+        self.assertIsNone(
+            self.cache.fingerprint(self.playbookobj, self.badplay))
+
+    def test_lookup_store(self):
+        """Test that only passing checks are cached, and stats count."""
+        fingerprint = self.cache.fingerprint(self.playbookobj, self.testplay)
+        self.assertFalse(self.cache.lookup(fingerprint))
+        self.cache.store(fingerprint, 4)
+        self.assertFalse(self.cache.lookup(fingerprint))
+        self.cache.store(fingerprint, 0)
+        self.assertTrue(self.cache.lookup(fingerprint))
+        self.assertFalse(self.cache.lookup(None))
+        stats = self.cache.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 2)
+        self.assertEqual(stats["uncacheable"], 1)
+        self.assertEqual(stats["entries"], 1)
+        self.assertEqual(stats["hit_rate"], 0.25)
+
+    def test_memo_latest(self):
+        """Test that only the latest version of each file is memoized."""
+        with tempfile.NamedTemporaryFile('w', suffix='.yml') as my_file:
+            for num in range(3):
+                my_file.write('- hosts: all' + str(num) + '\n')
+                my_file.flush()
+                os.utime(my_file.name, ns=(num, num))
+                self.assertEqual(self.cache.load_yaml(my_file.name)[-1],
+                                 {"hosts": 'all' + str(num)})
+                self.cache.file_digest(my_file.name)
+            self.assertEqual(list(self.cache.parsed), [my_file.name])
+            self.assertEqual(list(self.cache.file_digests), [my_file.name])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""Tests for anmad.timings module."""
+
+import unittest
+
+import redis
+
+from anmad.common import timings
+from anmad.common.queues import redis_pool
+
+class TestTimings(unittest.TestCase):
+    """Tests for anmad.timings module."""
+
+    def setUp(self):
+        """Record some runs of a test playbook."""
+        self.redis = redis.Redis(connection_pool=redis_pool())
+        self.tearDown()
+        for run in range(10):
+            start = 1000.0 * run
+            timings.record(self.redis, 'test_timings.yml', {
+                "start": start,
+                "end": start + 60,
+                "tasks": [
+                    {"task": "fast", "role": None, "start": start,
+                     "duration": 1.0},
+                    {"task": "slow", "role": "myrole", "start": start + 1,
+                     "duration": 10.0 + run},
+                    {"task": "slow too", "role": "myrole",
+                     "start": start + 20, "duration": 5.0}]})
+
+    def tearDown(self):
+        """Remove test timings."""
+        self.redis.srem(timings.PREFIX + ':playbooks', 'test_timings.yml')
+        for key in self.redis.scan_iter(timings.PREFIX + '*test_timings*'):
+            self.redis.delete(key)
+
+    def test_report(self):
+        """Test slowest tasks and roles are listed first."""
+        report = timings.report(self.redis, 'test_timings.yml', count=2)
+        self.assertEqual([task["task"] for task in report["tasks"]],
+                         ['slow', 'slow too'])
+        slow = report["tasks"][0]
+        self.assertEqual(slow["count"], 10)
+        self.assertEqual(slow["p50"], 14.0)
+        self.assertEqual(slow["p95"], 19.0)
+        self.assertEqual(slow["max"], 19.0)
+        self.assertGreater(slow["trend"], 1)
+        self.assertEqual(report["roles"][0]["role"], 'myrole')
+        self.assertEqual(report["roles"][0]["max"], 24.0)
+        self.assertEqual(report["runs"][0]["p50"], 60.0)
+
+    def test_percentile(self):
+        """Test nearest rank percentiles."""
+        self.assertIsNone(timings.percentile([], 50))
+        self.assertEqual(timings.percentile([1, 2, 3, 4], 50), 2)
+        self.assertEqual(timings.percentile(list(range(1, 101)), 95), 95)
+
+if __name__ == '__main__':
+    unittest.main()
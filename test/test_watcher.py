@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""Tests for anmad.watcher module."""
+
+import logging
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import __main__ as main
+
+from anmad.daemon.watcher import AnmadWatcher, InotifyWatch, PollingWatch
+
+class TestWatcher(unittest.TestCase):
+    """Tests for anmad.watcher module."""
+
+    def setUp(self):
+        """Set up a temporary playbook dir."""
+        self.logger = logging.getLogger(os.path.basename(main.__file__))
+        self.logger.setLevel(logging.CRITICAL)
+        self.playbookroot = tempfile.mkdtemp()
+        os.makedirs(self.playbookroot + '/roles/myrole')
+        os.makedirs(self.playbookroot + '/.git')
+
+    def tearDown(self):
+        """Remove the temporary playbook dir."""
+        shutil.rmtree(self.playbookroot)
+
+    def check_watch(self, watch):
+        """Check a watch sees new and changed files, but not hidden ones."""
+        self.assertEqual(watch.changes(0.2), [])
+        open(self.playbookroot + '/.git/HEAD', 'w').close()
+        open(self.playbookroot + '/roles/myrole/main.yml', 'w').close()
+        changed = []
+        deadline = time.time() + 3
+        while time.time() < deadline and not changed:
+            changed.extend(watch.changes(0.5))
+        watch.close()
+        self.assertIn(self.playbookroot + '/roles/myrole/main.yml', changed)
+        self.assertNotIn(self.playbookroot + '/.git/HEAD', changed)
+
+    def test_inotify(self):
+        """Test inotify watch."""
+        self.check_watch(InotifyWatch([self.playbookroot]))
+
+    def test_polling(self):
+        """Test polling watch."""
+        self.check_watch(PollingWatch([self.playbookroot], interval=0.1))
+
+    def test_debounce(self):
+        """Test that a burst of changes is handled in one call."""
+        calls = []
+        watcher = AnmadWatcher(
+            self.logger, [self.playbookroot], calls.append, debounce=0.5)
+        watcher.start()
+        for num in range(5):
+            open(self.playbookroot + '/deploy' + str(num) + '.yaml',
+                 'w').close()
+            time.sleep(0.1)
+        deadline = time.time() + 5
+        while time.time() < deadline and not calls:
+            time.sleep(0.1)
+        watcher.stop()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(calls[0]), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
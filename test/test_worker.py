@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""Tests for anmad.worker module."""
+
+import logging
+import os
+import time
+import unittest
+
+import __main__ as main
+
+from anmad.common.queues import AnmadQueues
+from anmad.daemon.worker import AnmadWorker
+
+class TestWorker(unittest.TestCase):
+    """Tests for anmad.worker module."""
+
+    def setUp(self):
+        """Set up test queues and two workers."""
+        self.logger = logging.getLogger(os.path.basename(main.__file__))
+        self.logger.setLevel(logging.CRITICAL)
+        self.queues = AnmadQueues('test_prerun', 'test_playbooks', 'test_info')
+        self.queues.clear()
+        self.worker = AnmadWorker(self.logger, self.queues.queue, lease_time=3,
+                                  lanes=self.queues.lanes)
+        self.otherworker = AnmadWorker(
+            self.logger, self.queues.queue, lease_time=3,
+            lanes=self.queues.lanes)
+        self.worker.start()
+        self.otherworker.start()
+
+    def tearDown(self):
+        """Stop workers and clear test queues."""
+        self.worker.stop()
+        self.otherworker.stop()
+        self.queues.clear()
+
+    def test_claim_release(self):
+        """Test that a claimed job leaves the queue, and only one worker
+        gets it."""
+        self.queues.queue_job(['deploy.yaml'])
+        job = self.worker.claim(timeout=1)
+        self.assertEqual(job["playbooks"], ['deploy.yaml'])
+        self.assertIsNone(self.otherworker.claim(timeout=1))
+        self.queues.update_job_lists()
+        self.assertEqual(len(self.queues.queue_list), 0)
+        self.worker.release()
+        self.otherworker.requeue_expired()
+        self.assertEqual(len(self.queues.queue), 0)
+
+    def test_requeue_expired(self):
+        """Test that jobs held by a worker whose lease expired are
+        requeued at the head of the queue."""
+        self.queues.queue_job(['deploy.yaml'])
+        self.queues.queue_job(['deploy2.yaml'])
+        self.worker.claim(timeout=1)
+        self.worker.stopping.set()
+        self.queues.queue.redis.delete(self.worker.lease_key)
+        self.otherworker.requeue_expired()
+        self.assertEqual(
+            self.queues.queue_job(['deploy.yaml'])["coalesced"], True)
+        self.assertEqual(
+            self.otherworker.claim(timeout=1)["playbooks"], ['deploy.yaml'])
+        self.assertNotIn("coalesced", self.queues.queue_job(['deploy.yaml']))
+
+    def test_lanes(self):
+        """Test that higher priority lanes are drained first, unless a
+        job has waited too long in a lower one."""
+        self.queues.queue_job(['deploy.yaml'], priority='bulk')
+        self.queues.queue_job(['deploy2.yaml'])
+        self.queues.queue_job(['deploy3.yaml'], priority='urgent')
+        self.assertEqual(
+            [self.worker.claim(timeout=1)["playbooks"] for _ in range(3)],
+            [['deploy3.yaml'], ['deploy2.yaml'], ['deploy.yaml']])
+        self.worker.release()
+        self.worker.starve_after = 0.5
+        self.queues.queue_job(['deploy.yaml'], priority='bulk')
+        time.sleep(0.6)
+        self.queues.queue_job(['deploy3.yaml'], priority='urgent')
+        self.assertEqual(self.worker.claim(timeout=1)["priority"], 'bulk')
+
+    def test_requeue_lanes(self):
+        """Test that expired jobs are requeued in their own lanes."""
+        self.queues.queue_job(['deploy.yaml'], priority='urgent')
+        self.queues.queue_job(['deploy2.yaml'], priority='bulk')
+        self.worker.claim(timeout=1)
+        self.worker.claim(timeout=1)
+        self.worker.stopping.set()
+        self.queues.queue.redis.delete(self.worker.lease_key)
+        self.otherworker.requeue_expired()
+        self.assertEqual(len(self.queues.lanes['urgent']), 1)
+        self.assertEqual(len(self.queues.lanes['bulk']), 1)
+        self.assertEqual(len(self.queues.queue), 0)
+        self.assertEqual(self.otherworker.claim(timeout=1)["playbooks"],
+                         ['deploy.yaml'])
+
+    def test_requeue_leftovers(self):
+        """Test that jobs a worker died requeueing are requeued with the
+        rest of its claimed jobs, and bad messages are buried."""
+        lane = self.queues.lanes['bulk']
+        self.queues.redis.delete(lane.dead_key)
+        self.queues.queue_job(['deploy.yaml'], priority='bulk')
+        self.worker.claim(timeout=1)
+        self.queues.redis.rpush(self.worker.processing_key, b'not json')
+        self.queues.redis.rpush(
+            self.worker.requeue_key, lane.serializer.dumps(
+                self.queues.queue_job(['deploy2.yaml'], priority='urgent')))
+        self.queues.redis.delete(self.queues.lanes['urgent'].key)
+        self.worker.stopping.set()
+        self.queues.queue.redis.delete(self.worker.lease_key)
+        self.otherworker.requeue_expired()
+        self.assertEqual(len(self.queues.lanes['bulk']), 1)
+        self.assertEqual(len(self.queues.lanes['urgent']), 1)
+        self.assertEqual(self.queues.redis.lrange(self.queues.queue.dead_key,
+                                                  0, -1), [b'not json'])
+        self.assertFalse(self.queues.redis.exists(
+            self.worker.requeue_key, self.otherworker.requeue_key,
+            self.worker.processing_key))
+        self.queues.redis.delete(self.queues.queue.dead_key)
+
+    def test_bad_heads(self):
+        """Test that a bad message at the head of a lane is buried before
+        anything else is claimed, and a bad submitted time is ignored."""
+        lane = self.queues.lanes['bulk']
+        self.queues.redis.delete(lane.dead_key)
+        self.queues.redis.rpush(lane.key, b'not json')
+        self.queues.redis.rpush(
+            self.queues.queue.key, b'{"type":"run","playbooks":["x.yml"],'
+            b'"submitted":"yesterday"}')
+        self.queues.queue_job(['deploy.yaml'], priority='urgent')
+        self.assertEqual(self.worker.claim(timeout=1)["playbooks"],
+                         ['deploy.yaml'])
+        self.assertEqual(self.queues.redis.llen(lane.dead_key), 1)
+        self.assertEqual(self.worker.claim(timeout=1)["playbooks"],
+                         ['x.yml'])
+        self.queues.redis.delete(lane.dead_key)
+
+    def test_claim_timeout(self):
+        """Test that claiming from empty lanes gives up after timeout."""
+        start = time.time()
+        self.assertIsNone(self.worker.claim(timeout=1.5))
+        self.assertGreaterEqual(time.time() - start, 1.5)
+
+    def test_claim_waiting(self):
+        """Test that a timeout of 0 only claims a job already waiting,
+        and that prerun jobs claimed by a dead worker are requeued."""
+        preworker = AnmadWorker(self.logger, self.queues.prequeue,
+                                lease_time=3)
+        preworker.start()
+        self.queues.prequeue_job('deploy.yaml')
+        self.assertEqual(preworker.claim(timeout=0)["playbooks"],
+                         ['deploy.yaml'])
+        start = time.time()
+        self.assertIsNone(preworker.claim(timeout=0))
+        self.assertLess(time.time() - start, 1)
+        preworker.stopping.set()
+        preworker.redis.delete(preworker.lease_key)
+        otherpreworker = AnmadWorker(self.logger, self.queues.prequeue,
+                                     lease_time=3)
+        otherpreworker.requeue_expired()
+        self.assertEqual(otherpreworker.claim(timeout=0)["playbooks"],
+                         ['deploy.yaml'])
+        otherpreworker.release()
+
+    def test_malformed(self):
+        """Test that messages that cant be decoded are moved to the dead
+        letters, and the next job is claimed."""
+        lane = self.queues.lanes['bulk']
+        self.queues.redis.delete(lane.dead_key)
+        self.queues.redis.rpush(lane.key, b'not json')
+        self.queues.queue_job(['deploy.yaml'], priority='bulk')
+        self.assertEqual(self.worker.claim(timeout=1)["playbooks"],
+                         ['deploy.yaml'])
+        self.assertEqual(self.queues.redis.lrange(lane.dead_key, 0, -1),
+                         [b'not json'])
+        self.assertEqual(
+            self.queues.redis.llen(self.worker.processing_key), 1)
+        self.queues.redis.delete(lane.dead_key)
+
+    def test_lock(self):
+        """Test that a held lock is exclusive."""
+        with self.worker.lock('prerun') as lock:
+            self.assertTrue(lock.owned())
+            otherlock = self.otherworker.queue.redis.lock(
+                lock.name, blocking=False)
+            self.assertFalse(otherlock.acquire())
+
+    def test_status(self):
+        """Test the status record follows progress and goes on stop."""
+        self.worker.progress('running', {"playbooks": ['deploy.yaml']})
+        status = self.queues.redis.hgetall(self.worker.status_key)
+        self.assertEqual(status[b'state'], b'running')
+        self.assertIn(b'deploy.yaml', status[b'job'])
+        self.assertGreater(self.queues.redis.ttl(self.worker.status_key), 0)
+        self.worker.stop()
+        self.assertFalse(self.queues.redis.exists(self.worker.status_key))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,7 +4,9 @@
 
 import logging
 import os
+import tempfile
 import unittest
+import unittest.mock
 
 import __main__ as main
 
@@ -77,6 +79,46 @@ class TestYaml(unittest.TestCase):
         verify = anmad.common.yaml.list_bad_yamlfiles(self.logger, ['/vagrant/samples'])
         self.assertEqual(verify, [])
 
+    def test_yaml_errors(self):
+        """Test that yaml_errors reports line and column of bad yaml,
+        both serially and across worker processes."""
+        errors = anmad.common.yaml.yaml_errors(self.logger, ['/vagrant/test'])
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(errors[0]["file"], '/vagrant/test/badyaml.yml')
+        self.assertIsNotNone(errors[0]["line"])
+        self.assertIsNotNone(errors[0]["column"])
+        manyfiles = self.testyamlfiles_parent * 10
+        manyfiles.append('/vagrant/test/badyaml.yml')
+        errors = anmad.common.yaml.yaml_errors(
+            self.logger, manyfiles, processes=2)
+        self.assertEqual([e["file"] for e in errors],
+                         ['/vagrant/test/badyaml.yml'])
+        with unittest.mock.patch('anmad.common.yaml.Pool') as pool:
+            errors = anmad.common.yaml.yaml_errors(
+                self.logger, manyfiles, processes=1)
+        pool.assert_not_called()
+        self.assertEqual(len(errors), 1)
+        errors = anmad.common.yaml.yaml_errors(
+            self.logger, ['/vagrant/test/missing.yml'])
+        self.assertIsNone(errors[0]["line"])
+
+    def test_yaml_errors_constructor(self):
+        """Test that yaml_errors reports files that parse, but have tags
+        or values the safe loader cant construct."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for name, content in [
+                    ('tag.yml', 'cmd: !!python/object/apply:os.system [id]\n'),
+                    ('date.yml', 'when: 2020-13-45\n'),
+                    ('good.yml', '---\na: 1\n---\nb: [2, 3]\n')]:
+                with open(tmpdir + '/' + name, 'w') as myfile:
+                    myfile.write(content)
+            errors = anmad.common.yaml.yaml_errors(
+                self.logger, [tmpdir], processes=1)
+        self.assertEqual(sorted(os.path.basename(e["file"]) for e in errors),
+                         ['date.yml', 'tag.yml'])
+        tagerror = [e for e in errors if e["file"].endswith('tag.yml')][0]
+        self.assertEqual(tagerror["line"], 1)
+
     def test_list_missing_files(self):
         """Test missing files func."""
         testfiles = ['/vagrant/samples/' + x for x in self.playbooks]